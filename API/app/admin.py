@@ -0,0 +1,53 @@
+import hmac
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from .clients import get_client_registry
+from .config import get_settings
+from .drain import get_drainer
+
+
+def require_admin(x_admin_token: Optional[str] = Header(default=None)) -> None:
+  """Admin routes can drain the server and rewrite budgets; without HPB_ADMIN_TOKEN they do not exist."""
+  token = get_settings().admin_token
+  if not token:
+    raise HTTPException(status_code=404, detail="Admin routes are disabled (HPB_ADMIN_TOKEN is not set)")
+  if not hmac.compare_digest(x_admin_token or "", token):
+    raise HTTPException(status_code=403, detail="Admin token required")
+
+
+router = APIRouter(prefix="/admin", tags=["admin"], dependencies=[Depends(require_admin)])
+
+
+class WeightRequest(BaseModel):
+  weight: float
+
+
+@router.get("/clients")
+def list_clients() -> JSONResponse:
+  return JSONResponse(get_client_registry().snapshot())
+
+
+@router.get("/drain")
+def drain_status() -> JSONResponse:
+  return JSONResponse(get_drainer().status())
+
+
+@router.post("/drain")
+def start_drain() -> JSONResponse:
+  """Stops taking new jobs and saves the queue; restart the process afterwards to resume it."""
+  drainer = get_drainer()
+  drainer.start("admin")
+  return JSONResponse(drainer.status(), status_code=202)
+
+
+@router.put("/clients/{client}")
+def set_client_weight(client: str, body: WeightRequest) -> JSONResponse:
+  if body.weight <= 0:
+    raise HTTPException(status_code=400, detail="weight must be positive")
+  registry = get_client_registry()
+  registry.set_weight(client, body.weight)
+  return JSONResponse({"client": client, "weight": registry.weight(client)})
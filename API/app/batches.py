@@ -0,0 +1,274 @@
+"""
+Manifest batches: thousands of cases given as input references, fed to the job queue a chunk at a
+time, with per-case progress and a final index written when the last case finishes.
+"""
+import csv
+import io
+import json
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from .config import get_settings
+from .jobs import DONE, FAILED, PERSISTED, Job
+
+PENDING = "pending"
+QUEUED = "queued"
+# Never submitted because the batch was cancelled.
+SKIPPED = "skipped"
+# Progress is also written to disk at most this often, so a long batch can be inspected offline.
+CHECKPOINT_SECONDS = 10.0
+
+
+@dataclass
+class BatchCase:
+  case_id: str
+  source: str
+  status: str = PENDING
+  job_id: Optional[str] = None
+  content_hash: Optional[str] = None
+  error: Optional[str] = None
+  result_url: Optional[str] = None
+  submitted_at: Optional[float] = None
+  finished_at: Optional[float] = None
+
+
+def case_id_for(source: str) -> str:
+  """hepaticvessel_001.nii.gz -> hepaticvessel_001 (and the nnU-Net _0000 channel suffix is dropped)."""
+  name = source.rstrip("/").rsplit("/", 1)[-1]
+  for suffix in (".nii.gz", ".nii", ".zip"):
+    if name.endswith(suffix):
+      name = name[: -len(suffix)]
+      break
+  return name[:-5] if name.endswith("_0000") else name
+
+
+def parse_manifest(text: str) -> List[Dict[str, str]]:
+  """A JSON list (of URIs, or of objects with ``source`` and optional ``case_id``), or CSV ``case_id,source``."""
+  stripped = text.lstrip()
+  if stripped.startswith("[") or stripped.startswith("{"):
+    data = json.loads(text)
+    rows = data.get("cases", []) if isinstance(data, dict) else data
+    return [{"source": row} if isinstance(row, str) else dict(row) for row in rows]
+  rows = []
+  for record in csv.reader(io.StringIO(text)):
+    if not record or record[0].startswith("#") or record[0].strip() == "case_id":
+      continue
+    rows.append({"source": record[0].strip()} if len(record) == 1 else
+                {"case_id": record[0].strip(), "source": record[1].strip()})
+  return rows
+
+
+class BatchRun:
+  """
+  Keeps at most ``chunk`` of its cases in the job queue. Workers stay busy, while a huge batch neither
+  floods the queue ahead of other clients nor holds scratch space for cases that cannot run yet.
+  ``start_case`` turns a case into a queued job; ``finish_case`` stores its result once it is done.
+  """
+
+  def __init__(self, batch_id: str, cases: List[BatchCase], *, chunk: int, client: str, params: Dict[str, Any],
+               start_case: Callable[[BatchCase], Job], finish_case: Callable[[BatchCase, Job], None],
+               finish_batch: Callable[["BatchRun"], Dict[str, Any]], should_stop: Callable[[], bool],
+               options: Optional[Dict[str, Any]] = None, attached: Optional[Dict[str, Job]] = None) -> None:
+    self.batch_id = batch_id
+    self.cases = cases
+    self.chunk = max(1, chunk)
+    self.client = client
+    self.params = params
+    # Whatever else the callbacks were built from (priority, publish), kept so a restart can rebuild them.
+    self.options = options or {}
+    self.created_at = time.time()
+    self.finished_at: Optional[float] = None
+    self.cancelled = False
+    # Stopped by a drain with cases left; the drainer saves the batch and the next process resumes it.
+    self.suspended = False
+    self.extra: Dict[str, Any] = {}
+    self._attached = attached or {}
+    self._start_case = start_case
+    self._finish_case = finish_case
+    self._finish_batch = finish_batch
+    self._should_stop = should_stop
+    self._lock = threading.Lock()
+    self._checkpointed = 0.0
+    self._thread = threading.Thread(target=self._run, name=f"hpb-{batch_id}", daemon=True)
+
+  @property
+  def index_path(self) -> Path:
+    return get_settings().result_root / "batches" / f"{self.batch_id}.json"
+
+  def start(self) -> "BatchRun":
+    self._thread.start()
+    return self
+
+  def cancel(self) -> None:
+    self.cancelled = True
+
+  def join(self, timeout: float) -> None:
+    if self._thread.is_alive():
+      self._thread.join(timeout)
+
+  def _run(self) -> None:
+    pending: Deque[BatchCase] = deque(case for case in self.cases if case.status == PENDING)
+    running: Dict[str, tuple] = {
+      case.job_id: (case, self._attached[case.job_id]) for case in self.cases if case.job_id in self._attached
+    }
+    stopping = False
+    while running or (pending and not stopping):
+      while pending and len(running) < self.chunk:
+        if self.cancelled:
+          for case in pending:
+            case.status = SKIPPED
+          pending.clear()
+          break
+        if self._should_stop():
+          # Draining: the rest stays pending and is saved with the batch for the next process.
+          stopping = True
+          break
+        case = pending.popleft()
+        try:
+          job = self._start_case(case)
+        except Exception as exc:
+          case.status, case.error, case.finished_at = FAILED, getattr(exc, "detail", None) or str(exc), time.time()
+          continue
+        case.status, case.job_id, case.submitted_at = QUEUED, job.job_id, time.time()
+        running[job.job_id] = (case, job)
+      if not running:
+        continue
+      # Waiting on the oldest job bounds the poll; every finished job is collected each round.
+      next(iter(running.values()))[1].wait(1.0)
+      for job_id, (case, job) in list(running.items()):
+        if not job.done.is_set():
+          case.status = job.status
+          continue
+        del running[job_id]
+        case.finished_at = time.time()
+        case.content_hash = job.content_hash
+        case.status = job.status
+        if job.status == DONE:
+          try:
+            self._finish_case(case, job)
+          except Exception as exc:
+            case.status, case.error = FAILED, f"Storing the result failed: {exc}"
+        else:
+          case.error = job.error if job.status == FAILED else "Server restarted; the job resumes on the next start"
+      self._checkpoint()
+    if pending or any(case.status == PERSISTED for case in self.cases):
+      self.suspended = True
+      self._checkpoint(force=True)
+      print(f"[batch] {self.batch_id} suspended for the restart: {self.counts()}", flush=True)
+      return
+    self.extra.update(self._finish_batch(self) or {})
+    self.finished_at = time.time()
+    self._checkpoint(force=True)
+    print(f"[batch] {self.batch_id} finished: {self.counts()}", flush=True)
+
+  def _checkpoint(self, force: bool = False) -> None:
+    if not force and time.time() - self._checkpointed < CHECKPOINT_SECONDS:
+      return
+    self._checkpointed = time.time()
+    self.index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = self.index_path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(self.index(), indent=2))
+    tmp.replace(self.index_path)
+
+  def counts(self) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    for case in self.cases:
+      counts[case.status] = counts.get(case.status, 0) + 1
+    return counts
+
+  def describe(self) -> Dict[str, Any]:
+    finished = [c for c in self.cases if c.finished_at and c.status == DONE]
+    elapsed = (self.finished_at or time.time()) - self.created_at
+    remaining = sum(1 for c in self.cases if c.status not in (DONE, FAILED, SKIPPED, PERSISTED))
+    rate = len(finished) / elapsed if finished and elapsed > 0 else None
+    return {
+      "batch_id": self.batch_id,
+      "client": self.client,
+      "params": self.params,
+      "total": len(self.cases),
+      "counts": self.counts(),
+      "chunk": self.chunk,
+      "created_at": self.created_at,
+      "finished_at": self.finished_at,
+      "cancelled": self.cancelled,
+      "suspended": self.suspended,
+      "cases_per_hour": round(rate * 3600, 1) if rate else None,
+      "eta_seconds": round(remaining / rate, 1) if rate and not self.finished_at else None,
+      **self.extra,
+    }
+
+  def index(self) -> Dict[str, Any]:
+    return {**self.describe(), "cases": [asdict(case) for case in self.cases]}
+
+  def to_record(self) -> Dict[str, Any]:
+    """What a drain persists so the next process can carry on with the batch."""
+    return {
+      "batch_id": self.batch_id,
+      "client": self.client,
+      "params": self.params,
+      "options": self.options,
+      "chunk": self.chunk,
+      "created_at": self.created_at,
+      "extra": self.extra,
+      "cases": [asdict(case) for case in self.cases],
+    }
+
+  @classmethod
+  def from_record(cls, record: Dict[str, Any], jobs: Dict[str, Job], **callbacks: Any) -> "BatchRun":
+    """
+    Rebuilds a saved batch around the jobs restored with it (see drain.restore_jobs). Cases whose job
+    did not come back (its input was gone) fail; cases never submitted are queued as before.
+    """
+    cases = [BatchCase(**case) for case in record["cases"]]
+    attached = {}
+    for case in cases:
+      if case.job_id in jobs:
+        case.status, case.error, case.finished_at = QUEUED, None, None
+        attached[case.job_id] = jobs[case.job_id]
+      elif case.status not in (PENDING, DONE, FAILED, SKIPPED):
+        case.status, case.error, case.finished_at = FAILED, "The job was lost in a restart", time.time()
+    run = cls(record["batch_id"], cases, chunk=record["chunk"], client=record["client"], params=record["params"],
+              options=record.get("options"), attached=attached, **callbacks)
+    run.created_at = record["created_at"]
+    run.extra.update(record.get("extra") or {})
+    return run
+
+
+class BatchRegistry:
+  def __init__(self) -> None:
+    self._runs: Dict[str, BatchRun] = {}
+    self._lock = threading.Lock()
+
+  def add(self, run: BatchRun) -> BatchRun:
+    with self._lock:
+      self._runs[run.batch_id] = run
+    return run.start()
+
+  def get(self, batch_id: str) -> Optional[BatchRun]:
+    with self._lock:
+      return self._runs.get(batch_id)
+
+  def all(self) -> List[BatchRun]:
+    with self._lock:
+      return list(self._runs.values())
+
+  def suspended(self, timeout: float) -> List[BatchRun]:
+    """
+    Batches a drain interrupted, once their threads have collected the last jobs. A batch that does not
+    settle within ``timeout`` is returned as it stands; its unfinished cases fail on restore.
+    """
+    runs = [run for run in self.all() if run.finished_at is None]
+    deadline = time.time() + timeout
+    for run in runs:
+      run.join(max(0.0, deadline - time.time()))
+    return runs
+
+
+@lru_cache
+def get_batch_registry() -> BatchRegistry:
+  return BatchRegistry()
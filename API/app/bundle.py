@@ -0,0 +1,349 @@
+"""
+Batch bundles (.zip or .tar[.gz]) unpacked while they upload: members are written under their case
+folder as they arrive, and each case is handed back as soon as the archive moves on to the next one.
+"""
+import asyncio
+import io
+import struct
+import tarfile
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+from typing import AsyncIterator, Callable, Deque, Generator, Iterator, Optional, Tuple
+
+from .ingest import BLOCK_BYTES, MAX_IN_FLIGHT
+from .validation import InputRejected
+
+ZIP_LOCAL = b"PK\x03\x04"
+ZIP_DESCRIPTOR = b"PK\x07\x08"
+# Central directory, end of central directory and their zip64 forms: no more members follow.
+ZIP_TRAILERS = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06", b"PK\x06\x07")
+SKIPPED_PARTS = ("__MACOSX",)
+
+
+class BundleError(ValueError):
+  pass
+
+
+@dataclass
+class BundleCase:
+  case_id: str
+  folder: Path
+
+
+class ChunkReader(io.RawIOBase):
+  """Blocking file object over chunks pushed from the event loop, holding at most ``limit`` bytes."""
+
+  def __init__(self, limit: int = BLOCK_BYTES * MAX_IN_FLIGHT) -> None:
+    super().__init__()
+    self._chunks: Deque[memoryview] = deque()
+    self._buffered = 0
+    self._limit = limit
+    self._ended = False
+    self._aborted = False
+    self._cond = threading.Condition()
+
+  def readable(self) -> bool:
+    return True
+
+  def put(self, chunk: bytes) -> None:
+    with self._cond:
+      while self._buffered >= self._limit and not self._aborted:
+        self._cond.wait()
+      if not self._aborted:
+        self._chunks.append(memoryview(chunk))
+        self._buffered += len(chunk)
+        self._cond.notify_all()
+
+  def end(self) -> None:
+    with self._cond:
+      self._ended = True
+      self._cond.notify_all()
+
+  def abort(self) -> None:
+    with self._cond:
+      self._aborted = True
+      self._cond.notify_all()
+
+  def readinto(self, buffer) -> int:
+    with self._cond:
+      while not self._chunks and not self._ended and not self._aborted:
+        self._cond.wait()
+      if self._aborted:
+        raise BundleError("Upload was interrupted")
+      if not self._chunks:
+        return 0
+      chunk = self._chunks[0]
+      count = min(len(buffer), len(chunk))
+      buffer[:count] = chunk[:count]
+      if count == len(chunk):
+        self._chunks.popleft()
+      else:
+        self._chunks[0] = chunk[count:]
+      self._buffered -= count
+      self._cond.notify_all()
+      return count
+
+
+class _Pushback:
+  """Reader that can put back bytes read past the end of a deflate stream."""
+
+  def __init__(self, raw) -> None:
+    self._raw = raw
+    self._pending = b""
+
+  def read(self, size: int) -> bytes:
+    if self._pending:
+      data, self._pending = self._pending[:size], self._pending[size:]
+      return data
+    return self._raw.read(size)
+
+  def unread(self, data: bytes) -> None:
+    self._pending = data + self._pending
+
+  def read_exact(self, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+      more = self.read(size - len(data))
+      if not more:
+        raise BundleError("Archive ends in the middle of a member")
+      data += more
+    return data
+
+
+def _zip64_sizes(extra: bytes, usize: int, csize: int) -> Tuple[int, int, bool]:
+  offset = 0
+  while offset + 4 <= len(extra):
+    tag, length = struct.unpack_from("<HH", extra, offset)
+    if tag == 0x0001:
+      fields = extra[offset + 4: offset + 4 + length]
+      values = list(struct.unpack_from(f"<{len(fields) // 8}Q", fields))
+      if usize == 0xFFFFFFFF and values:
+        usize = values.pop(0)
+      if csize == 0xFFFFFFFF and values:
+        csize = values.pop(0)
+      return usize, csize, True
+    offset += 4 + length
+  return usize, csize, False
+
+
+def _stored_until_descriptor(stream: _Pushback, zip64: bool) -> Generator[bytes, None, int]:
+  """
+  Data of a stored member whose size only follows it, in the data descriptor. Each ``PK\x07\x08``
+  is taken as the end only if the CRC and sizes after it match the bytes before it, since the
+  signature can also occur inside the data. Returns the CRC.
+  """
+  size_format = "<QQ" if zip64 else "<II"
+  descriptor_len = 8 + struct.calcsize(size_format)
+  buffer = bytearray()
+  emitted = 0
+  crc = 0
+  search_from = 0
+  ended = False
+  while True:
+    found = buffer.find(ZIP_DESCRIPTOR, search_from)
+    if found >= 0 and len(buffer) >= found + descriptor_len:
+      (stored_crc,) = struct.unpack_from("<I", buffer, found + 4)
+      csize, usize = struct.unpack_from(size_format, buffer, found + 8)
+      data_crc = zlib.crc32(buffer[:found], crc)
+      if csize == usize == emitted + found and stored_crc == data_crc:
+        if found:
+          yield bytes(buffer[:found])
+        stream.unread(bytes(buffer[found + descriptor_len:]))
+        return data_crc
+      search_from = found + 1
+      continue
+    if found < 0 and len(buffer) > BLOCK_BYTES:
+      # No signature starts before the last three bytes, so everything up to them is member data.
+      keep = len(buffer) - 3
+      crc = zlib.crc32(buffer[:keep], crc)
+      emitted += keep
+      yield bytes(buffer[:keep])
+      del buffer[:keep]
+      search_from = 0
+    if ended:
+      raise BundleError("Archive ends in the middle of a member")
+    data = stream.read(BLOCK_BYTES)
+    if data:
+      buffer += data
+    else:
+      ended = True
+
+
+def _zip_member_data(stream: _Pushback, flags: int, method: int, csize: int, crc: int,
+                     zip64: bool) -> Iterator[bytes]:
+  described = bool(flags & 0x08)
+  actual_crc = 0
+  if method == 0 and described:
+    # Written by streaming zip writers (StreamingZip included) that cannot seek back to the header.
+    crc = actual_crc = yield from _stored_until_descriptor(stream, zip64)
+    described = False
+  elif method == 0:
+    remaining = csize
+    while remaining:
+      data = stream.read(min(remaining, BLOCK_BYTES))
+      if not data:
+        raise BundleError("Archive ends in the middle of a member")
+      remaining -= len(data)
+      actual_crc = zlib.crc32(data, actual_crc)
+      yield data
+  else:
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    remaining = None if described else csize
+    while not inflater.eof:
+      data = stream.read(BLOCK_BYTES if remaining is None else min(remaining, BLOCK_BYTES))
+      if not data:
+        raise BundleError("Archive ends in the middle of a member")
+      if remaining is not None:
+        remaining -= len(data)
+      out = inflater.decompress(data)
+      if out:
+        actual_crc = zlib.crc32(out, actual_crc)
+        yield out
+    if inflater.unused_data:
+      stream.unread(inflater.unused_data)
+  if described:
+    head = stream.read_exact(4)
+    if head == ZIP_DESCRIPTOR:
+      head = stream.read_exact(4)
+    crc = struct.unpack("<I", head)[0]
+    stream.read_exact(16 if zip64 else 8)
+  if actual_crc != crc:
+    raise BundleError("Archive member failed its CRC check")
+
+
+def _zip_members(stream: _Pushback) -> Iterator[Tuple[str, Iterator[bytes]]]:
+  """Walks local file headers in order; the central directory at the end is never needed."""
+  while True:
+    signature = stream.read(4)
+    if not signature or signature in ZIP_TRAILERS:
+      return
+    if signature != ZIP_LOCAL:
+      raise BundleError("Corrupt zip archive")
+    _, flags, method, _, _, crc, csize, usize, name_len, extra_len = struct.unpack("<HHHHHIIIHH", stream.read_exact(26))
+    name = stream.read_exact(name_len).decode("utf-8" if flags & 0x800 else "cp437")
+    usize, csize, zip64 = _zip64_sizes(stream.read_exact(extra_len), usize, csize)
+    if flags & 0x01:
+      raise BundleError(f"Encrypted member {name}")
+    if method not in (0, 8):
+      raise BundleError(f"Member {name} uses unsupported compression method {method}")
+    yield name, _zip_member_data(stream, flags, method, csize, crc, zip64)
+
+
+def _tar_members(stream) -> Iterator[Tuple[str, Iterator[bytes]]]:
+  try:
+    archive = tarfile.open(fileobj=stream, mode="r|*")
+  except tarfile.ReadError as exc:
+    raise BundleError("Unsupported archive type; provide .zip or .tar.gz") from exc
+  with archive:
+    for member in archive:
+      if not member.isfile():
+        continue
+      source = archive.extractfile(member)
+      yield member.name, iter(lambda: source.read(BLOCK_BYTES), b"")
+
+
+def _case_path(name: str) -> Optional[Tuple[str, ...]]:
+  parts = PurePosixPath(name.replace("\\", "/")).parts
+  if not parts or parts[0] == "/" or ".." in parts:
+    raise BundleError(f"Archive member {name} points outside the bundle")
+  if len(parts) < 2 or any(part in SKIPPED_PARTS or part.startswith(".") for part in parts):
+    return None
+  return parts
+
+
+def extract_cases(source, dest: Path, emit: Callable[[BundleCase], None], *, max_cases: int,
+                  max_bytes: int) -> int:
+  """
+  Unpacks the bundle read from ``source`` into ``dest/<case>/...``; ``emit`` gets each case once the
+  archive has moved past it. A case's files must be contiguous, which tar and zip tools produce.
+  Raises InputRejected ("too_large") once the members expand beyond ``max_bytes`` in total.
+  """
+  stream = _Pushback(source)
+  magic = stream.read(4)
+  if len(magic) < 4:
+    raise BundleError("Bundle is empty")
+  stream.unread(magic)
+  members = _zip_members(stream) if magic == ZIP_LOCAL else _tar_members(stream)
+  current: Optional[str] = None
+  seen = set()
+  total = 0
+
+  def counted(data: Iterator[bytes]) -> Iterator[bytes]:
+    nonlocal total
+    for block in data:
+      total += len(block)
+      if total > max_bytes:
+        raise InputRejected("too_large", f"Bundle expands beyond {max_bytes} bytes")
+      yield block
+
+  for name, data in members:
+    parts = _case_path(name)
+    data = counted(data)
+    if parts is None:
+      for _ in data:
+        pass
+      continue
+    if parts[0] != current:
+      if current is not None:
+        emit(BundleCase(current, dest / current))
+      if parts[0] in seen:
+        raise BundleError(f"Files of case {parts[0]} are not together in the archive")
+      seen.add(parts[0])
+      if len(seen) > max_cases:
+        raise BundleError(f"Too many cases (>{max_cases})")
+      current = parts[0]
+    target = dest.joinpath(*parts)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with target.open("wb") as out:
+      for block in data:
+        out.write(block)
+  if current is not None:
+    emit(BundleCase(current, dest / current))
+  return len(seen)
+
+
+async def stream_bundle(chunks: AsyncIterator[bytes], dest: Path, *, max_cases: int,
+                        max_bytes: int) -> AsyncIterator[BundleCase]:
+  """Yields cases while later ones are still uploading; extraction runs on one worker thread."""
+  loop = asyncio.get_running_loop()
+  reader = ChunkReader()
+  cases: asyncio.Queue = asyncio.Queue()
+
+  def emit(case: BundleCase) -> None:
+    loop.call_soon_threadsafe(cases.put_nowait, case)
+
+  def extract() -> None:
+    try:
+      extract_cases(io.BufferedReader(reader, BLOCK_BYTES), dest, emit, max_cases=max_cases, max_bytes=max_bytes)
+    finally:
+      loop.call_soon_threadsafe(cases.put_nowait, None)
+
+  async def feed() -> None:
+    try:
+      async for chunk in chunks:
+        await loop.run_in_executor(feeder, reader.put, chunk)
+    finally:
+      reader.end()
+
+  with ThreadPoolExecutor(max_workers=1, thread_name_prefix="hpb-bundle") as pool, \
+       ThreadPoolExecutor(max_workers=1, thread_name_prefix="hpb-bundle-feed") as feeder:
+    feeding = asyncio.ensure_future(feed())
+    extraction = loop.run_in_executor(pool, extract)
+    # When the upload itself failed, that error is raised and the extractor's is only a consequence.
+    extraction.add_done_callback(lambda future: future.cancelled() or future.exception())
+    try:
+      while (case := await cases.get()) is not None:
+        yield case
+      if feeding.done() and not feeding.cancelled() and feeding.exception() is not None:
+        raise feeding.exception()  # e.g. no bundle field; the extractor only saw an empty stream
+      await extraction
+      # The rest (a zip's central directory) is read and dropped so the multipart form is checked to the end.
+      reader.abort()
+      await feeding
+    finally:
+      reader.abort()
+      feeding.cancel()
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .config import get_settings
+from .utils import link_or_copy
+from .volumes import nifti_suffix, with_nifti_suffix
+
+CACHED_SUFFIXES = (".nii.gz", ".nii")
+
+
+class ResultCache:
+  """Node-local cache of stage outputs keyed by input content hash, stage and parameters."""
+
+  def __init__(self, root: Path, max_bytes: int) -> None:
+    self.root = root
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    self.root.mkdir(parents=True, exist_ok=True)
+
+  @staticmethod
+  def key(content_hash: str, stage: str, params: Dict[str, Any]) -> str:
+    blob = json.dumps({"input": content_hash, "stage": stage, "params": params}, sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+  def _path(self, key: str, suffix: str = ".nii.gz") -> Path:
+    return self.root / key[:2] / f"{key}{suffix}"
+
+  def get(self, key: str) -> Optional[Path]:
+    with self._lock:
+      # Intermediate stage outputs are kept as plain .nii (see volumes.py), final artifacts as .nii.gz.
+      for suffix in CACHED_SUFFIXES:
+        path = self._path(key, suffix)
+        if path.exists():
+          os.utime(path)
+          self.hits += 1
+          return path
+      self.misses += 1
+      return None
+
+  def put(self, key: str, source: Path) -> Path:
+    path = self._path(key, nifti_suffix(source))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{key}.tmp")
+    link_or_copy(source, tmp)
+    os.replace(tmp, path)
+    self._evict()
+    return path
+
+  def _evict(self) -> None:
+    with self._lock:
+      entries = [(p.stat().st_mtime, p.stat().st_size, p)
+                 for suffix in CACHED_SUFFIXES for p in self.root.glob(f"*/*{suffix}")]
+      total = sum(size for _, size, _ in entries)
+      for _, size, path in sorted(entries):
+        if total <= self.max_bytes:
+          break
+        path.unlink(missing_ok=True)
+        total -= size
+
+  def stats(self) -> Dict[str, Any]:
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+      }
+
+  def fetch_or_run(self, content_hash: Optional[str], stage: str, params: Dict[str, Any],
+                   target: Path, produce: Callable[[], Path]) -> Tuple[Path, bool]:
+    """
+    Links a cached stage output to ``target`` (with the cached file's .nii/.nii.gz suffix) or runs
+    ``produce`` and caches its output. Returns (path, hit).
+    """
+    if not content_hash:
+      return produce(), False
+    key = self.key(content_hash, stage, params)
+    cached = self.get(key)
+    if cached is not None:
+      target.parent.mkdir(parents=True, exist_ok=True)
+      return link_or_copy(cached, with_nifti_suffix(target, nifti_suffix(cached))), True
+    output = produce()
+    self.put(key, output)
+    return output, False
+
+
+@lru_cache
+def get_result_cache() -> ResultCache:
+  settings = get_settings()
+  return ResultCache(settings.cache_root, int(settings.cache_max_gb * 1024 ** 3))
@@ -0,0 +1,193 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+from fastapi import Header, HTTPException
+
+from .config import get_settings
+from .jobs import DONE, QUEUED, RUNNING, Job, get_job_queue
+from .metrics import CLIENT_COMPUTE, CLIENT_THROTTLED
+
+ANONYMOUS = "anonymous"
+
+
+def parse_pairs(raw: Optional[str]) -> Dict[str, str]:
+  """Parses ``a=1,b=2`` style settings."""
+  pairs: Dict[str, str] = {}
+  for item in (raw or "").split(","):
+    key, sep, value = item.strip().partition("=")
+    if sep and key.strip():
+      pairs[key.strip()] = value.strip()
+  return pairs
+
+
+class TokenBucket:
+  """
+  Compute-second budget. Requests are admitted while the balance is positive and the
+  job's cost is then debited, so a large batch may leave the client in debt until it refills.
+  """
+
+  def __init__(self, rate: float, burst: float) -> None:
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = time.time()
+
+  def refill(self) -> float:
+    now = time.time()
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    return self.tokens
+
+  def take(self, amount: float) -> None:
+    self.refill()
+    self.tokens -= amount
+
+  def retry_after(self) -> float:
+    deficit = -self.refill()
+    return max(1.0, deficit / self.rate) if self.rate > 0 else 60.0
+
+
+@dataclass
+class ClientAccount:
+  name: str
+  weight: float
+  bucket: TokenBucket
+  submitted: int = 0
+  completed: int = 0
+  failed: int = 0
+  throttled: int = 0
+  charged_seconds: float = 0.0
+  compute_seconds: float = 0.0
+  last_seen: float = field(default_factory=time.time)
+
+
+class ClientRegistry:
+  """Per-client compute-second accounting behind the fair-share limits."""
+
+  def __init__(self, *, rate: float, burst: float, weights: Dict[str, float], api_keys: Dict[str, str]) -> None:
+    self.rate = rate
+    self.burst = burst
+    self.weights = weights
+    self.api_keys = api_keys
+    self._accounts: Dict[str, ClientAccount] = {}
+    self._lock = threading.Lock()
+
+  def _account(self, name: str) -> ClientAccount:
+    account = self._accounts.get(name)
+    if account is None:
+      weight = self.weights.get(name, 1.0)
+      account = ClientAccount(name=name, weight=weight, bucket=TokenBucket(self.rate * weight, self.burst * weight))
+      self._accounts[name] = account
+    return account
+
+  def identify(self, api_key: Optional[str], client_id: Optional[str]) -> str:
+    if self.api_keys:
+      if api_key not in self.api_keys:
+        raise KeyError("unknown API key")
+      return self.api_keys[api_key]
+    return (client_id or ANONYMOUS).strip()[:64] or ANONYMOUS
+
+  def weight(self, name: str) -> float:
+    with self._lock:
+      return self._account(name).weight
+
+  def set_weight(self, name: str, weight: float) -> None:
+    with self._lock:
+      account = self._account(name)
+      scale = weight / account.weight
+      account.weight = weight
+      self.weights[name] = weight
+      account.bucket.rate *= scale
+      account.bucket.burst *= scale
+
+  def throttle(self, name: str) -> Optional[float]:
+    """Seconds the client must wait, or None when it may submit now."""
+    if self.rate <= 0:
+      return None
+    with self._lock:
+      account = self._account(name)
+      account.last_seen = time.time()
+      if account.bucket.refill() > 0:
+        return None
+      account.throttled += 1
+      retry = account.bucket.retry_after()
+    CLIENT_THROTTLED.inc(client=name)
+    return retry
+
+  def charge(self, name: str, seconds: float) -> None:
+    with self._lock:
+      account = self._account(name)
+      account.submitted += 1
+      account.charged_seconds += seconds
+      account.bucket.take(seconds)
+
+  def settle(self, job: Job) -> None:
+    """
+    Queue listener: replaces the predicted charge with the compute the job actually used. A failed
+    or rejected job reports no stages, so its prediction is refunded.
+    """
+    used = sum(float(s["seconds"]) for s in job.metadata.get("stages", []) if not s.get("cached"))
+    with self._lock:
+      account = self._account(job.client)
+      if job.status == DONE:
+        account.completed += 1
+      else:
+        account.failed += 1
+      account.compute_seconds += used
+      account.charged_seconds += used - job.cost_seconds
+      account.bucket.take(used - job.cost_seconds)
+    CLIENT_COMPUTE.inc(used, client=job.client)
+
+  def snapshot(self) -> Dict[str, Any]:
+    queued: Dict[str, int] = {}
+    running: Dict[str, int] = {}
+    for job in get_job_queue().snapshot():
+      counts = running if job.status == RUNNING else queued if job.status == QUEUED else {}
+      counts[job.client] = counts.get(job.client, 0) + 1
+    with self._lock:
+      clients = []
+      for name, account in sorted(self._accounts.items()):
+        clients.append({
+          "client": name,
+          "weight": account.weight,
+          "tokens": round(account.bucket.refill(), 1),
+          "rate": account.bucket.rate,
+          "burst": account.bucket.burst,
+          "queued": queued.get(name, 0),
+          "running": running.get(name, 0),
+          "submitted": account.submitted,
+          "completed": account.completed,
+          "failed": account.failed,
+          "throttled": account.throttled,
+          "charged_seconds": round(account.charged_seconds, 1),
+          "compute_seconds": round(account.compute_seconds, 1),
+          "last_seen": account.last_seen,
+        })
+    return {"rate": self.rate, "burst": self.burst, "clients": clients}
+
+
+@lru_cache
+def get_client_registry() -> ClientRegistry:
+  settings = get_settings()
+  registry = ClientRegistry(
+    rate=settings.client_rate,
+    burst=settings.client_burst,
+    weights={name: float(w) for name, w in parse_pairs(settings.client_weights).items()},
+    api_keys=parse_pairs(settings.api_keys),
+  )
+  get_job_queue().add_listener(registry.settle)
+  return registry
+
+
+def resolve_client(
+  x_api_key: Optional[str] = Header(default=None),
+  x_client_id: Optional[str] = Header(default=None),
+) -> str:
+  """FastAPI dependency naming the client a request is accounted to."""
+  try:
+    return get_client_registry().identify(x_api_key, x_client_id)
+  except KeyError as exc:
+    raise HTTPException(status_code=401, detail="Missing or unknown X-API-Key") from exc
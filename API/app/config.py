@@ -1,3 +1,4 @@
+import os
 from functools import lru_cache
 from pathlib import Path
 from typing import Optional
@@ -12,7 +13,73 @@ class Settings(BaseModel):
   keep_intermediate: bool = Field(default=False, alias="HPB_KEEP_INTERMEDIATE")
   aws_region: str = Field(default="us-east-1", alias="AWS_REGION")
   s3_bucket: Optional[str] = Field(default=None, alias="HPB_S3_BUCKET")
+  # s3:// inputs: readable buckets (default: HPB_S3_BUCKET), endpoint override for MinIO/moto,
+  # and the part size and parallelism of ranged downloads.
+  s3_input_buckets: Optional[str] = Field(default=None, alias="HPB_S3_INPUT_BUCKETS")
+  s3_endpoint: Optional[str] = Field(default=None, alias="HPB_S3_ENDPOINT")
+  s3_part_mb: float = Field(default=8.0, alias="HPB_S3_PART_MB")
+  s3_concurrency: int = Field(default=8, alias="HPB_S3_CONCURRENCY")
+  # publish=true uploads result packages to HPB_S3_BUCKET under <prefix>/<case>/segmentations/.
+  s3_result_prefix: str = Field(default="liverCases", alias="HPB_S3_RESULT_PREFIX")
+  # Resumable uploads (POST /uploads, tus protocol): size limit and how long an unfinished upload is kept.
+  upload_max_gb: float = Field(default=4.0, alias="HPB_UPLOAD_MAX_GB")
+  upload_ttl_hours: float = Field(default=24.0, alias="HPB_UPLOAD_TTL_HOURS")
+  # Finished results kept for re-download from /results/{id}/{artifact}; HPB_RESULT_MAX_GB=0 disables.
+  result_root: Path = Field(default=Path("/tmp/hpb_results"), alias="HPB_RESULT_ROOT")
+  result_max_gb: float = Field(default=10.0, alias="HPB_RESULT_MAX_GB")
+  result_ttl_hours: float = Field(default=24.0, alias="HPB_RESULT_TTL_HOURS")
+  # Job scratch (see scratch.py): stage work directories live in RAM under HPB_SCRATCH_RAM_ROOT while
+  # HPB_SCRATCH_RAM_GB has room (0 disables), else on disk; per-job and node-wide disk quotas (0 = none).
+  scratch_ram_root: Optional[Path] = Field(default=Path("/dev/shm/hpb"), alias="HPB_SCRATCH_RAM_ROOT")
+  scratch_ram_gb: float = Field(default=4.0, alias="HPB_SCRATCH_RAM_GB")
+  scratch_job_gb: float = Field(default=20.0, alias="HPB_SCRATCH_JOB_GB")
+  scratch_disk_gb: float = Field(default=0.0, alias="HPB_SCRATCH_DISK_GB")
+  # NIfTI outputs are gzipped in independent blocks on this many threads (0 = one per core, up to 16).
+  gzip_level: int = Field(default=6, alias="HPB_GZIP_LEVEL")
+  gzip_threads: int = Field(default=0, alias="HPB_GZIP_THREADS")
   max_batch_cases: int = Field(default=10, alias="HPB_MAX_BATCH")
+  # Total uncompressed size a /segment/batch bundle may expand to.
+  bundle_max_gb: float = Field(default=20.0, alias="HPB_BUNDLE_MAX_GB")
+  # Manifest batches (POST /batches): case limit, cases kept in the job queue at once, and the
+  # directories server-local input paths may point into (comma-separated; none by default).
+  max_manifest_cases: int = Field(default=10000, alias="HPB_MAX_MANIFEST_CASES")
+  batch_chunk: int = Field(default=16, alias="HPB_BATCH_CHUNK")
+  local_input_roots: Optional[str] = Field(default=None, alias="HPB_LOCAL_INPUT_ROOTS")
+  # "standalone" runs jobs on in-process workers; "coordinator" only schedules
+  # them for remote workers started with `python -m app.worker`.
+  mode: str = Field(default="standalone", alias="HPB_MODE")
+  local_workers: int = Field(default=1, alias="HPB_LOCAL_WORKERS")
+  worker_timeout: float = Field(default=30.0, alias="HPB_WORKER_TIMEOUT")
+  coordinator_url: str = Field(default="http://localhost:8080", alias="HPB_COORDINATOR_URL")
+  # Shared secret remote workers send as X-Worker-Token; the /workers node routes refuse all requests without it.
+  worker_token: Optional[str] = Field(default=None, alias="HPB_WORKER_TOKEN")
+  cache_root: Path = Field(default=Path("/tmp/hpb_cache"), alias="HPB_CACHE_ROOT")
+  cache_max_gb: float = Field(default=20.0, alias="HPB_CACHE_MAX_GB")
+  # Bounded-load factor for consistent-hash routing: a node takes at most
+  # ceil(c * average load) jobs before its cases spill to the next node on the ring.
+  routing_load_factor: float = Field(default=1.25, alias="HPB_ROUTING_LOAD_FACTOR")
+  # Let running bulk jobs pause between stages when interactive work is waiting.
+  preempt_bulk: bool = Field(default=True, alias="HPB_PREEMPT_BULK")
+  max_job_memory_gb: float = Field(default=28.0, alias="HPB_MAX_JOB_MEMORY_GB")
+  # Fair share: each client earns ``client_rate`` compute-seconds per second (times its
+  # weight) up to ``client_burst``; 0 disables throttling. Weights and keys are "a=1,b=2" lists.
+  client_rate: float = Field(default=1.0, alias="HPB_CLIENT_RATE")
+  client_burst: float = Field(default=3600.0, alias="HPB_CLIENT_BURST")
+  client_weights: Optional[str] = Field(default=None, alias="HPB_CLIENT_WEIGHTS")
+  api_keys: Optional[str] = Field(default=None, alias="HPB_API_KEYS")
+  admin_token: Optional[str] = Field(default=None, alias="HPB_ADMIN_TOKEN")
+  # Drain: how long running stages may take to finish before their jobs are saved anyway,
+  # and where queued jobs are saved (defaults to <HPB_IN_ROOT>/queue_state.json).
+  drain_grace_seconds: float = Field(default=120.0, alias="HPB_DRAIN_GRACE")
+  queue_state: Optional[Path] = Field(default=None, alias="HPB_QUEUE_STATE")
+  # Run Task008 in-process against models kept resident (see models.py) instead of nnUNet_predict.
+  resident_models: bool = Field(default=False, alias="HPB_RESIDENT_MODELS")
+  resident_budget_gb: float = Field(default=8.0, alias="HPB_MODEL_BUDGET_GB")
+  # Input validation (see validation.py): size limit, minimum slice count, and whether a voxel
+  # sample must look like CT in Hounsfield units.
+  max_voxels: int = Field(default=512 * 512 * 2048, alias="HPB_MAX_VOXELS")
+  min_slices: int = Field(default=16, alias="HPB_MIN_SLICES")
+  check_hu: bool = Field(default=True, alias="HPB_CHECK_HU")
 
   class Config:
     populate_by_name = True
@@ -21,7 +88,7 @@ class Settings(BaseModel):
 
 @lru_cache
 def get_settings() -> Settings:
-  settings = Settings()
+  settings = Settings.model_validate(dict(os.environ))
   settings.in_root.mkdir(parents=True, exist_ok=True)
   settings.out_root.mkdir(parents=True, exist_ok=True)
   return settings
@@ -0,0 +1,131 @@
+import hmac
+import json
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
+from fastapi.responses import FileResponse, JSONResponse
+from pydantic import BaseModel
+
+from .config import get_settings
+from .costmodel import get_cost_model
+from .jobs import RUNNING, Job, get_job_queue, job_scratch
+
+
+def require_worker(x_worker_token: Optional[str] = Header(default=None)) -> None:
+  """Worker routes hand out patients' CTs and accept results, so they are closed unless HPB_WORKER_TOKEN is set."""
+  token = get_settings().worker_token
+  if not token:
+    raise HTTPException(status_code=403, detail="Remote workers are disabled (HPB_WORKER_TOKEN is not set)")
+  if not hmac.compare_digest(x_worker_token or "", token):
+    raise HTTPException(status_code=403, detail="Worker token required")
+
+
+router = APIRouter(prefix="/workers", tags=["workers"])
+# Everything a worker node calls; GET /workers stays an open status page like /jobs/{id}.
+node_router = APIRouter(dependencies=[Depends(require_worker)])
+
+
+class RegisterRequest(BaseModel):
+  name: str
+  capacity: int = 1
+
+
+class FailRequest(BaseModel):
+  error: str
+  rejected: Optional[str] = None
+
+
+def _owned_job(worker_id: str, job_id: str) -> Job:
+  job = get_job_queue().get(job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+  if job.status != RUNNING or job.worker_id != worker_id:
+    raise HTTPException(status_code=409, detail=f"Job {job_id} is not assigned to {worker_id}")
+  return job
+
+
+@router.get("")
+def list_workers() -> JSONResponse:
+  queue = get_job_queue()
+  return JSONResponse({
+    "mode": get_settings().mode,
+    "queue_depth": queue.depth(),
+    "workers": [w.describe() for w in queue.workers()],
+    "cost_model": get_cost_model().snapshot(),
+  })
+
+
+@node_router.post("/register")
+def register_worker(body: RegisterRequest) -> JSONResponse:
+  worker = get_job_queue().register_worker(body.name, capacity=body.capacity)
+  heartbeat = max(1.0, get_settings().worker_timeout / 3)
+  return JSONResponse({"worker_id": worker.worker_id, "heartbeat_seconds": heartbeat})
+
+
+@node_router.post("/{worker_id}/heartbeat")
+def heartbeat(worker_id: str) -> JSONResponse:
+  if not get_job_queue().heartbeat(worker_id):
+    raise HTTPException(status_code=404, detail=f"Unknown worker {worker_id}")
+  return JSONResponse({"ok": True})
+
+
+@node_router.post("/{worker_id}/claim")
+async def claim_job(worker_id: str, wait: float = 20.0):
+  # Long-polls on the event loop; a blocking claim would hold a threadpool thread for up to a minute.
+  queue = get_job_queue()
+  if not queue.is_registered(worker_id):
+    raise HTTPException(status_code=404, detail=f"Unknown worker {worker_id}")
+  job = await queue.claim_async(worker_id, timeout=min(max(wait, 0.0), 60.0))
+  if job is None:
+    return Response(status_code=204)
+  return JSONResponse({
+    "job_id": job.job_id,
+    "kind": job.kind,
+    "case_id": job.case_id,
+    "params": job.params,
+    "input_uri": job.input_uri,
+    "content_hash": job.content_hash,
+  })
+
+
+@node_router.get("/{worker_id}/jobs/{job_id}/input")
+def job_input(worker_id: str, job_id: str) -> FileResponse:
+  job = _owned_job(worker_id, job_id)
+  return FileResponse(job.input_path, media_type="application/gzip")
+
+
+@node_router.put("/{worker_id}/jobs/{job_id}/result")
+async def job_result(worker_id: str, job_id: str, request: Request) -> JSONResponse:
+  job = _owned_job(worker_id, job_id)
+  metadata = json.loads(request.headers.get("x-job-metadata") or "{}")
+  result_path = job_scratch(job_id)["out"] / f"result_{worker_id}"
+  with result_path.open("wb") as f:
+    async for chunk in request.stream():
+      f.write(chunk)
+  # The worker may have been expired while uploading; only the current owner completes the job.
+  _owned_job(worker_id, job_id)
+  get_job_queue().complete(job_id, result_path, metadata)
+  return JSONResponse({"ok": True})
+
+
+@node_router.post("/{worker_id}/jobs/{job_id}/fail")
+def job_failed(worker_id: str, job_id: str, body: FailRequest) -> JSONResponse:
+  _owned_job(worker_id, job_id)
+  get_job_queue().fail(job_id, body.error, rejected=body.rejected)
+  return JSONResponse({"ok": True})
+
+
+@node_router.get("/{worker_id}/jobs/{job_id}/preempt")
+def job_preempt(worker_id: str, job_id: str) -> JSONResponse:
+  _owned_job(worker_id, job_id)
+  return JSONResponse({"preempt": get_job_queue().should_preempt(job_id)})
+
+
+@node_router.post("/{worker_id}/jobs/{job_id}/requeue")
+def job_requeue(worker_id: str, job_id: str) -> JSONResponse:
+  _owned_job(worker_id, job_id)
+  get_job_queue().requeue(job_id, worker_id=worker_id)
+  return JSONResponse({"ok": True})
+
+
+router.include_router(node_router)
@@ -0,0 +1,178 @@
+import json
+import math
+import threading
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .jobs import DONE, Job, get_job_queue
+from .planner import TOTALSEG_PARTS, totalseg_parts
+
+# Header of a typical abdominal CT, used when a job's header could not be read.
+TYPICAL_FEATURES = {"nx": 512, "ny": 512, "nz": 300, "sx": 0.8, "sy": 0.8, "sz": 1.5, "datatype": 4, "bitpix": 16}
+
+# Spacing (mm) each stage resamples to before inference.
+STAGE_SPACING = {
+  ("liver", False): (1.5, 1.5, 1.5),
+  ("liver", True): (3.0, 3.0, 3.0),
+  ("totalseg", False): (1.5, 1.5, 1.5),
+  ("totalseg", True): (3.0, 3.0, 3.0),
+  ("task008", False): (0.8, 0.8, 1.5),
+}
+
+# Fraction of the Task008 grid left after cascade cropping to the liver bounding box.
+CROP_FRACTION = 0.35
+
+# (base seconds, seconds per million stage voxels, base bytes, bytes per stage voxel).
+# Rough g4dn numbers; the model replaces them with fitted values as jobs complete.
+PRIORS = {
+  "liver": (10.0, 3.5, 2.5e9, 150.0),
+  "totalseg": (20.0, 10.0, 3.5e9, 250.0),
+  "task008": (5.0, 0.55, 2.0e9, 60.0),
+}
+
+
+def stage_mvox(stage: str, params: Dict[str, Any], features: Optional[Dict[str, float]]) -> float:
+  """Millions of voxels the stage processes after resampling the input to its working spacing."""
+  f = features or TYPICAL_FEATURES
+  fast = bool(params.get("fast", False)) if stage != "task008" else False
+  target = STAGE_SPACING.get((stage, fast), (1.5, 1.5, 1.5))
+  voxels = 1.0
+  for n, spacing, goal in zip((f["nx"], f["ny"], f["nz"]), (f["sx"], f["sy"], f["sz"]), target):
+    voxels *= max(1, math.ceil(n * spacing / goal))
+  if stage == "task008" and params.get("crop"):
+    voxels *= CROP_FRACTION
+  return voxels / 1e6
+
+
+def stage_multiplier(stage: str, params: Dict[str, Any]) -> float:
+  if stage == "task008":
+    return float(max(1, len(str(params.get("folds", "0")).replace(",", " ").split())))
+  if stage == "totalseg" and params.get("roi_subset") and not params.get("fast"):
+    # Only the 1.5 mm models containing the requested structures run.
+    return len(totalseg_parts(params["roi_subset"])) / len(TOTALSEG_PARTS)
+  return 1.0
+
+
+def prior_seconds(stage: str, params: Dict[str, Any], mvox: float) -> float:
+  base, per_mvox, _, _ = PRIORS.get(stage, (30.0, 2.0, 2e9, 100.0))
+  return (base + per_mvox * mvox) * stage_multiplier(stage, params)
+
+
+def prior_bytes(stage: str, params: Dict[str, Any], mvox: float) -> float:
+  _, _, base, per_voxel = PRIORS.get(stage, (30.0, 2.0, 2e9, 100.0))
+  return base + per_voxel * mvox * 1e6
+
+
+class LinearFit:
+  """Online least squares y = a + b*x with exponential forgetting so the model tracks drift."""
+
+  def __init__(self, decay: float = 0.98) -> None:
+    self.decay = decay
+    self.n = self.sx = self.sy = self.sxx = self.sxy = 0.0
+    self.samples = 0
+
+  def add(self, x: float, y: float) -> None:
+    d = self.decay
+    self.n = self.n * d + 1
+    self.sx = self.sx * d + x
+    self.sy = self.sy * d + y
+    self.sxx = self.sxx * d + x * x
+    self.sxy = self.sxy * d + x * y
+    self.samples += 1
+
+  def predict(self, x: float, prior: Callable[[float], float]) -> float:
+    mean_x, mean_y = self.sx / self.n, self.sy / self.n
+    var = self.sxx / self.n - mean_x ** 2
+    if self.samples >= 3 and var > (0.05 * mean_x) ** 2:
+      slope = (self.sxy / self.n - mean_x * mean_y) / var
+      if slope >= 0:
+        return max(0.0, mean_y + slope * (x - mean_x))
+    # Not enough spread in sizes yet: keep the prior's shape, anchored at the observed mean.
+    return mean_y * prior(x) / max(prior(mean_x), 1e-9)
+
+  def calibration(self, prior: Callable[[float], float]) -> float:
+    return (self.sy / self.n) / max(prior(self.sx / self.n), 1e-9)
+
+
+class CostModel:
+  """
+  Predicts stage runtime and peak memory from the NIfTI header alone. One fit per
+  (stage, parameters); configurations not seen yet use the priors scaled by how the
+  observed ones compare to their priors.
+  """
+
+  def __init__(self) -> None:
+    self._seconds: Dict[str, LinearFit] = {}
+    self._bytes: Dict[str, LinearFit] = {}
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def _key(stage: str, params: Dict[str, Any]) -> str:
+    return json.dumps({"stage": stage, "params": params}, sort_keys=True)
+
+  def observe(self, stage: str, params: Dict[str, Any], features: Optional[Dict[str, float]], *,
+              seconds: float, peak_bytes: int = 0) -> None:
+    key = self._key(stage, params)
+    mvox = stage_mvox(stage, params, features)
+    with self._lock:
+      self._seconds.setdefault(key, LinearFit()).add(mvox, seconds)
+      if peak_bytes:
+        self._bytes.setdefault(key, LinearFit()).add(mvox, float(peak_bytes))
+
+  def observe_job(self, job: Job) -> None:
+    if job.status != DONE:
+      return
+    for record in job.metadata.get("stages", []):
+      if not record.get("cached"):
+        self.observe(
+          record["stage"], record["params"], job.features,
+          seconds=float(record["seconds"]), peak_bytes=int(record.get("peak_rss_bytes") or 0),
+        )
+
+  def _estimate(self, fits: Dict[str, LinearFit], stage: str, params: Dict[str, Any], mvox: float,
+                prior: Callable[[str, Dict[str, Any], float], float]) -> float:
+    fit = fits.get(self._key(stage, params))
+    if fit is not None:
+      return fit.predict(mvox, lambda x: prior(stage, params, x))
+    ratios = []
+    for key, other in fits.items():
+      entry = json.loads(key)
+      if entry["stage"] == stage:
+        ratios.append(other.calibration(lambda x, e=entry: prior(e["stage"], e["params"], x)))
+    return prior(stage, params, mvox) * (sum(ratios) / len(ratios) if ratios else 1.0)
+
+  def predict_stage(self, stage: str, params: Dict[str, Any], features: Optional[Dict[str, float]]) -> Dict[str, float]:
+    mvox = stage_mvox(stage, params, features)
+    with self._lock:
+      seconds = self._estimate(self._seconds, stage, params, mvox, prior_seconds)
+      peak = self._estimate(self._bytes, stage, params, mvox, prior_bytes)
+    return {"seconds": seconds, "peak_bytes": peak, "mvox": mvox}
+
+  def predict(self, plan: List[Tuple[str, Dict[str, Any]]], features: Optional[Dict[str, float]]) -> Dict[str, Any]:
+    stages = [{"stage": stage, "params": params, **self.predict_stage(stage, params, features)} for stage, params in plan]
+    return {
+      "seconds": sum(s["seconds"] for s in stages),
+      "peak_bytes": max((s["peak_bytes"] for s in stages), default=0.0),
+      "stages": stages,
+    }
+
+  def snapshot(self) -> List[Dict[str, Any]]:
+    with self._lock:
+      rows = []
+      for key, fit in sorted(self._seconds.items()):
+        memory = self._bytes.get(key)
+        rows.append({
+          **json.loads(key),
+          "samples": fit.samples,
+          "mean_seconds": round(fit.sy / fit.n, 2),
+          "mean_mvox": round(fit.sx / fit.n, 2),
+          "mean_peak_gb": round(memory.sy / memory.n / 1e9, 2) if memory else None,
+        })
+      return rows
+
+
+@lru_cache
+def get_cost_model() -> CostModel:
+  model = CostModel()
+  get_job_queue().add_listener(model.observe_job)
+  return model
@@ -0,0 +1,265 @@
+"""DICOM series -> NIfTI: slice headers and pixel data are read in parallel and stacked in memory."""
+import os
+import shutil
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from .config import get_settings
+from .ingest import IngestResult, uncompressed_path
+from .nifti import NiftiHeader, read_header
+from .pgzip import compress_file
+from .validation import InputRejected
+
+DECODE_THREADS = min(16, os.cpu_count() or 4)
+MAX_SLICES = 5000
+SERIES_UID = "0020|000e"
+IGNORED_NAMES = {"DICOMDIR"}
+
+# numpy dtype -> NIfTI datatype code, for the header that is checked before any pixel is decoded.
+NIFTI_DATATYPES = {"uint8": 2, "int16": 4, "int32": 8, "float32": 16, "float64": 64, "int8": 256, "uint16": 512, "uint32": 768}
+
+
+class DicomError(InputRejected):
+  def __init__(self, message: str) -> None:
+    super().__init__("malformed", message)
+
+
+@dataclass
+class DicomSlice:
+  path: Path
+  series_uid: str
+  origin: Sequence[float]
+  direction: Sequence[float]
+  spacing: Sequence[float]
+  size: Sequence[int]
+  dtype: str
+  position: float = 0.0
+
+
+@dataclass
+class DicomConversion:
+  header: NiftiHeader
+  series_uid: str
+  slices: int
+  skipped_files: int
+  seconds: float
+  threads: int
+
+  def stage_record(self) -> Dict[str, Any]:
+    """Entry for the job's ``stages`` list; params stay empty so the cost model fits one line per voxel."""
+    return {
+      "stage": "dicom",
+      "params": {},
+      "seconds": round(self.seconds, 3),
+      "peak_rss_bytes": 0,
+      "cached": False,
+      "slices": self.slices,
+      "series_uid": self.series_uid,
+      "threads": self.threads,
+    }
+
+
+def _numpy_dtype(pixel_id: int) -> str:
+  import SimpleITK as sitk
+
+  return sitk.GetArrayViewFromImage(sitk.Image([1, 1], pixel_id)).dtype.name
+
+
+def _read_info(path: Path) -> Optional[DicomSlice]:
+  import SimpleITK as sitk
+
+  reader = sitk.ImageFileReader()
+  reader.SetImageIO("GDCMImageIO")
+  reader.SetFileName(str(path))
+  try:
+    reader.ReadImageInformation()
+  except RuntimeError:
+    return None  # not DICOM, or no pixel data (reports, presentation states)
+  series = reader.GetMetaData(SERIES_UID).strip() if reader.HasMetaDataKey(SERIES_UID) else ""
+  return DicomSlice(
+    path=path,
+    series_uid=series,
+    origin=reader.GetOrigin(),
+    direction=reader.GetDirection(),
+    spacing=reader.GetSpacing(),
+    size=reader.GetSize(),
+    dtype=_numpy_dtype(reader.GetPixelID()),
+  )
+
+
+def _decode_into(volume, index: int, path: Path) -> None:
+  import SimpleITK as sitk
+
+  # GDCM handles the compressed transfer syntaxes (JPEG, JPEG-LS, JPEG 2000, RLE) and applies
+  # Rescale Slope/Intercept, so the pixels come out in Hounsfield units.
+  image = sitk.ReadImage(str(path), imageIO="GDCMImageIO")
+  array = sitk.GetArrayViewFromImage(image)
+  volume[index] = array.reshape(volume.shape[1:])
+
+
+def _select_series(slices: List[DicomSlice]) -> List[DicomSlice]:
+  import numpy as np
+
+  by_series: Dict[str, List[DicomSlice]] = {}
+  for item in slices:
+    by_series.setdefault(item.series_uid, []).append(item)
+  chosen = max(by_series.values(), key=len)
+  if any(len(item.size) < 3 for item in chosen):
+    # A plain 2D image (e.g. a lone slice or secondary capture) carries no slice geometry to stack.
+    raise InputRejected("dimensions", f"DICOM series holds {len(chosen)} 2D image(s), not a 3D CT volume")
+  first = chosen[0]
+  shape = tuple(first.size[:2])
+  if any(tuple(item.size[:2]) != shape for item in chosen):
+    raise DicomError("Slices in the series have different sizes")
+  direction = np.array(first.direction, dtype=float).reshape(3, 3)
+  normal = np.cross(direction[:, 0], direction[:, 1])
+  for item in chosen:
+    item.position = float(np.dot(item.origin, normal))
+  chosen.sort(key=lambda item: item.position)
+  positions = np.array([item.position for item in chosen])
+  if len(chosen) > 1 and np.any(np.diff(positions) < 1e-4):
+    raise DicomError("Series contains slices at the same position (multiple acquisitions or phases)")
+  return chosen
+
+
+def convert_series(files: List[Path], nii_path: Path, gz_path: Path, *,
+                   check_header: Optional[Callable[[NiftiHeader], None]] = None) -> DicomConversion:
+  """
+  Reads all slice headers in parallel, keeps the largest series sorted along the slice normal,
+  checks the resulting volume header, then decodes the slices in parallel into one array.
+  """
+  import numpy as np
+  import SimpleITK as sitk
+
+  started = time.time()
+  with ThreadPoolExecutor(max_workers=DECODE_THREADS, thread_name_prefix="hpb-dicom") as pool:
+    infos = list(pool.map(_read_info, files))
+    slices = [info for info in infos if info is not None]
+    if not slices:
+      raise DicomError("No DICOM images found")
+    series = _select_series(slices)
+    if len(series) == 1 and series[0].size[2] > 1:
+      # Enhanced (multi-frame) CT: one file already holds the whole volume.
+      image = sitk.ReadImage(str(series[0].path), imageIO="GDCMImageIO")
+      return _write(image, nii_path, gz_path, series, len(files), started, check_header)
+
+    cols, rows = series[0].size[:2]
+    positions = [item.position for item in series]
+    dz = float(np.median(np.diff(positions))) if len(series) > 1 else float(series[0].spacing[2] or 1.0)
+    dtype = np.result_type(*{item.dtype for item in series})
+    if dtype == np.float64:
+      dtype = np.dtype(np.float32)
+    header = NiftiHeader(
+      version=1, endian="<", shape=(cols, rows, len(series)),
+      spacing=(float(series[0].spacing[0]), float(series[0].spacing[1]), dz),
+      datatype=NIFTI_DATATYPES.get(dtype.name, 0), bitpix=dtype.itemsize * 8, vox_offset=352,
+      scl_slope=1.0, scl_inter=0.0,
+    )
+    if check_header is not None:
+      check_header(header)
+
+    volume = np.empty((len(series), rows, cols), dtype=dtype)
+    list(pool.map(lambda pair: _decode_into(volume, *pair), enumerate(item.path for item in series)))
+
+  direction = np.array(series[0].direction, dtype=float).reshape(3, 3)
+  direction[:, 2] = np.cross(direction[:, 0], direction[:, 1])
+  image = sitk.GetImageFromArray(volume)
+  image.SetSpacing(header.spacing)
+  image.SetOrigin(tuple(series[0].origin))
+  image.SetDirection(tuple(direction.flatten()))
+  return _write(image, nii_path, gz_path, series, len(files), started, None)
+
+
+def _write(image, nii_path: Path, gz_path: Path, series: List[DicomSlice], files: int, started: float,
+           check_header: Optional[Callable[[NiftiHeader], None]]) -> DicomConversion:
+  import SimpleITK as sitk
+
+  nii_path.parent.mkdir(parents=True, exist_ok=True)
+  # The uncompressed copy is what TotalSegmentator and validation read; nnU-Net v1 needs .nii.gz.
+  sitk.WriteImage(image, str(nii_path))
+  header = read_header(nii_path)
+  if check_header is not None:
+    check_header(header)
+  compress_file(nii_path, gz_path, level=1)
+  return DicomConversion(
+    header=header,
+    series_uid=series[0].series_uid,
+    slices=int(image.GetSize()[2]),
+    skipped_files=files - len(series),
+    seconds=time.time() - started,
+    threads=DECODE_THREADS,
+  )
+
+
+def series_files(folder: Path) -> List[Path]:
+  return sorted(
+    p for p in folder.rglob("*")
+    if p.is_file() and p.name not in IGNORED_NAMES and not p.name.startswith(".") and "__MACOSX" not in p.parts
+  )
+
+
+def extract_zip(zip_path: Path, dest: Path) -> List[Path]:
+  """Extracts members under generated names (no path traversal) after checking count and total size."""
+  settings = get_settings()
+  try:
+    archive = zipfile.ZipFile(zip_path)
+  except zipfile.BadZipFile as exc:
+    raise DicomError(f"Unreadable zip archive: {exc}") from exc
+  with archive:
+    members = [
+      info for info in archive.infolist()
+      if not info.is_dir() and Path(info.filename).name not in IGNORED_NAMES
+      and not Path(info.filename).name.startswith(".") and "__MACOSX" not in info.filename
+    ]
+    if len(members) > MAX_SLICES:
+      raise InputRejected("too_large", f"Archive has {len(members)} files; the limit is {MAX_SLICES}")
+    # Generous bound on the pixel data of an accepted volume plus per-file DICOM headers.
+    limit = settings.max_voxels * 4 + len(members) * 64 * 1024
+    if sum(info.file_size for info in members) > limit:
+      raise InputRejected("too_large", "Archive expands beyond the largest accepted volume")
+    dest.mkdir(parents=True, exist_ok=True)
+    targets = []
+    for index, info in enumerate(members):
+      target = dest / f"{index:05d}.dcm"
+      with archive.open(info) as src, target.open("wb") as out:
+        shutil.copyfileobj(src, out, 1024 * 1024)
+      targets.append(target)
+  return targets
+
+
+def convert_zip(zip_path: Path, gz_path: Path, nii_path: Path, *,
+                check_header: Optional[Callable[[NiftiHeader], None]] = None) -> DicomConversion:
+  work = zip_path.parent / "dicom"
+  try:
+    started = time.time()
+    files = extract_zip(zip_path, work)
+    conversion = convert_series(files, nii_path, gz_path, check_header=check_header)
+    conversion.seconds = time.time() - started
+    return conversion
+  finally:
+    shutil.rmtree(work, ignore_errors=True)
+
+
+def conversion_result(conversion: DicomConversion, params: Dict[str, Any], content_hash: str,
+                      gz_path: Path) -> IngestResult:
+  """Records the conversion as the job's first stage and describes its output like a NIfTI upload."""
+  params["conversion"] = conversion.stage_record()
+  return IngestResult(content_hash=content_hash, compressed_bytes=0, header=conversion.header,
+                      nii_path=uncompressed_path(gz_path), complete=True)
+
+
+def expand_archive(received: IngestResult, gz_path: Path, params: Dict[str, Any], *,
+                   check_header: Optional[Callable[[NiftiHeader], None]] = None) -> IngestResult:
+  """Turns a zip stored at ``gz_path`` by the ingest sink into input.nii(.gz); other inputs pass through."""
+  if not received.archive:
+    return received
+  archive = gz_path.replace(gz_path.with_name("dicom.zip"))
+  try:
+    conversion = convert_zip(archive, gz_path, uncompressed_path(gz_path), check_header=check_header)
+  finally:
+    archive.unlink(missing_ok=True)
+  return conversion_result(conversion, params, received.content_hash, gz_path)
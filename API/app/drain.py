@@ -0,0 +1,183 @@
+"""Graceful drain: stop taking work, let running stages finish, persist the queue for the next process."""
+import json
+import os
+import signal
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from .batches import BatchRun, get_batch_registry
+from .clients import get_client_registry
+from .config import get_settings
+from .jobs import Job, JobQueue, get_job_queue
+
+# How long a drain waits for batch threads to collect their last jobs before saving the batches.
+BATCH_SETTLE_SECONDS = 30.0
+
+
+def state_path() -> Path:
+  settings = get_settings()
+  return settings.queue_state or settings.in_root / "queue_state.json"
+
+
+def batch_state_path() -> Path:
+  return state_path().with_name("batch_state.json")
+
+
+def _save_state(path: Path, key: str, records: List[Dict[str, Any]]) -> None:
+  tmp = path.with_suffix(".tmp")
+  tmp.write_text(json.dumps({"saved_at": time.time(), key: records}, indent=2))
+  os.replace(tmp, path)
+
+
+def _load_state(path: Path, key: str) -> List[Dict[str, Any]]:
+  if not path.exists():
+    return []
+  try:
+    records = json.loads(path.read_text()).get(key, [])
+  except (OSError, ValueError) as exc:
+    print(f"[drain] could not read {path}: {exc}", flush=True)
+    return []
+  path.unlink()
+  return records
+
+
+def save_jobs(path: Path, jobs: List[Job]) -> None:
+  _save_state(path, "jobs", [job.to_record() for job in jobs])
+
+
+def save_batches(path: Path, runs: List[BatchRun]) -> None:
+  _save_state(path, "batches", [run.to_record() for run in runs])
+
+
+def restore_jobs(queue: JobQueue,
+                 resume_batch: Optional[Callable[[Dict[str, Any], Dict[str, Job]], None]] = None) -> List[Job]:
+  """
+  Queues the jobs a previous process persisted while draining, then hands each saved batch to
+  ``resume_batch`` together with the restored jobs so it can pick up its cases again.
+  """
+  clients = get_client_registry()
+  restored = []
+  for record in _load_state(state_path(), "jobs"):
+    job = Job.from_record(record)
+    if not job.input_uri and not job.input_path.exists():
+      print(f"[drain] dropping {job.job_id}: input {job.input_path} is gone", flush=True)
+      continue
+    queue.submit(job, weight=clients.weight(job.client))
+    restored.append(job)
+  if restored:
+    print(f"[drain] restored {len(restored)} job(s) from {state_path()}", flush=True)
+  batches = _load_state(batch_state_path(), "batches")
+  if batches and resume_batch is not None:
+    jobs = {job.job_id: job for job in restored}
+    for record in batches:
+      resume_batch(record, jobs)
+    print(f"[drain] resumed {len(batches)} batch(es) from {batch_state_path()}", flush=True)
+  return restored
+
+
+class Drainer:
+  def __init__(self, queue: JobQueue, grace_seconds: float) -> None:
+    self.queue = queue
+    self.grace_seconds = grace_seconds
+    self.started_at: Optional[float] = None
+    self.finished_at: Optional[float] = None
+    self.reason: Optional[str] = None
+    self.persisted: List[Job] = []
+    self._callbacks: List[Callable[[], None]] = []
+    self._lock = threading.Lock()
+
+  @property
+  def draining(self) -> bool:
+    return self.started_at is not None
+
+  def start(self, reason: str, on_finished: Optional[Callable[[], None]] = None) -> bool:
+    """
+    Begins draining in the background; returns False if a drain is already under way.
+    ``on_finished`` runs once the drain completes, immediately if it already has.
+    """
+    with self._lock:
+      done = self.finished_at is not None
+      if on_finished is not None and not done:
+        self._callbacks.append(on_finished)
+      started = not self.draining
+      if started:
+        self.started_at = time.time()
+        self.reason = reason
+    if done and on_finished is not None:
+      on_finished()
+    if started:
+      print(f"[drain] started ({reason}); grace {self.grace_seconds:.0f}s", flush=True)
+      threading.Thread(target=self._run, name="hpb-drain", daemon=True).start()
+    return started
+
+  def _persist(self, jobs: List[Job]) -> None:
+    self.persisted.extend(jobs)
+    save_jobs(state_path(), self.persisted)
+    # Only wake the waiting requests once the jobs are safely on disk.
+    for job in jobs:
+      job.finish()
+
+  def _run(self) -> None:
+    self.queue.close()
+    deadline = self.started_at + self.grace_seconds
+    while True:
+      # Queued jobs are saved right away; running `both` jobs stop at their next stage boundary
+      # and come back through the queue, so they are picked up here too.
+      taken = self.queue.take_pending()
+      if taken:
+        self._persist(taken)
+      if not self.queue.running() or time.time() >= deadline:
+        break
+      time.sleep(0.5)
+    overdue = self.queue.take_running()
+    if overdue:
+      self._persist(overdue)
+    batches = get_batch_registry().suspended(BATCH_SETTLE_SECONDS)
+    if batches:
+      save_batches(batch_state_path(), batches)
+    with self._lock:
+      self.finished_at = time.time()
+      callbacks, self._callbacks = self._callbacks, []
+    print(f"[drain] finished; {len(self.persisted)} job(s) and {len(batches)} batch(es) saved", flush=True)
+    for callback in callbacks:
+      callback()
+
+  def status(self) -> Dict[str, Any]:
+    return {
+      "draining": self.draining,
+      "reason": self.reason,
+      "started_at": self.started_at,
+      "finished_at": self.finished_at,
+      "grace_seconds": self.grace_seconds,
+      "running": len(self.queue.running()),
+      "persisted": [job.job_id for job in self.persisted],
+    }
+
+
+@lru_cache
+def get_drainer() -> Drainer:
+  return Drainer(get_job_queue(), get_settings().drain_grace_seconds)
+
+
+def install_signal_handlers() -> None:
+  """
+  SIGTERM starts a drain and only hands the signal to the server's own handler once it is done,
+  so the server keeps answering (with 503 for new work) while running stages finish.
+  """
+  if threading.current_thread() is not threading.main_thread():
+    return
+  previous = signal.getsignal(signal.SIGTERM)
+
+  def finish() -> None:
+    if callable(previous):
+      previous(signal.SIGTERM, None)
+    else:
+      os._exit(0)
+
+  def handle(signum, frame) -> None:
+    get_drainer().start("SIGTERM", on_finished=finish)
+
+  signal.signal(signal.SIGTERM, handle)
@@ -0,0 +1,49 @@
+import bisect
+import hashlib
+from typing import Dict, Iterator, List, Tuple
+
+
+def _point(value: str) -> int:
+  return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+  """Consistent-hash ring with virtual nodes; adding or removing a node only moves its own arcs."""
+
+  def __init__(self, replicas: int = 64) -> None:
+    self.replicas = replicas
+    self._points: List[Tuple[int, str]] = []
+    self._nodes: Dict[str, int] = {}
+
+  def __contains__(self, node: str) -> bool:
+    return node in self._nodes
+
+  def __len__(self) -> int:
+    return len(self._nodes)
+
+  def add(self, node: str, weight: int = 1) -> None:
+    if node in self._nodes:
+      self.remove(node)
+    count = self.replicas * max(1, weight)
+    self._nodes[node] = count
+    for index in range(count):
+      bisect.insort(self._points, (_point(f"{node}#{index}"), node))
+
+  def remove(self, node: str) -> None:
+    if self._nodes.pop(node, None) is None:
+      return
+    self._points = [entry for entry in self._points if entry[1] != node]
+
+  def walk(self, key: str) -> Iterator[str]:
+    """Yields each node once, clockwise from ``key``'s position on the ring."""
+    if not self._points:
+      return
+    start = bisect.bisect(self._points, (_point(key), ""))
+    seen = set()
+    for offset in range(len(self._points)):
+      node = self._points[(start + offset) % len(self._points)][1]
+      if node not in seen:
+        seen.add(node)
+        yield node
+        if len(seen) == len(self._nodes):
+          return
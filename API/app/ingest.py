@@ -0,0 +1,332 @@
+"""
+Pipelined CT upload: while the request body arrives, the compressed bytes are stored and hashed,
+gunzipped incrementally, and the NIfTI header and voxel data are written into a preallocated
+uncompressed file, so everything downstream can start as soon as the last byte lands.
+"""
+import asyncio
+import hashlib
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Callable, Deque, List, Optional
+
+from starlette.requests import Request
+
+from .nifti import NIFTI1_HEADER_SIZE, NiftiError, NiftiHeader, parse_header
+
+# Received bytes are handed to the decompression thread in blocks of this size; at most
+# MAX_IN_FLIGHT blocks wait for it before the request stream is back-pressured.
+BLOCK_BYTES = 1024 * 1024
+MAX_IN_FLIGHT = 8
+# Uncompressed volumes claiming more than this are only stored, not expanded.
+MAX_VOLUME_BYTES = 16 * 1024 ** 3
+
+
+@dataclass
+class IngestResult:
+  content_hash: str
+  compressed_bytes: int
+  header: Optional[NiftiHeader]
+  nii_path: Optional[Path]
+  # False when the stream ended before header.vox_offset + header.data_bytes.
+  complete: bool = False
+  # The upload was a zip archive (a DICOM series, see dicom.py) and was stored as received.
+  archive: bool = False
+
+  def volume(self):
+    """Voxel data as a read-only memory map in NIfTI (x, y, z) order."""
+    import numpy as np
+
+    if self.header is None or self.nii_path is None:
+      raise NiftiError("Upload is not a readable NIfTI volume")
+    return np.memmap(
+      self.nii_path, dtype=self.header.dtype, mode="r", offset=self.header.vox_offset,
+      shape=self.header.shape, order="F",
+    )
+
+
+class NiftiSink:
+  """
+  Consumes the upload in order: stores it as received (unless ``gz_path`` is None) and expands it
+  into an uncompressed .nii. With ``check_header`` nothing is written to disk until the header has
+  passed it; a stream that is not NIfTI then raises NiftiError as soon as that is clear.
+  """
+
+  def __init__(self, gz_path: Optional[Path], nii_path: Path, *,
+               check_header: Optional[Callable[[NiftiHeader], None]] = None) -> None:
+    self.gz_path = gz_path
+    self.nii_path = nii_path
+    self._check = check_header
+    self._gz = None
+    self._held: List[bytes] = []
+    self._digest = hashlib.sha256()
+    self._size = 0
+    self._compressed: Optional[bool] = None
+    self._inflater = None
+    self._pending = b""
+    self._head = bytearray()
+    self._nii = None
+    self._written = 0
+    self._expected = 0
+    self._failed = False
+    self.archive = False
+    self.header: Optional[NiftiHeader] = None
+
+  def _store(self, data: bytes) -> None:
+    if self.gz_path is None:
+      return
+    if self._gz is None and (self._check is None or self.header is not None or self.archive):
+      self.gz_path.parent.mkdir(parents=True, exist_ok=True)
+      self._gz = self.gz_path.open("wb")
+      for held in self._held:
+        self._gz.write(held)
+      self._held = []
+    if self._gz is not None:
+      self._gz.write(data)
+    else:
+      self._held.append(data)
+
+  def feed(self, data: bytes) -> None:
+    self._store(data)
+    self._digest.update(data)
+    self._size += len(data)
+    if self._compressed is None:
+      self._pending += data
+      if len(self._pending) < 2:
+        return
+      data, self._pending = self._pending, b""
+      self._compressed = data[:2] == b"\x1f\x8b"
+      if self._compressed:
+        self._inflater = zlib.decompressobj(wbits=31)
+      self.archive = data[:2] == b"PK"
+      if self.archive:
+        self._store(b"")
+    if not self.archive:
+      self._expand(data)
+
+  def _expand(self, data: bytes) -> None:
+    if self._failed:
+      return
+    if not self._compressed:
+      self._consume(data)
+      return
+    while data:
+      try:
+        self._consume(self._inflater.decompress(data))
+      except zlib.error as exc:
+        self._reject(NiftiError(f"Corrupt gzip stream: {exc}"))
+        return
+      if not self._inflater.eof:
+        break
+      # Multi-member gzip (e.g. written in parallel): continue with the next member.
+      data = self._inflater.unused_data
+      self._inflater = zlib.decompressobj(wbits=31)
+
+  def _reject(self, exc: NiftiError) -> None:
+    self._failed = True
+    if self._check is not None:
+      raise exc
+
+  def _consume(self, raw: bytes) -> None:
+    if self._failed or not raw:
+      return
+    if self._nii is not None:
+      self._nii.write(raw)
+      self._written += len(raw)
+      return
+    self._head += raw
+    if len(self._head) < NIFTI1_HEADER_SIZE:
+      return
+    try:
+      header = parse_header(bytes(self._head))
+    except NiftiError as exc:
+      if "NIfTI-2" in str(exc):
+        return  # wait for the rest of the larger header
+      self._reject(exc)
+      return
+    if self._check is not None:
+      self._check(header)
+    total = max(header.vox_offset + header.data_bytes, len(self._head))
+    if total > MAX_VOLUME_BYTES:
+      self._failed = True
+      return
+    self.header = header
+    self._expected = header.vox_offset + header.data_bytes
+    self._store(b"")
+    self.nii_path.parent.mkdir(parents=True, exist_ok=True)
+    self._nii = self.nii_path.open("wb")
+    try:
+      os.posix_fallocate(self._nii.fileno(), 0, total)
+    except (AttributeError, OSError):
+      self._nii.truncate(total)
+    self._nii.write(bytes(self._head))
+    self._written = len(self._head)
+    self._head = bytearray()
+
+  def close(self) -> IngestResult:
+    if self.archive:
+      if self._gz is not None:
+        self._gz.close()
+      return IngestResult(content_hash=self._digest.hexdigest(), compressed_bytes=self._size, header=None,
+                          nii_path=None, archive=True)
+    if self._pending:
+      self._compressed = self._pending[:2] == b"\x1f\x8b"
+      self._consume(self._pending)
+    if self._compressed and self._inflater is not None and not self._failed:
+      self._consume(self._inflater.flush())
+    if self.header is None and not self._failed:
+      try:
+        header = parse_header(bytes(self._head))
+      except NiftiError as exc:
+        self._reject(exc)
+      else:
+        if self._check is not None:
+          self._check(header)
+        self.header = header
+    self._store(b"")
+    if self._gz is not None:
+      self._gz.close()
+    if self._nii is not None:
+      # A short upload must not look complete because of the preallocated tail.
+      self._nii.truncate(self._written)
+      self._nii.close()
+    nii_path = self.nii_path if self._nii is not None and not self._failed else None
+    if nii_path is None:
+      self.nii_path.unlink(missing_ok=True)
+    return IngestResult(
+      content_hash=self._digest.hexdigest(),
+      compressed_bytes=self._size,
+      header=self.header if not self._failed else None,
+      nii_path=nii_path,
+      complete=nii_path is not None and self._written >= self._expected,
+    )
+
+  def flush(self) -> None:
+    """Pushes what was written so far to the OS, e.g. between the chunks of a resumable upload."""
+    for handle in (self._gz, self._nii):
+      if handle is not None:
+        handle.flush()
+
+  def abort(self) -> None:
+    if self._gz is not None:
+      self._gz.close()
+    if self._nii is not None:
+      self._nii.close()
+
+
+def ingest_file(source: Path, nii_path: Path, *,
+                check_header: Optional[Callable[[NiftiHeader], None]] = None) -> IngestResult:
+  """Hashes and expands a CT that is already on disk (e.g. extracted from a batch archive)."""
+  sink = NiftiSink(None, nii_path, check_header=check_header)
+  try:
+    with source.open("rb") as f:
+      while chunk := f.read(BLOCK_BYTES):
+        sink.feed(chunk)
+    return sink.close()
+  except BaseException:
+    sink.abort()
+    raise
+
+
+async def ingest_stream(chunks: AsyncIterator[bytes], gz_path: Path, nii_path: Path, *,
+                        check_header: Optional[Callable[[NiftiHeader], None]] = None) -> IngestResult:
+  """Writes, hashes and decompresses ``chunks`` on one worker thread while more bytes arrive."""
+  sink = NiftiSink(gz_path, nii_path, check_header=check_header)
+  loop = asyncio.get_running_loop()
+  in_flight: Deque[asyncio.Future] = deque()
+  with ThreadPoolExecutor(max_workers=1, thread_name_prefix="hpb-ingest") as pool:
+    try:
+      block = bytearray()
+      async for chunk in chunks:
+        block += chunk
+        if len(block) >= BLOCK_BYTES:
+          in_flight.append(loop.run_in_executor(pool, sink.feed, bytes(block)))
+          block.clear()
+          while len(in_flight) > MAX_IN_FLIGHT:
+            await in_flight.popleft()
+      if block:
+        in_flight.append(loop.run_in_executor(pool, sink.feed, bytes(block)))
+      while in_flight:
+        await in_flight.popleft()
+      return await loop.run_in_executor(pool, sink.close)
+    except BaseException:
+      for future in in_flight:
+        future.cancel()
+      sink.abort()
+      raise
+
+
+async def multipart_file_chunks(request: Request, field: str) -> AsyncIterator[bytes]:
+  """Yields the bytes of one file field of a multipart body as they arrive, without spooling the form."""
+  from multipart.multipart import MultipartParser, parse_options_header
+
+  _, options = parse_options_header(request.headers.get("content-type", ""))
+  boundary = options.get(b"boundary")
+  if not boundary:
+    raise ValueError("Missing boundary in multipart body")
+  found: List[bool] = [False]
+  state = {"field": b"", "headers": b"", "active": False}
+  out: List[bytes] = []
+
+  def on_header_field(data: bytes, start: int, end: int) -> None:
+    state["field"] += data[start:end]
+
+  def on_header_value(data: bytes, start: int, end: int) -> None:
+    if state["field"].lower() == b"content-disposition":
+      state["headers"] += data[start:end]
+
+  def on_header_end() -> None:
+    state["field"] = b""
+
+  def on_headers_finished() -> None:
+    _, disposition = parse_options_header(state["headers"])
+    state["active"] = disposition.get(b"name") == field.encode()
+    found[0] = found[0] or state["active"]
+    state["headers"] = b""
+
+  def on_part_data(data: bytes, start: int, end: int) -> None:
+    if state["active"]:
+      out.append(data[start:end])
+
+  def on_part_end() -> None:
+    state["active"] = False
+
+  parser = MultipartParser(boundary, {
+    "on_header_field": on_header_field,
+    "on_header_value": on_header_value,
+    "on_header_end": on_header_end,
+    "on_headers_finished": on_headers_finished,
+    "on_part_data": on_part_data,
+    "on_part_end": on_part_end,
+  })
+  async for chunk in request.stream():
+    parser.write(chunk)
+    if out:
+      yield b"".join(out)
+      out.clear()
+  parser.finalize()
+  if out:
+    yield b"".join(out)
+  if not found[0]:
+    raise ValueError(f"Missing file field '{field}'")
+
+
+async def ingest_request(request: Request, gz_path: Path, *, field: str = "ct",
+                         check_header: Optional[Callable[[NiftiHeader], None]] = None) -> IngestResult:
+  """
+  Accepts the CT either as the ``field`` part of a multipart form or as the raw request body
+  (e.g. ``Content-Type: application/gzip``). The uncompressed copy is written next to ``gz_path``.
+  """
+  if request.headers.get("content-type", "").startswith("multipart/form-data"):
+    chunks = multipart_file_chunks(request, field)
+  else:
+    chunks = request.stream()
+  return await ingest_stream(chunks, gz_path, uncompressed_path(gz_path), check_header=check_header)
+
+
+def uncompressed_path(gz_path: Path) -> Path:
+  """input.nii.gz -> input.nii"""
+  return gz_path.with_suffix("") if gz_path.suffix == ".gz" else gz_path.with_suffix(".raw.nii")
@@ -0,0 +1,524 @@
+import asyncio
+import math
+import shutil
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from .config import get_settings
+from .hashring import HashRing
+from .metrics import JOBS_TOTAL, PREEMPTIONS, QUEUE_WAIT, REGISTRY, label_key
+from .scratch import get_scratch_manager
+from .utils import uuid4_hex
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# Saved to disk during a drain; the next process resumes it under the same job id.
+PERSISTED = "persisted"
+
+# Lower rank is served first; within a class clients share workers by weighted fair queuing.
+PRIORITIES = ("interactive", "standard", "bulk")
+PRIORITY_RANK = {name: rank for rank, name in enumerate(PRIORITIES)}
+
+
+@dataclass
+class Job:
+  job_id: str
+  kind: str
+  case_id: str
+  input_path: Path
+  params: Dict[str, Any] = field(default_factory=dict)
+  # s3:// URI the worker downloads into ``input_path`` itself (see s3.py).
+  input_uri: Optional[str] = None
+  content_hash: Optional[str] = None
+  features: Optional[Dict[str, float]] = None
+  priority: str = "standard"
+  client: str = "anonymous"
+  cost_seconds: float = 0.0
+  fair_tag: float = 0.0
+  status: str = QUEUED
+  assigned_to: Optional[str] = None
+  worker_id: Optional[str] = None
+  result_path: Optional[Path] = None
+  metadata: Dict[str, Any] = field(default_factory=dict)
+  error: Optional[str] = None
+  submitted_at: float = field(default_factory=time.time)
+  queued_at: float = field(default_factory=time.time)
+  started_at: Optional[float] = None
+  finished_at: Optional[float] = None
+  preemptions: int = 0
+  done: threading.Event = field(default_factory=threading.Event, repr=False)
+  # Event-loop futures of requests awaiting the job (see wait_async); resolved by finish().
+  _waiters: List[Tuple[Any, Any]] = field(default_factory=list, repr=False)
+  _waiters_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+  def wait(self, timeout: Optional[float] = None) -> bool:
+    return self.done.wait(timeout)
+
+  async def wait_async(self) -> None:
+    """Like ``wait`` without holding a threadpool thread for the job's whole runtime."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    with self._waiters_lock:
+      if self.done.is_set():
+        return
+      self._waiters.append((loop, future))
+    try:
+      await future
+    finally:
+      with self._waiters_lock:
+        if (loop, future) in self._waiters:
+          self._waiters.remove((loop, future))
+
+  def finish(self) -> None:
+    """Wakes everything waiting on the job, from any thread."""
+    with self._waiters_lock:
+      self.done.set()
+      waiters, self._waiters = self._waiters, []
+    for loop, future in waiters:
+      try:
+        loop.call_soon_threadsafe(_resolve, future)
+      except RuntimeError:
+        pass  # the request's event loop has already shut down
+
+  def describe(self) -> Dict[str, Any]:
+    return {
+      "job_id": self.job_id,
+      "kind": self.kind,
+      "case_id": self.case_id,
+      "params": self.params,
+      "input_uri": self.input_uri,
+      "content_hash": self.content_hash,
+      "priority": self.priority,
+      "client": self.client,
+      "status": self.status,
+      "assigned_to": self.assigned_to,
+      "worker_id": self.worker_id,
+      "error": self.error,
+      "submitted_at": self.submitted_at,
+      "started_at": self.started_at,
+      "finished_at": self.finished_at,
+      "preemptions": self.preemptions,
+    }
+
+  def to_record(self) -> Dict[str, Any]:
+    """What a drain persists so the next process can queue the job again."""
+    return {
+      "job_id": self.job_id,
+      "kind": self.kind,
+      "case_id": self.case_id,
+      "input_path": str(self.input_path),
+      "input_uri": self.input_uri,
+      "params": self.params,
+      "content_hash": self.content_hash,
+      "features": self.features,
+      "priority": self.priority,
+      "client": self.client,
+      "cost_seconds": self.cost_seconds,
+      "submitted_at": self.submitted_at,
+      "preemptions": self.preemptions,
+    }
+
+  @classmethod
+  def from_record(cls, record: Dict[str, Any]) -> "Job":
+    return cls(**{**record, "input_path": Path(record["input_path"])})
+
+
+def _resolve(future) -> None:
+  if not future.done():
+    future.set_result(None)
+
+
+@dataclass
+class WorkerInfo:
+  worker_id: str
+  name: str
+  capacity: int = 1
+  registered_at: float = field(default_factory=time.time)
+  last_seen: float = field(default_factory=time.time)
+  completed: int = 0
+  failed: int = 0
+  cache_hits: int = 0
+  cache_misses: int = 0
+
+  def describe(self) -> Dict[str, Any]:
+    lookups = self.cache_hits + self.cache_misses
+    return {
+      "worker_id": self.worker_id,
+      "name": self.name,
+      "capacity": self.capacity,
+      "registered_at": self.registered_at,
+      "last_seen": self.last_seen,
+      "completed": self.completed,
+      "failed": self.failed,
+      "cache_hits": self.cache_hits,
+      "cache_misses": self.cache_misses,
+      "cache_hit_rate": round(self.cache_hits / lookups, 3) if lookups else None,
+    }
+
+
+class JobQueue:
+  """
+  Pending jobs shared by the in-process pool and remote workers.
+  Jobs with a content hash are routed to a worker over a consistent-hash ring
+  so repeated inputs land on the node whose result cache already holds them.
+  """
+
+  def __init__(self, load_factor: float = 1.25, preempt_bulk: bool = True) -> None:
+    self._cond = threading.Condition()
+    self._pending: Deque[Job] = deque()
+    self._jobs: Dict[str, Job] = {}
+    self._workers: Dict[str, WorkerInfo] = {}
+    self._ring = HashRing()
+    self._listeners: List[Callable[[Job], None]] = []
+    # Start-time fair queuing: virtual clock and the finish tag of each client's last job.
+    self._virtual_time = 0.0
+    self._client_finish: Dict[str, float] = {}
+    self._closed = False
+    # Event-loop futures of async claims (see claim_async), woken together with the condition.
+    self._claim_waiters: List[Tuple[Any, Any]] = []
+    self.load_factor = load_factor
+    self.preempt_bulk = preempt_bulk
+
+  def _notify(self) -> None:
+    """Wakes blocked and async claims; call with ``_cond`` held."""
+    self._cond.notify_all()
+    waiters, self._claim_waiters = self._claim_waiters, []
+    for loop, future in waiters:
+      try:
+        loop.call_soon_threadsafe(_resolve, future)
+      except RuntimeError:
+        pass
+
+  def _node_loads(self) -> Dict[str, int]:
+    loads = {worker_id: 0 for worker_id in self._workers}
+    for job in self._jobs.values():
+      node = job.worker_id if job.status == RUNNING else job.assigned_to if job.status == QUEUED else None
+      if node in loads:
+        loads[node] += 1
+    return loads
+
+  def _route(self, job: Job) -> Optional[str]:
+    """Bounded-load consistent hashing: first node clockwise from the hash that is below its load cap."""
+    if not job.content_hash or not len(self._ring):
+      return None
+    loads = self._node_loads()
+    total_capacity = sum(w.capacity for w in self._workers.values())
+    total_load = sum(loads.values()) + 1
+    fallback = None
+    for node in self._ring.walk(job.content_hash):
+      fallback = fallback or node
+      cap = math.ceil(self.load_factor * total_load * self._workers[node].capacity / total_capacity)
+      if loads[node] + 1 <= cap:
+        return node
+    return fallback
+
+  def _node_full(self, worker_id: Optional[str]) -> bool:
+    worker = self._workers.get(worker_id or "")
+    if worker is None:
+      return True
+    running = sum(1 for job in self._jobs.values() if job.status == RUNNING and job.worker_id == worker_id)
+    return running >= worker.capacity
+
+  def _eligible(self, job: Job, worker_id: str) -> bool:
+    if job.assigned_to in (worker_id, None) or job.assigned_to not in self._workers:
+      return True
+    # Interactive work trades cache locality for latency when its node has no free slot.
+    return job.priority == "interactive" and self._node_full(job.assigned_to)
+
+  def _next_for(self, worker_id: str) -> Optional[Job]:
+    best = None
+    for job in self._pending:
+      if not self._eligible(job, worker_id):
+        continue
+      if best is None or self._order(job) < self._order(best):
+        best = job
+    return best
+
+  @staticmethod
+  def _order(job: Job) -> tuple:
+    return PRIORITY_RANK[job.priority], job.fair_tag, job.submitted_at
+
+  def submit(self, job: Job, *, weight: float = 1.0) -> Job:
+    with self._cond:
+      self._jobs[job.job_id] = job
+      job.queued_at = time.time()
+      # A client's jobs are spaced by their predicted cost over its weight, so a client with
+      # hundreds of queued cases interleaves with everyone else instead of running first.
+      job.fair_tag = max(self._virtual_time, self._client_finish.get(job.client, 0.0))
+      self._client_finish[job.client] = job.fair_tag + max(job.cost_seconds, 1.0) / max(weight, 1e-6)
+      job.assigned_to = self._route(job)
+      self._pending.append(job)
+      self._notify()
+    return job
+
+  def get(self, job_id: str) -> Optional[Job]:
+    with self._cond:
+      return self._jobs.get(job_id)
+
+  def forget(self, job_id: str) -> None:
+    with self._cond:
+      self._jobs.pop(job_id, None)
+
+  def depth(self) -> int:
+    with self._cond:
+      return len(self._pending)
+
+  def add_listener(self, listener: Callable[[Job], None]) -> None:
+    """Registers a callback run after each job completes or fails (``job.status`` tells which)."""
+    self._listeners.append(listener)
+
+  def snapshot(self) -> List[Job]:
+    with self._cond:
+      return [job for job in self._jobs.values() if job.status in (QUEUED, RUNNING)]
+
+  def total_capacity(self) -> int:
+    with self._cond:
+      return sum(worker.capacity for worker in self._workers.values())
+
+  def depth_by_priority(self) -> Dict[str, int]:
+    with self._cond:
+      depths = {name: 0 for name in PRIORITIES}
+      for job in self._pending:
+        depths[job.priority] += 1
+      return depths
+
+  def claim(self, worker_id: str, timeout: float = 0.0) -> Optional[Job]:
+    deadline = time.time() + timeout
+    with self._cond:
+      while self._closed or (job := self._next_for(worker_id)) is None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return None
+        self._cond.wait(remaining)
+      return self._start(job, worker_id)
+
+  async def claim_async(self, worker_id: str, timeout: float = 0.0) -> Optional[Job]:
+    """``claim`` for the coordinator's long-poll route: waits on the event loop, not in a thread."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+      with self._cond:
+        job = None if self._closed else self._next_for(worker_id)
+        if job is not None:
+          return self._start(job, worker_id)
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+          return None
+        future = loop.create_future()
+        self._claim_waiters.append((loop, future))
+      try:
+        await asyncio.wait_for(future, remaining)
+      except asyncio.TimeoutError:
+        pass
+      finally:
+        with self._cond:
+          if (loop, future) in self._claim_waiters:
+            self._claim_waiters.remove((loop, future))
+
+  def _start(self, job: Job, worker_id: str) -> Job:
+    """Hands a pending job to ``worker_id``; call with ``_cond`` held."""
+    self._pending.remove(job)
+    self._virtual_time = max(self._virtual_time, job.fair_tag)
+    job.status = RUNNING
+    job.worker_id = worker_id
+    job.started_at = time.time()
+    QUEUE_WAIT.observe(job.started_at - job.queued_at, priority=job.priority)
+    worker = self._workers.get(worker_id)
+    if worker:
+      worker.last_seen = time.time()
+    return job
+
+  def complete(self, job_id: str, result_path: Path, metadata: Optional[Dict[str, Any]] = None) -> Job:
+    with self._cond:
+      job = self._jobs[job_id]
+      job.status = DONE
+      job.result_path = result_path
+      job.metadata.update(metadata or {})
+      job.finished_at = time.time()
+      auto = job.params.get("auto_config")
+      if auto:
+        # Measured here rather than on the worker: a remote worker's clock need not match the one
+        # that stamped ``submitted_at``.
+        job.metadata["auto_config"] = {
+          **{k: v for k, v in auto.items() if k != "submitted_at"},
+          "actual_seconds": round(job.finished_at - auto.get("submitted_at", job.submitted_at), 2),
+        }
+      worker = self._workers.get(job.worker_id or "")
+      if worker:
+        worker.completed += 1
+        cache = job.metadata.get("cache") or {}
+        worker.cache_hits += int(cache.get("hits", 0))
+        worker.cache_misses += int(cache.get("misses", 0))
+    JOBS_TOTAL.inc(kind=job.kind, priority=job.priority, status=DONE)
+    self._run_listeners(job)
+    job.finish()
+    return job
+
+  def fail(self, job_id: str, error: str, *, rejected: Optional[str] = None) -> Job:
+    """``rejected`` is the validation reason when the worker refused the input (see validation.py)."""
+    with self._cond:
+      job = self._jobs[job_id]
+      job.status = FAILED
+      job.error = error
+      if rejected:
+        job.metadata["rejected"] = rejected
+      job.finished_at = time.time()
+      worker = self._workers.get(job.worker_id or "")
+      if worker:
+        worker.failed += 1
+    JOBS_TOTAL.inc(kind=job.kind, priority=job.priority, status=FAILED)
+    self._run_listeners(job)
+    job.finish()
+    return job
+
+  def _run_listeners(self, job: Job) -> None:
+    for listener in self._listeners:
+      try:
+        listener(job)
+      except Exception as exc:  # listeners are bookkeeping; never block the waiting request
+        print(f"[jobs] listener failed for {job.job_id}: {exc}", flush=True)
+
+  def should_preempt(self, job_id: str) -> bool:
+    """True when a running bulk job should pause at its next stage boundary for waiting interactive work."""
+    with self._cond:
+      job = self._jobs.get(job_id)
+      if job is None or job.status != RUNNING or not job.content_hash:
+        return False
+      if self._closed:
+        # Draining: stop at the next stage boundary; the finished stages stay in the result cache.
+        return True
+      if not self.preempt_bulk or job.priority != "bulk":
+        return False
+      if not any(waiting.priority == "interactive" for waiting in self._pending):
+        return False
+      # An idle slot anywhere will pick the interactive job up without pausing anyone.
+      return all(self._node_full(worker_id) for worker_id in self._workers)
+
+  def requeue(self, job_id: str, *, worker_id: str) -> Job:
+    """Puts a preempted job back, pinned to the node whose result cache holds its finished stages."""
+    with self._cond:
+      job = self._jobs[job_id]
+      job.status = QUEUED
+      job.worker_id = None
+      job.started_at = None
+      job.queued_at = time.time()
+      job.preemptions += 1
+      job.assigned_to = worker_id
+      self._pending.append(job)
+      self._notify()
+    PREEMPTIONS.inc(kind=job.kind)
+    return job
+
+  def close(self) -> None:
+    """Stops handing out jobs (drain). Running jobs may still complete, fail or requeue."""
+    with self._cond:
+      self._closed = True
+      self._notify()
+
+  def running(self) -> List[Job]:
+    with self._cond:
+      return [job for job in self._jobs.values() if job.status == RUNNING]
+
+  def take_pending(self) -> List[Job]:
+    """Removes every queued job for persisting and marks it PERSISTED."""
+    with self._cond:
+      taken = list(self._pending)
+      self._pending.clear()
+      for job in taken:
+        job.status = PERSISTED
+      return taken
+
+  def take_running(self) -> List[Job]:
+    """Gives up on running jobs that outlived the drain grace period; they restart from the cache."""
+    with self._cond:
+      taken = [job for job in self._jobs.values() if job.status == RUNNING]
+      for job in taken:
+        job.status = PERSISTED
+        job.worker_id = None
+      return taken
+
+  def register_worker(self, name: str, *, capacity: int = 1, worker_id: Optional[str] = None) -> WorkerInfo:
+    with self._cond:
+      worker_id = worker_id or f"worker_{uuid4_hex(8)}"
+      worker = WorkerInfo(worker_id=worker_id, name=name, capacity=max(1, capacity))
+      self._workers[worker_id] = worker
+      # Joining only claims the new node's arcs; queued jobs keep their assignment.
+      self._ring.add(worker_id, weight=worker.capacity)
+      self._notify()
+      return worker
+
+  def heartbeat(self, worker_id: str) -> bool:
+    with self._cond:
+      worker = self._workers.get(worker_id)
+      if worker is None:
+        return False
+      worker.last_seen = time.time()
+      return True
+
+  def is_registered(self, worker_id: str) -> bool:
+    with self._cond:
+      return worker_id in self._workers
+
+  def workers(self) -> List[WorkerInfo]:
+    with self._cond:
+      return list(self._workers.values())
+
+  def expire_workers(self, timeout: float, *, keep: tuple = ()) -> List[str]:
+    """Drop workers that missed their heartbeats and requeue whatever they were running."""
+    cutoff = time.time() - timeout
+    with self._cond:
+      expired = [wid for wid, w in self._workers.items() if w.last_seen < cutoff and wid not in keep]
+      for worker_id in expired:
+        del self._workers[worker_id]
+        self._ring.remove(worker_id)
+      for job in self._jobs.values():
+        if job.status == RUNNING and job.worker_id in expired:
+          job.status = QUEUED
+          job.worker_id = None
+          job.started_at = None
+          job.queued_at = time.time()
+          self._pending.appendleft(job)
+      # Only jobs owned by departed nodes move; everything else keeps its node.
+      for job in self._pending:
+        if job.assigned_to in expired:
+          job.assigned_to = self._route(job)
+      if expired:
+        self._notify()
+      return expired
+
+
+@lru_cache
+def get_job_queue() -> JobQueue:
+  settings = get_settings()
+  return JobQueue(load_factor=settings.routing_load_factor, preempt_bulk=settings.preempt_bulk)
+
+
+REGISTRY.gauge(
+  "hpb_queue_depth",
+  "Jobs waiting for a worker by priority class",
+  lambda: {label_key({"priority": name}): depth for name, depth in get_job_queue().depth_by_priority().items()},
+)
+
+
+def job_scratch(job_id: str) -> Dict[str, Path]:
+  settings = get_settings()
+  in_dir = settings.in_root / job_id
+  out_dir = settings.out_root / job_id
+  in_dir.mkdir(parents=True, exist_ok=True)
+  out_dir.mkdir(parents=True, exist_ok=True)
+  return {"in": in_dir, "out": out_dir}
+
+
+def release_job(job: Job) -> None:
+  settings = get_settings()
+  get_job_queue().forget(job.job_id)
+  get_scratch_manager().close(job.job_id, keep=settings.keep_intermediate)
+  if not settings.keep_intermediate:
+    shutil.rmtree(settings.in_root / job.job_id, ignore_errors=True)
@@ -1,27 +1,352 @@
 from __future__ import annotations
 
+import asyncio
+import json
+import re
 import shutil
-import time
+import threading
+from concurrent.futures import Future
+from contextlib import aclosing, asynccontextmanager
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional, Union
 
-from fastapi import BackgroundTasks, FastAPI, File, HTTPException, UploadFile
-from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from fastapi import Depends, FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 
+from .admin import router as admin_router
+from .batches import BatchCase, BatchRun, case_id_for, get_batch_registry, parse_manifest
+from .bundle import BundleCase, stream_bundle
+from .clients import get_client_registry, resolve_client
 from .config import get_settings
-from .runners import nnunet_v1_task008, prepare_package, totalseg_liver_only, totalseg_multilabel
+from .coordinator import router as workers_router
+from .costmodel import get_cost_model
+from .dicom import conversion_result, convert_series, expand_archive, series_files
+from .drain import get_drainer, install_signal_handlers, restore_jobs
+from .ingest import ingest_file, ingest_request, multipart_file_chunks, uncompressed_path
+from .jobs import DONE, FAILED, PERSISTED, PRIORITIES, Job, get_job_queue, release_job
+from .maskcodec import MEDIA_TYPE as MASK_MEDIA_TYPE, SUFFIX as MASK_SUFFIX
+from .metrics import INPUT_REJECTED, REGISTRY
+from .models import get_model_registry
+from .nifti import NiftiError, read_header, read_header_stream
+from .pipeline import JOB_KINDS, MASK_FORMATS, result_filename, result_media_type
+from .planner import plan_merge, plan_structures
+from .publish import ResultPublisher, publish_package, result_bucket
+from .results import StoredResult, get_result_store
+from .s3 import error_status, get_s3_client, parse_s3_uri, probe
+from .scheduler import AdmissionError, admit, estimate, plan_for_deadline, predict_seconds
+from .scratch import get_scratch_manager
+from .uploads import UploadError, get_upload_store
+from .uploads import router as uploads_router
 from .utils import (
-  Timer,
-  extract_archive,
-  log_execution,
-  package_outputs,
-  temp_case_dirs,
+  hash_file,
+  link_or_copy,
   unique_case_id,
-  write_metadata,
 )
+from .validation import InputRejected, check_header, validate_volume
+from .worker import LocalWorkerPool, WorkerReaper
+from .zipstream import StreamingZip
 
 settings = get_settings()
-app = FastAPI(title=settings.app_name)
+CASE_ID = re.compile(r"[A-Za-z0-9._-]{1,128}")
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+  if settings.mode == "coordinator" and not settings.worker_token:
+    raise RuntimeError("HPB_MODE=coordinator needs HPB_WORKER_TOKEN; remote workers could not authenticate")
+  queue = get_job_queue()
+  get_cost_model()
+  get_client_registry()
+  install_signal_handlers()
+  restore_jobs(queue, resume_batch=resume_manifest_batch)
+  pool = LocalWorkerPool(queue, 0 if settings.mode == "coordinator" else settings.local_workers)
+  reaper = WorkerReaper(queue, settings.worker_timeout)
+  pool.start()
+  reaper.start()
+  try:
+    yield
+  finally:
+    reaper.stop()
+    pool.stop()
+
+
+app = FastAPI(title=settings.app_name, lifespan=lifespan)
+app.include_router(workers_router)
+app.include_router(admin_router)
+app.include_router(uploads_router)
+
+
+def resolve_priority(requested: Optional[str], default: str) -> str:
+  priority = requested or default
+  if priority not in PRIORITIES:
+    raise HTTPException(status_code=400, detail=f"priority must be one of {', '.join(PRIORITIES)}")
+  return priority
+
+
+def with_mask_format(params: Dict[str, Any], mask_format: str) -> Dict[str, Any]:
+  """Adds ``mask_format`` to the job parameters; left out for the default so NIfTI jobs look as before."""
+  if mask_format not in MASK_FORMATS:
+    raise HTTPException(status_code=400, detail=f"mask_format must be one of {', '.join(MASK_FORMATS)}")
+  return {**params, "mask_format": mask_format} if mask_format != "nifti" else params
+
+
+def with_merge(params: Dict[str, Any], merged: bool, structures: Optional[str], precedence: Optional[str]) -> Dict[str, Any]:
+  """Parameters for a merged ``both`` package (see planner.plan_merge); unchanged without ``merged``."""
+  if not merged:
+    if structures or precedence:
+      raise HTTPException(status_code=400, detail="structures and precedence apply to merged=true only")
+    return params
+  try:
+    plan = plan_merge(structures, precedence)
+  except ValueError as exc:
+    raise HTTPException(status_code=400, detail=str(exc)) from exc
+  return {**params, "merged": True, "structures": plan.organs, "precedence": plan.precedence}
+
+
+def new_job(kind: str, case_id: str, params: Dict[str, Any], *, priority: str, client: str) -> Job:
+  job_id = unique_case_id(prefix="job")
+  # The scratch directory is only created once the input has passed the header checks.
+  input_path = settings.in_root / job_id / "input.nii.gz"
+  return Job(job_id=job_id, kind=kind, case_id=case_id, input_path=input_path, params=params,
+             priority=priority, client=client)
+
+
+def structure_list(structures: str) -> List[str]:
+  try:
+    return plan_structures(structures).structures
+  except ValueError as exc:
+    raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+
+def result_headers(job: Job) -> Dict[str, str]:
+  headers = {}
+  if "labels" in job.metadata:
+    headers["X-Label-Map"] = json.dumps(job.metadata["labels"])
+  if "auto_config" in job.metadata:
+    headers["X-Auto-Config"] = json.dumps(job.metadata["auto_config"])
+  stored = job.metadata.get("stored")
+  if stored:
+    headers["X-Result-Url"] = stored["url"]
+    headers["ETag"] = stored["etag"]
+  return headers
+
+
+def keep_result(job: Job) -> None:
+  """Copies a finished result into the result store so it outlives the response (see results.py)."""
+  store = get_result_store()
+  if not store.enabled or job.status != DONE:
+    return
+  filename = result_filename(job.kind, job.case_id, job.params.get("mask_format", "nifti"))
+  try:
+    entry = store.put(job.job_id, job.kind, job.case_id, job.content_hash, job.result_path, filename, client=job.client)
+  except OSError as exc:
+    print(f"[results] could not store {job.job_id}: {exc}", flush=True)
+    return
+  job.metadata["stored"] = {"url": f"/results/{job.job_id}/{filename}", "etag": entry.artifacts[filename]["etag"]}
+
+
+def check_accepting() -> None:
+  if get_drainer().draining:
+    raise HTTPException(status_code=503, detail="Server is draining for a restart", headers={"Retry-After": "30"})
+
+
+def persisted_error(job: Job) -> HTTPException:
+  return HTTPException(
+    status_code=503,
+    detail=f"Server restarted before job {job.job_id} finished; it resumes on the next start. "
+           f"Fetch the result from /jobs/{job.job_id}/result",
+    headers={"Retry-After": "30", "X-Job-Id": job.job_id},
+  )
+
+
+def check_budget(client: str) -> None:
+  retry_after = get_client_registry().throttle(client)
+  if retry_after is not None:
+    raise HTTPException(
+      status_code=429,
+      detail=f"Compute budget for {client} is spent; retry in {retry_after:.0f}s",
+      headers={"Retry-After": str(int(retry_after + 0.5))},
+    )
+
+
+def check_deadline(deadline_s: Optional[float]) -> None:
+  if deadline_s is not None and deadline_s <= 0:
+    raise HTTPException(status_code=400, detail="deadline_s must be positive")
+
+
+def header_features(path) -> Optional[Dict[str, float]]:
+  try:
+    return read_header(path).features()
+  except (NiftiError, OSError):
+    return None
+
+
+def admit_job(job: Job, deadline_s: Optional[float]) -> None:
+  """Reads the input header for the cost model and rejects jobs that cannot fit on a worker."""
+  if job.features is None:
+    job.features = header_features(job.input_path)
+  try:
+    admit(job.kind, job.params, job.features, flexible=deadline_s is not None)
+  except AdmissionError as exc:
+    release_job(job)
+    raise HTTPException(status_code=413, detail=str(exc)) from exc
+
+
+def schedule_job(job: Job, deadline_s: Optional[float]) -> None:
+  if deadline_s is not None:
+    job.params = plan_for_deadline(job.kind, job.params, job.features, deadline_s=deadline_s, priority=job.priority)
+  clients = get_client_registry()
+  job.cost_seconds = predict_seconds(job.kind, job.params, job.features)
+  clients.charge(job.client, job.cost_seconds)
+  get_job_queue().submit(job, weight=clients.weight(job.client))
+
+
+# The single-CT endpoints read the body themselves (see ingest.py) so that storing, hashing and
+# gunzipping overlap with the transfer; this keeps the multipart ``ct`` field in the OpenAPI schema.
+CT_UPLOAD = {
+  "requestBody": {
+    "required": False,
+    "content": {
+      "multipart/form-data": {
+        "schema": {"type": "object", "required": ["ct"], "properties": {"ct": {"type": "string", "format": "binary"}}},
+      },
+      "application/gzip": {"schema": {"type": "string", "format": "binary"}},
+    },
+  },
+}
+
+
+def rejected(exc: ValueError, prefix: str = "") -> HTTPException:
+  if not isinstance(exc, InputRejected):
+    exc = InputRejected("malformed", str(exc))
+  INPUT_REJECTED.inc(reason=exc.reason)
+  return HTTPException(status_code=exc.status_code, detail=f"{prefix}{exc}")
+
+
+async def receive_ct(request: Request, job: Job) -> None:
+  """
+  Streams the CT (NIfTI, or a zip of DICOM slices) into the job's scratch directory. NIfTI headers
+  are checked as soon as they arrive, so unusable uploads are refused before anything is written;
+  a voxel sample is checked at the end.
+  """
+  try:
+    received = await ingest_request(request, job.input_path, check_header=check_header)
+    received = await run_in_threadpool(expand_archive, received, job.input_path, job.params, check_header=check_header)
+    await run_in_threadpool(validate_volume, received.header, received.complete, received.volume)
+  except (InputRejected, NiftiError) as exc:
+    release_job(job)
+    raise rejected(exc) from exc
+  except ValueError as exc:
+    release_job(job)
+    raise HTTPException(status_code=400, detail=str(exc)) from exc
+  except BaseException:
+    release_job(job)
+    raise
+  job.content_hash = received.content_hash
+  job.features = received.header.features()
+
+
+async def receive_source(source: str, job: Job) -> None:
+  """
+  Checks an s3:// input from its size and header (one small ranged GET); the worker downloads
+  the object itself, and the voxel sample is checked there.
+  """
+  try:
+    _, header = await run_in_threadpool(probe, source)
+    if header is not None:
+      check_header(header)
+      job.features = header.features()
+  except (InputRejected, NiftiError) as exc:
+    release_job(job)
+    raise rejected(exc) from exc
+  except ValueError as exc:
+    release_job(job)
+    raise HTTPException(status_code=400, detail=str(exc)) from exc
+  except Exception as exc:
+    release_job(job)
+    status = error_status(exc)
+    if status in (403, 404):
+      raise HTTPException(status_code=status, detail=f"Cannot read {source}") from exc
+    raise HTTPException(status_code=502, detail=f"S3 error for {source}: {exc}") from exc
+  job.input_uri = source
+
+
+async def receive_upload(upload_id: str, job: Job, client: str) -> None:
+  """Finalizes a completed resumable upload into the job; its bytes were hashed as they arrived."""
+  try:
+    received = await run_in_threadpool(get_upload_store().take, upload_id, client, job.input_path)
+    received = await run_in_threadpool(expand_archive, received, job.input_path, job.params, check_header=check_header)
+    await run_in_threadpool(validate_volume, received.header, received.complete, received.volume)
+  except UploadError as exc:
+    release_job(job)
+    raise HTTPException(status_code=exc.status_code, detail=str(exc)) from exc
+  except (InputRejected, NiftiError) as exc:
+    release_job(job)
+    raise rejected(exc) from exc
+  except ValueError as exc:
+    release_job(job)
+    raise HTTPException(status_code=400, detail=str(exc)) from exc
+  except BaseException:
+    release_job(job)
+    raise
+  job.content_hash = received.content_hash
+  job.features = received.header.features()
+
+
+def check_publish(publish: bool, case_id: Optional[str] = None) -> None:
+  if publish and not settings.s3_bucket:
+    raise HTTPException(status_code=400, detail="publish=true needs HPB_S3_BUCKET")
+  if case_id is not None and not CASE_ID.fullmatch(case_id):
+    raise HTTPException(status_code=400, detail="case_id may only contain letters, digits, '.', '_' and '-'")
+
+
+async def run_upload_job(kind: str, request: Request, params: Dict[str, Any], *, priority: str, client: str,
+                         deadline_s: Optional[float], error_prefix: str, source: Optional[str] = None,
+                         upload: Optional[str] = None, publish: bool = False,
+                         case_id: Optional[str] = None) -> FileResponse:
+  if source and upload:
+    raise HTTPException(status_code=400, detail="Pass either source or upload, not both")
+  check_deadline(deadline_s)
+  check_publish(publish, case_id)
+  check_accepting()
+  check_budget(client)
+  job = new_job(kind, case_id or unique_case_id(), params, priority=priority, client=client)
+  if source:
+    await receive_source(source, job)
+  elif upload:
+    await receive_upload(upload, job, client)
+  else:
+    await receive_ct(request, job)
+  admit_job(job, deadline_s)
+  schedule_job(job, deadline_s)
+  await job.wait_async()
+
+  if job.status == PERSISTED:
+    raise persisted_error(job)
+  if job.status == FAILED:
+    release_job(job)
+    if job.metadata.get("rejected"):
+      raise rejected(InputRejected(job.metadata["rejected"], job.error or ""))
+    raise HTTPException(status_code=500, detail=f"{error_prefix}: {job.error}")
+  await run_in_threadpool(keep_result, job)
+  headers = result_headers(job)
+  if publish:
+    try:
+      published = await run_in_threadpool(publish_package, job.case_id, job.result_path)
+    except Exception as exc:
+      release_job(job)
+      raise HTTPException(status_code=502, detail=f"Publishing {job.case_id} to S3 failed: {exc}") from exc
+    headers["X-S3-Keys"] = json.dumps(published.keys)
+  return FileResponse(
+    job.result_path,
+    media_type=result_media_type(kind, job.params.get("mask_format", "nifti")),
+    filename=result_filename(kind, job.case_id, job.params.get("mask_format", "nifti")),
+    headers=headers,
+    background=BackgroundTask(release_job, job),
+  )
 
 
 @app.get("/healthz")
@@ -29,6 +354,14 @@ def health() -> PlainTextResponse:
   return PlainTextResponse("ok")
 
 
+@app.get("/readyz")
+def ready() -> JSONResponse:
+  """Readiness for load balancers: flips to 503 as soon as a drain starts."""
+  if get_drainer().draining:
+    return JSONResponse({"ready": False, "draining": True}, status_code=503)
+  return JSONResponse({"ready": True})
+
+
 @app.get("/version")
 def version() -> JSONResponse:
   info = {}
@@ -51,181 +384,654 @@ def version() -> JSONResponse:
     info["totalseg"] = getattr(ts, "__version__", "unknown")
   except Exception as exc:
     info["totalseg_error"] = str(exc)
+  info["models"] = get_model_registry().stats()
+  info["results"] = get_result_store().stats()
+  info["scratch"] = get_scratch_manager().stats()
   return JSONResponse(info)
 
 
-@app.post("/segment/task008")
-async def segment_task008(ct: UploadFile = File(...), folds: str = "0"):
-  case_id = unique_case_id()
-  with temp_case_dirs(case_id) as dirs:
-    in_dir, out_dir = dirs["in"], dirs["out"]
-    in_path = in_dir / f"{case_id}_0000.nii.gz"
-    in_path.write_bytes(await ct.read())
+@app.get("/metrics")
+def metrics() -> Response:
+  return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
-    try:
-      with Timer() as timer:
-        output_path = nnunet_v1_task008(in_dir, out_dir, case_id=case_id, folds=folds)
-      log_execution(f"task008:{case_id}", timer.duration)
-    except Exception as exc:
-      raise HTTPException(status_code=500, detail=f"Task008 failed: {exc}") from exc
 
-    return FileResponse(output_path, media_type="application/gzip", filename=f"{case_id}_task008.nii.gz")
+@app.post("/estimate")
+async def estimate_job(
+  ct: UploadFile = File(...),
+  kind: str = "both",
+  folds: str = "0",
+  fast: bool = True,
+  crop: bool = False,
+  structures: Optional[str] = None,
+  priority: Optional[str] = None,
+  deadline_s: Optional[float] = None,
+) -> JSONResponse:
+  """Predicts runtime, peak memory and ETA from the NIfTI header; the upload may be just the first few KB."""
+  if kind not in JOB_KINDS:
+    raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(JOB_KINDS)}")
+  check_deadline(deadline_s)
+  priority = resolve_priority(priority, "standard")
+  try:
+    header = read_header_stream(ct.file)
+    check_header(header)
+  except (InputRejected, NiftiError) as exc:
+    raise rejected(exc) from exc
+  features = header.features()
+  params: Dict[str, Any] = {"folds": folds, "fast": fast, "crop": crop}
+  if kind == "structures" or structures:
+    kind = "structures"
+    params["structures"] = structure_list(structures or "")
+  if deadline_s is not None:
+    params = plan_for_deadline(kind, params, features, deadline_s=deadline_s, priority=priority)
+  return JSONResponse({"header": features, **estimate(kind, params, features, priority=priority)})
 
 
-@app.post("/segment/liver")
-async def segment_liver(ct: UploadFile = File(...), fast: bool = False):
-  case_id = unique_case_id()
-  with temp_case_dirs(case_id) as dirs:
-    in_dir, out_dir = dirs["in"], dirs["out"]
-    in_path = in_dir / f"{case_id}.nii.gz"
-    in_path.write_bytes(await ct.read())
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str) -> JSONResponse:
+  job = get_job_queue().get(job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+  return JSONResponse(job.describe())
 
-    try:
-      with Timer() as timer:
-        output_path = totalseg_liver_only(in_path, out_dir, fast=fast)
-      log_execution(f"liver:{case_id}", timer.duration)
-    except Exception as exc:
-      raise HTTPException(status_code=500, detail=f"TotalSegmentator liver failed: {exc}") from exc
 
-    return FileResponse(output_path, media_type="application/gzip", filename=f"{case_id}_liver.nii.gz")
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str):
+  """Result of a job whose original request was cut off by a restart (see /readyz and drain)."""
+  job = get_job_queue().get(job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+  if job.status == FAILED:
+    release_job(job)
+    raise HTTPException(status_code=500, detail=job.error)
+  if job.status != DONE:
+    return JSONResponse(job.describe(), status_code=202)
+  keep_result(job)
+  return FileResponse(
+    job.result_path,
+    media_type=result_media_type(job.kind, job.params.get("mask_format", "nifti")),
+    filename=result_filename(job.kind, job.case_id, job.params.get("mask_format", "nifti")),
+    headers=result_headers(job),
+    background=BackgroundTask(release_job, job),
+  )
 
 
-@app.post("/segment/totalseg")
-async def segment_totalseg(ct: UploadFile = File(...), fast: bool = False):
-  case_id = unique_case_id()
-  with temp_case_dirs(case_id) as dirs:
-    in_dir, out_dir = dirs["in"], dirs["out"]
-    in_path = in_dir / f"{case_id}.nii.gz"
-    in_path.write_bytes(await ct.read())
+def stored_result(key: str, client: str) -> StoredResult:
+  entry = get_result_store().get(key, client)
+  if entry is None:
+    raise HTTPException(status_code=404, detail=f"No stored result for {key} (unknown, or evicted)")
+  return entry
+
+
+@app.get("/results/{key}")
+def result_index(key: str, client: str = Depends(resolve_client)) -> JSONResponse:
+  """Artifacts stored for a job id, or for the newest job on an input content hash."""
+  entry = stored_result(key, client)
+  return JSONResponse({
+    "job_id": entry.job_id,
+    "kind": entry.kind,
+    "case_id": entry.case_id,
+    "content_hash": entry.content_hash,
+    "created_at": entry.created_at,
+    "expires_at": entry.created_at + settings.result_ttl_hours * 3600 if settings.result_ttl_hours > 0 else None,
+    "artifacts": {name: {**meta, "url": f"/results/{entry.job_id}/{name}"} for name, meta in entry.artifacts.items()},
+  })
+
+
+@app.get("/results/{key}/{artifact}")
+def result_artifact(key: str, artifact: str, request: Request, client: str = Depends(resolve_client)):
+  """
+  Conditional and ranged download: ``If-None-Match`` with the artifact's ETag answers 304, and a
+  ``Range`` header (honoured when ``If-Range`` is absent or still matches) answers 206.
+  """
+  entry = stored_result(key, client)
+  path = get_result_store().path(entry, artifact)
+  if path is None or not path.exists():
+    raise HTTPException(status_code=404, detail=f"Result {entry.job_id} has no artifact {artifact}")
+  etag = entry.artifacts[artifact]["etag"]
+  headers = {"ETag": etag, "Cache-Control": "private, max-age=0, must-revalidate"}
+  if etag_matches(request.headers.get("if-none-match"), etag):
+    return Response(status_code=304, headers=headers)
+  honour_if_range(request, etag)
+  # Starlette answers Range requests (single and multiple ranges, If-Range, 416) for FileResponse.
+  return FileResponse(path, media_type=artifact_media_type(artifact), filename=artifact, headers=headers)
+
+
+def honour_if_range(request: Request, etag: str) -> None:
+  """
+  Starlette checks If-Range against its own mtime/size ETag, never the stored one this endpoint
+  advertises. An If-Range that matches ours is dropped so the Range applies. Any other value is
+  left for Starlette, which then sends the full file.
+  """
+  if_range = request.headers.get("if-range")
+  if if_range is not None and if_range.strip() == etag:
+    request.scope["headers"] = [(name, value) for name, value in request.scope["headers"] if name != b"if-range"]
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+  if not header:
+    return False
+  candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+  return "*" in candidates or etag in candidates
+
+
+def artifact_media_type(name: str) -> str:
+  if name.endswith(".zip"):
+    return "application/zip"
+  if name.endswith(".json"):
+    return "application/json"
+  if name.endswith(MASK_SUFFIX):
+    return MASK_MEDIA_TYPE
+  return "application/gzip"
+
+
+@app.post("/segment/task008", openapi_extra=CT_UPLOAD)
+async def segment_task008(
+  request: Request,
+  folds: str = "0",
+  mask_format: str = "nifti",
+  priority: Optional[str] = None,
+  deadline_s: Optional[float] = None,
+  source: Optional[str] = None,
+  upload: Optional[str] = None,
+  client: str = Depends(resolve_client),
+):
+  return await run_upload_job(
+    "task008", request, with_mask_format({"folds": folds}, mask_format), priority=resolve_priority(priority, "interactive"),
+    client=client, deadline_s=deadline_s, error_prefix="Task008 failed", source=source, upload=upload,
+  )
 
-    try:
-      with Timer() as timer:
-        output_path = totalseg_multilabel(in_path, out_dir, fast=fast)
-      log_execution(f"totalseg:{case_id}", timer.duration)
-    except Exception as exc:
-      raise HTTPException(status_code=500, detail=f"TotalSegmentator multi-label failed: {exc}") from exc
 
-    return FileResponse(output_path, media_type="application/gzip", filename=f"{case_id}_totalseg.nii.gz")
+@app.post("/segment/liver", openapi_extra=CT_UPLOAD)
+async def segment_liver(
+  request: Request,
+  fast: bool = False,
+  mask_format: str = "nifti",
+  priority: Optional[str] = None,
+  deadline_s: Optional[float] = None,
+  source: Optional[str] = None,
+  upload: Optional[str] = None,
+  client: str = Depends(resolve_client),
+):
+  return await run_upload_job(
+    "liver", request, with_mask_format({"fast": fast}, mask_format), priority=resolve_priority(priority, "interactive"),
+    client=client, deadline_s=deadline_s, error_prefix="TotalSegmentator liver failed", source=source,
+    upload=upload,
+  )
+
+
+@app.post("/segment/totalseg", openapi_extra=CT_UPLOAD)
+async def segment_totalseg(
+  request: Request,
+  fast: bool = False,
+  structures: Optional[str] = None,
+  folds: str = "0",
+  mask_format: str = "nifti",
+  priority: Optional[str] = None,
+  deadline_s: Optional[float] = None,
+  source: Optional[str] = None,
+  upload: Optional[str] = None,
+  client: str = Depends(resolve_client),
+):
+  """
+  Without ``structures`` runs the full multi-label model. With a comma-separated structure list
+  (TotalSegmentator class names plus ``hepatic_vessels``/``liver_tumors``) runs only the models that
+  produce them and returns one label map; ``X-Label-Map`` gives the label of each structure.
+  """
+  if structures:
+    return await run_upload_job(
+      "structures", request,
+      with_mask_format({"structures": structure_list(structures), "fast": fast, "folds": folds}, mask_format),
+      priority=resolve_priority(priority, "interactive"),
+      client=client, deadline_s=deadline_s, error_prefix="Structure segmentation failed", source=source,
+      upload=upload,
+    )
+  return await run_upload_job(
+    "totalseg", request, with_mask_format({"fast": fast}, mask_format), priority=resolve_priority(priority, "interactive"),
+    client=client, deadline_s=deadline_s, error_prefix="TotalSegmentator multi-label failed", source=source,
+    upload=upload,
+  )
 
 
-@app.post("/segment/both")
+@app.post("/segment/both", openapi_extra=CT_UPLOAD)
 async def segment_both(
-  ct: UploadFile = File(...),
+  request: Request,
   folds: str = "0",
   fast: bool = True,
-  background_tasks: BackgroundTasks | None = None,
+  mask_format: str = "nifti",
+  merged: bool = False,
+  structures: Optional[str] = None,
+  precedence: Optional[str] = None,
+  priority: Optional[str] = None,
+  deadline_s: Optional[float] = None,
+  source: Optional[str] = None,
+  upload: Optional[str] = None,
+  publish: bool = False,
+  case_id: Optional[str] = None,
+  client: str = Depends(resolve_client),
 ):
-  case_id = unique_case_id()
-  with temp_case_dirs(case_id) as dirs:
-    in_dir, out_dir = dirs["in"], dirs["out"]
-    case_root = out_dir
-
-    raw_ct = in_dir / f"{case_id}.nii.gz"
-    ct_v1 = in_dir / f"{case_id}_0000.nii.gz"
-    data = await ct.read()
-    raw_ct.write_bytes(data)
-    ct_v1.write_bytes(data)
-
-    liver_dir = case_root / "totalseg"
-    task_dir = case_root / "task008"
-    liver_dir.mkdir(parents=True, exist_ok=True)
-    task_dir.mkdir(parents=True, exist_ok=True)
+  """
+  With ``publish=true`` the package is also uploaded to ``<HPB_S3_RESULT_PREFIX>/<case_id>/segmentations/``.
+  With ``merged=true`` the package holds one ``labels`` map (liver, hepatic vessels, tumours and the
+  TotalSegmentator ``structures`` requested) instead of two masks; ``precedence`` lists structures
+  highest first for voxels where masks overlap, and meta.json documents the label table.
+  """
+  params = with_merge(with_mask_format({"folds": folds, "fast": fast}, mask_format), merged, structures, precedence)
+  return await run_upload_job(
+    "both", request, params, priority=resolve_priority(priority, "standard"),
+    client=client, deadline_s=deadline_s, error_prefix="Pipeline failed", source=source,
+    upload=upload, publish=publish, case_id=case_id,
+  )
 
-    try:
-      with Timer() as timer_liver:
-        liver_path = totalseg_liver_only(raw_ct, liver_dir, fast=fast)
-      log_execution(f"liver:{case_id}", timer_liver.duration)
 
-      with Timer() as timer_task008:
-        task008_path = nnunet_v1_task008(in_dir, task_dir, case_id=case_id, folds=folds)
-      log_execution(f"task008:{case_id}", timer_task008.duration)
-    except Exception as exc:
-      raise HTTPException(status_code=500, detail=f"Pipeline failed: {exc}") from exc
+# Like CT_UPLOAD: the bundle is read from the request stream, as a ``bundle`` form field or the raw body.
+BUNDLE_UPLOAD = {
+  "requestBody": {
+    "required": False,
+    "content": {
+      "multipart/form-data": {
+        "schema": {"type": "object", "required": ["bundle"],
+                   "properties": {"bundle": {"type": "string", "format": "binary"}}},
+      },
+      "application/zip": {"schema": {"type": "string", "format": "binary"}},
+      "application/gzip": {"schema": {"type": "string", "format": "binary"}},
+    },
+  },
+}
 
-    metadata = {
-      "case_id": case_id,
-      "labels_task008": {"1": "hepatic_vessels", "2": "liver_tumors"},
-      "liver_seconds": round(timer_liver.duration, 2),
-      "task008_seconds": round(timer_task008.duration, 2),
-      "timestamp": time.time(),
-    }
 
-    pkg_dir = prepare_package(case_root, liver_mask=liver_path, task008_mask=task008_path, metadata=metadata)
-    archive_path = package_outputs(pkg_dir, base_name=case_id)
+def ingest_case(job: Job, raw_source: Optional[Path], dicom_files: List[Path], *, move: bool) -> None:
+  """
+  Validates a case's CT, given as a NIfTI file or as DICOM slices, and puts it into the job's scratch
+  directory (moved out of a batch bundle, hardlinked from anywhere else). Raises InputRejected.
+  """
+  job.input_path.parent.mkdir(parents=True, exist_ok=True)
+  if raw_source is not None:
+    received = ingest_file(raw_source, uncompressed_path(job.input_path), check_header=check_header)
+  else:
+    conversion = convert_series(dicom_files, uncompressed_path(job.input_path), job.input_path, check_header=check_header)
+    received = conversion_result(conversion, job.params, hash_file(job.input_path), job.input_path)
+  validate_volume(received.header, received.complete, received.volume)
+  if raw_source is not None:
+    if move:
+      raw_source.replace(job.input_path)
+    else:
+      link_or_copy(raw_source, job.input_path)
+  job.content_hash = received.content_hash
+  job.features = received.header.features()
 
-    if background_tasks:
-      background_tasks.add_task(shutil.rmtree, pkg_dir.parent, ignore_errors=True)
 
-    return FileResponse(archive_path, media_type="application/zip", filename=f"{case_id}_results.zip")
+async def receive_case(case: BundleCase, job: Job) -> None:
+  """Validates one unpacked case folder and moves its CT into the job's scratch directory."""
+  raw_source = case.folder / "raw.nii.gz"
+  raw0000_source = case.folder / "raw_0000.nii.gz"
+  if not raw_source.exists() and raw0000_source.exists():
+    raw_source = raw0000_source
+  # A case folder without raw.nii.gz may hold the DICOM slices of the series instead.
+  dicom_files = [] if raw_source.exists() else series_files(case.folder)
+  if not raw_source.exists() and not dicom_files:
+    release_job(job)
+    raise HTTPException(status_code=400, detail=f"Case {case.case_id} missing raw.nii.gz or DICOM slices")
+  try:
+    await run_in_threadpool(ingest_case, job, None if dicom_files else raw_source, dicom_files, move=True)
+  except (InputRejected, NiftiError) as exc:
+    release_job(job)
+    raise rejected(exc, prefix=f"Case {case.case_id}: ") from exc
 
 
-@app.post("/segment/batch")
+@app.post("/segment/batch", openapi_extra=BUNDLE_UPLOAD)
 async def segment_batch(
-  bundle: UploadFile = File(...),
+  request: Request,
   folds: str = "0",
   fast: bool = True,
+  mask_format: str = "nifti",
+  merged: bool = False,
+  structures: Optional[str] = None,
+  precedence: Optional[str] = None,
+  priority: Optional[str] = None,
+  deadline_s: Optional[float] = None,
+  publish: bool = False,
+  client: str = Depends(resolve_client),
 ):
+  """
+  Cases are queued as they come out of the uploading bundle, so inference on the first case starts
+  while the rest is still arriving. The response streams a zip that grows case by case in completion
+  order; a failed case does not fail the batch but is listed in manifest.json. With ``publish=true``
+  each case is also uploaded to S3 as it finishes.
+  """
+  priority = resolve_priority(priority, "bulk")
+  params = with_merge(with_mask_format({"folds": folds, "fast": fast}, mask_format), merged, structures, precedence)
+  check_deadline(deadline_s)
+  check_publish(publish)
+  check_accepting()
+  check_budget(client)
   batch_id = unique_case_id(prefix="batch")
   batch_root = settings.out_root / batch_id
   batch_root.mkdir(parents=True, exist_ok=True)
+  if request.headers.get("content-type", "").startswith("multipart/form-data"):
+    chunks = multipart_file_chunks(request, "bundle")
+  else:
+    chunks = request.stream()
+
+  # Every case is its own job so registered workers pick them up in parallel. With a deadline,
+  # each case is planned after the previous ones are queued, so later cases see the backlog.
+  jobs: List[Job] = []
+  max_bytes = int(settings.bundle_max_gb * 1024 ** 3)
   try:
-    case_dirs = extract_archive(bundle, batch_root)
+    async with aclosing(stream_bundle(chunks, batch_root, max_cases=settings.max_batch_cases,
+                                      max_bytes=max_bytes)) as cases:
+      async for case in cases:
+        job = new_job("both", case.case_id, dict(params), priority=priority, client=client)
+        await receive_case(case, job)
+        admit_job(job, deadline_s)
+        schedule_job(job, deadline_s)
+        jobs.append(job)
+  except BaseException as exc:
+    # Cases already queued keep running (their stages land in the result cache); clean up after them.
+    if jobs:
+      threading.Thread(target=release_when_done, args=(jobs,), daemon=True).start()
+    shutil.rmtree(batch_root, ignore_errors=True)
+    if isinstance(exc, InputRejected):
+      raise rejected(exc) from exc
+    if isinstance(exc, ValueError):
+      raise HTTPException(status_code=400, detail=str(exc)) from exc
+    raise
+  if not jobs:
+    shutil.rmtree(batch_root, ignore_errors=True)
+    raise HTTPException(status_code=400, detail="Bundle contains no case folders")
+
+  publisher = ResultPublisher() if publish else None
+  uploads: Dict[str, Future] = {}
+  completed: asyncio.Queue = asyncio.Queue()
+
+  async def finished(job: Job) -> None:
+    await job.wait_async()
+    if publisher is not None and job.status == DONE:
+      # Uploads in completion order, overlapping with inference on the cases still queued.
+      uploads[job.job_id] = publisher.submit(job.case_id, job.result_path)
+    completed.put_nowait(job)
+
+  def release(job: Job) -> None:
+    # The upload reads the package from the job's scratch directory, so that goes once it is done.
+    upload = uploads.get(job.job_id)
+    if upload is None:
+      release_job(job)
+    else:
+      upload.add_done_callback(lambda _: release_job(job))
+
+  waiters = [asyncio.ensure_future(finished(job)) for job in jobs]
+
+  async def stream_batch():
+    """
+    Each case's files are appended as soon as that case finishes, straight from its result package;
+    nothing is extracted or re-archived on disk. manifest.json goes last and records failed cases.
+    """
+    archive = StreamingZip()
+    pending = {job.job_id: job for job in jobs}
+    try:
+      manifest: List[dict] = []
+      for _ in jobs:
+        job = await completed.get()
+        pending.pop(job.job_id)
+        if job.status == DONE:
+          await run_in_threadpool(keep_result, job)
+          async for chunk in iterate_in_threadpool(archive.add_zip(job.case_id, job.result_path)):
+            yield chunk
+          manifest.append(job.metadata)
+        elif job.status == PERSISTED:
+          # Resumes on the next start and fills the result cache; resubmitting the case is then a cache hit.
+          manifest.append({"case_id": job.case_id, "job_id": job.job_id, "status": PERSISTED})
+          continue
+        else:
+          manifest.append({"case_id": job.case_id, "job_id": job.job_id, "status": job.status, "error": job.error})
+        release(job)
+      summary: Dict[str, Any] = {
+        "batch_id": batch_id,
+        "cases": manifest,
+        "failed": [entry["case_id"] for entry in manifest if entry.get("status") == FAILED],
+        "persisted": [entry["case_id"] for entry in manifest if entry.get("status") == PERSISTED],
+      }
+      if publisher is not None:
+        summary["publish"] = await run_in_threadpool(publisher.finish)
+      for chunk in archive.add_bytes("manifest.json", json.dumps(summary, indent=2).encode()):
+        yield chunk
+      for chunk in archive.close():
+        yield chunk
+    finally:
+      # The client may disconnect mid-stream; cases still running are released when they finish.
+      for waiter in waiters:
+        waiter.cancel()
+      for job_id in set(pending) & set(uploads):
+        release(pending.pop(job_id))
+      if pending:
+        threading.Thread(target=release_when_done, args=(list(pending.values()),), daemon=True).start()
+      if not settings.keep_intermediate:
+        shutil.rmtree(batch_root, ignore_errors=True)
+
+  return StreamingResponse(
+    stream_batch(), media_type="application/zip",
+    headers={"Content-Disposition": f'attachment; filename="{batch_id}_batch.zip"', "X-Batch-Id": batch_id},
+  )
+
+
+def release_when_done(jobs: List[Job]) -> None:
+  for job in jobs:
+    job.wait()
+    if job.status != PERSISTED:
+      release_job(job)
+
+
+MANIFEST_MAX_BYTES = 16 * 1024 * 1024
+
+
+class ManifestBatchRequest(BaseModel):
+  # Inline cases (URIs, or {"case_id": ..., "source": ...}) or a manifest file to read them from.
+  cases: Optional[List[Union[str, Dict[str, str]]]] = None
+  manifest: Optional[str] = None
+  folds: str = "0"
+  fast: bool = True
+  priority: Optional[str] = None
+  publish: bool = False
+  chunk: Optional[int] = None
+
+
+def local_input(source: str) -> Path:
+  """Resolves a server-local input path, which must lie under one of HPB_LOCAL_INPUT_ROOTS."""
+  roots = [Path(root.strip()).resolve() for root in (settings.local_input_roots or "").split(",") if root.strip()]
+  path = Path(source).resolve()
+  if not any(path.is_relative_to(root) for root in roots):
+    raise ValueError(f"{source} is not under an allowed input root (HPB_LOCAL_INPUT_ROOTS)")
+  return path
+
+
+def read_manifest(reference: str) -> str:
+  if reference.startswith("s3://"):
+    bucket, key = parse_s3_uri(reference)
+    body = get_s3_client().get_object(Bucket=bucket, Key=key)["Body"].read(MANIFEST_MAX_BYTES + 1)
+  else:
+    with local_input(reference).open("rb") as handle:
+      body = handle.read(MANIFEST_MAX_BYTES + 1)
+  if len(body) > MANIFEST_MAX_BYTES:
+    raise ValueError("Manifest is larger than 16 MB")
+  return body.decode("utf-8-sig")
+
+
+def manifest_cases(body: ManifestBatchRequest) -> List[BatchCase]:
+  """Checks ids and reference syntax up front; whether each input exists is checked when its case starts."""
+  if (body.cases is None) == (body.manifest is None):
+    raise ValueError("Give either cases or manifest")
+  rows = parse_manifest(read_manifest(body.manifest)) if body.manifest else \
+    [{"source": row} if isinstance(row, str) else row for row in body.cases]
+  if not rows:
+    raise ValueError("The manifest lists no cases")
+  if len(rows) > settings.max_manifest_cases:
+    raise ValueError(f"Too many cases ({len(rows)} > {settings.max_manifest_cases})")
+  cases: List[BatchCase] = []
+  seen = set()
+  for row in rows:
+    source = (row.get("source") or "").strip()
+    if not source:
+      raise ValueError(f"Case without a source: {row}")
+    case_id = row.get("case_id") or case_id_for(source)
+    if not CASE_ID.fullmatch(case_id):
+      raise ValueError(f"Invalid case_id {case_id!r}")
+    if case_id in seen:
+      raise ValueError(f"Duplicate case_id {case_id}")
+    seen.add(case_id)
+    if source.startswith("s3://"):
+      parse_s3_uri(source)
+    else:
+      local_input(source)
+    cases.append(BatchCase(case_id=case_id, source=source))
+  return cases
+
+
+def start_manifest_case(case: BatchCase, params: Dict[str, Any], *, priority: str, client: str) -> Job:
+  """Validates one manifest input like an upload and queues it; raises with the reason the case failed."""
+  job = new_job("both", case.case_id, dict(params), priority=priority, client=client)
+  try:
+    if case.source.startswith("s3://"):
+      _, header = probe(case.source)
+      if header is not None:
+        check_header(header)
+        job.features = header.features()
+      job.input_uri = case.source
+    else:
+      path = local_input(case.source)
+      if path.is_dir():
+        files = series_files(path)
+        if not files:
+          raise InputRejected("malformed", f"{case.source} holds no files")
+        ingest_case(job, None, files, move=False)
+      elif path.is_file():
+        ingest_case(job, path, [], move=False)
+      else:
+        raise ValueError(f"{case.source} does not exist")
+    admit_job(job, None)
+  except Exception as exc:
+    release_job(job)
+    if isinstance(exc, InputRejected):
+      INPUT_REJECTED.inc(reason=exc.reason)
+    if error_status(exc) in (403, 404):
+      raise ValueError(f"Cannot read {case.source}") from exc
+    raise
+  schedule_job(job, None)
+  return job
+
+
+def finish_manifest_case(case: BatchCase, job: Job, *, publish: bool) -> None:
+  """Moves a finished case into the result store (and S3) and frees its scratch."""
+  try:
+    keep_result(job)
+    case.result_url = job.metadata.get("stored", {}).get("url")
+    if publish:
+      publish_package(case.case_id, job.result_path)
+  finally:
+    release_job(job)
+
+
+def finish_manifest_batch(run: BatchRun, *, publish: bool) -> Dict[str, Any]:
+  if not publish:
+    return {}
+  key = f"{settings.s3_result_prefix.strip('/')}/batches/{run.batch_id}/index.json"
+  try:
+    get_s3_client().put_object(Bucket=result_bucket(), Key=key, Body=json.dumps(run.index(), indent=2).encode(),
+                               ContentType="application/json")
+  except Exception as exc:
+    print(f"[batch] {run.batch_id}: uploading the index failed: {exc}", flush=True)
+    return {"index_error": str(exc)}
+  return {"index_key": key}
+
+
+def manifest_callbacks(run_params: Dict[str, Any], *, client: str, priority: str, publish: bool) -> Dict[str, Any]:
+  return {
+    "start_case": lambda case: start_manifest_case(case, run_params, priority=priority, client=client),
+    "finish_case": lambda case, job: finish_manifest_case(case, job, publish=publish),
+    "finish_batch": lambda run: finish_manifest_batch(run, publish=publish),
+    "should_stop": lambda: get_drainer().draining,
+  }
+
+
+def resume_manifest_batch(record: Dict[str, Any], jobs: Dict[str, Job]) -> None:
+  """Carries on with a batch the previous process saved while draining."""
+  options = record.get("options") or {}
+  callbacks = manifest_callbacks(record["params"], client=record["client"], priority=options.get("priority", "bulk"),
+                                 publish=bool(options.get("publish")))
+  get_batch_registry().add(BatchRun.from_record(record, jobs, **callbacks))
+
+
+@app.post("/batches", status_code=202)
+def submit_manifest_batch(body: ManifestBatchRequest, client: str = Depends(resolve_client)) -> JSONResponse:
+  """
+  Queues a batch of input references (s3:// URIs or paths under HPB_LOCAL_INPUT_ROOTS) and returns at
+  once. Cases enter the job queue ``chunk`` at a time; progress is at /batches/{id}, the index at the end.
+  """
+  priority = resolve_priority(body.priority, "bulk")
+  check_publish(body.publish)
+  if not body.publish and not get_result_store().enabled:
+    raise HTTPException(status_code=400, detail="Batch results need the result store (HPB_RESULT_MAX_GB > 0) or publish=true")
+  check_accepting()
+  check_budget(client)
+  try:
+    cases = manifest_cases(body)
   except ValueError as exc:
     raise HTTPException(status_code=400, detail=str(exc)) from exc
+  except Exception as exc:
+    raise HTTPException(status_code=502, detail=f"Cannot read manifest {body.manifest}: {exc}") from exc
+  params = {"folds": body.folds, "fast": body.fast}
+  run = BatchRun(
+    unique_case_id(prefix="batch"), cases,
+    chunk=body.chunk or settings.batch_chunk, client=client, params=params,
+    options={"priority": priority, "publish": body.publish},
+    **manifest_callbacks(params, client=client, priority=priority, publish=body.publish),
+  )
+  get_batch_registry().add(run)
+  return JSONResponse(
+    {"batch_id": run.batch_id, "cases": len(cases), "status_url": f"/batches/{run.batch_id}"}, status_code=202,
+  )
+
+
+def batch_run(batch_id: str, client: Optional[str] = None) -> BatchRun:
+  """The batch, which must belong to ``client`` when given; another client's batch is reported as unknown."""
+  run = get_batch_registry().get(batch_id)
+  if run is None or (client is not None and run.client != client):
+    raise HTTPException(status_code=404, detail=f"Unknown batch {batch_id}")
+  return run
+
+
+@app.get("/batches")
+def list_manifest_batches(client: str = Depends(resolve_client)) -> JSONResponse:
+  return JSONResponse({"batches": [run.describe() for run in get_batch_registry().all() if run.client == client]})
+
+
+@app.get("/batches/{batch_id}")
+def manifest_batch_status(batch_id: str, status: Optional[str] = None, offset: int = 0, limit: int = 100,
+                          client: str = Depends(resolve_client)) -> JSONResponse:
+  """Progress and a page of cases, optionally only those with ``status`` (e.g. ``failed`` or ``done``)."""
+  run = batch_run(batch_id, client)
+  cases = [case for case in run.cases if status is None or case.status == status]
+  return JSONResponse({
+    **run.describe(),
+    "matching": len(cases),
+    "cases": [vars(case) for case in cases[offset:offset + max(0, min(limit, 1000))]],
+  })
 
-  if len(case_dirs) > settings.max_batch_cases:
-    raise HTTPException(status_code=400, detail=f"Too many cases (>{settings.max_batch_cases})")
-
-  manifest: List[dict] = []
-
-  for case_dir in case_dirs:
-    case_id = case_dir.name
-    with temp_case_dirs(case_id) as dirs:
-      in_dir, out_dir = dirs["in"], dirs["out"]
-
-      raw_source = case_dir / "raw.nii.gz"
-      raw0000_source = case_dir / "raw_0000.nii.gz"
-      if not raw_source.exists() and raw0000_source.exists():
-        raw_source = raw0000_source
-      if not raw_source.exists():
-        raise HTTPException(status_code=400, detail=f"Case {case_id} missing raw.nii.gz")
-
-      raw_ct = in_dir / f"{case_id}.nii.gz"
-      ct_v1 = in_dir / f"{case_id}_0000.nii.gz"
-      data = raw_source.read_bytes()
-      raw_ct.write_bytes(data)
-      ct_v1.write_bytes(data)
-
-      liver_dir = out_dir / "totalseg"
-      task_dir = out_dir / "task008"
-      liver_dir.mkdir(parents=True, exist_ok=True)
-      task_dir.mkdir(parents=True, exist_ok=True)
-
-      try:
-        with Timer() as timer_liver:
-          liver_path = totalseg_liver_only(raw_ct, liver_dir, fast=fast)
-        with Timer() as timer_task008:
-          task008_path = nnunet_v1_task008(in_dir, task_dir, case_id=case_id, folds=folds)
-      except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Batch case {case_id} failed: {exc}") from exc
-
-      metadata = {
-        "case_id": case_id,
-        "labels_task008": {"1": "hepatic_vessels", "2": "liver_tumors"},
-        "liver_seconds": round(timer_liver.duration, 2),
-        "task008_seconds": round(timer_task008.duration, 2),
-        "timestamp": time.time(),
-      }
 
-      pkg_dir = prepare_package(out_dir, liver_mask=liver_path, task008_mask=task008_path, metadata=metadata)
-      dest_dir = batch_root / case_id
-      if dest_dir.exists():
-        shutil.rmtree(dest_dir)
-      shutil.copytree(pkg_dir, dest_dir)
-      manifest.append(metadata)
+@app.get("/batches/{batch_id}/index")
+def manifest_batch_index(batch_id: str, client: str = Depends(resolve_client)):
+  """The final index (every case with its status, job id and result URL); 202 with progress until then."""
+  run = get_batch_registry().get(batch_id)
+  if run is not None and run.finished_at is None:
+    return JSONResponse(batch_run(batch_id, client).describe(), status_code=202)
+  path = settings.result_root / "batches" / f"{batch_id}.json"
+  # The index records its client, so ownership holds after a restart has emptied the registry.
+  if not CASE_ID.fullmatch(batch_id) or not path.exists() or json.loads(path.read_text()).get("client") != client:
+    raise HTTPException(status_code=404, detail=f"Unknown batch {batch_id}")
+  return FileResponse(path, media_type="application/json", filename=f"{batch_id}_index.json")
 
-  manifest_path = batch_root / "manifest.json"
-  write_metadata(manifest_path, {"batch_id": batch_id, "cases": manifest})
 
-  consolidated = package_outputs(batch_root, base_name=batch_id)
-  return FileResponse(consolidated, media_type="application/zip", filename=f"{batch_id}_batch.zip")
+@app.delete("/batches/{batch_id}")
+def cancel_manifest_batch(batch_id: str, client: str = Depends(resolve_client)) -> JSONResponse:
+  """Stops queuing further cases; cases already queued still finish and are stored."""
+  run = batch_run(batch_id, client)
+  run.cancel()
+  return JSONResponse(run.describe())
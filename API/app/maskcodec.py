@@ -0,0 +1,141 @@
+"""
+Compact label-mask format (``.hpbm``). Each label is cropped to its bounding box and stored as
+bit-packed voxels or as run lengths, whichever is smaller, then compressed with zstd (zlib if
+``zstandard`` is not installed). A small JSON header carries the grid and geometry, so decoding
+gives back the label map voxel for voxel.
+
+Layout: ``MAGIC``, uint32 LE header length, header JSON, then the per-label blobs at the offsets
+the header lists. This module needs only numpy (and zstandard for zstd files), so clients can
+copy it as-is; ``scripts/decode_mask.py`` converts .hpbm back to NIfTI.
+"""
+import json
+import struct
+import zlib
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+MAGIC = b"HPBMASK1"
+VERSION = 1
+SUFFIX = ".hpbm"
+MEDIA_TYPE = "application/vnd.hpb.mask"
+ZSTD_LEVEL = 10
+ZLIB_LEVEL = 9
+
+
+def _compressor() -> Tuple[str, Any]:
+  try:
+    import zstandard  # type: ignore
+  except ImportError:
+    return "zlib", lambda data: zlib.compress(data, ZLIB_LEVEL)
+  return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+
+
+def _decompress(codec: str, data: bytes, size: int) -> bytes:
+  if codec == "zlib":
+    return zlib.decompress(data)
+  if codec == "zstd":
+    import zstandard  # type: ignore
+
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+  raise ValueError(f"Unknown mask codec {codec}")
+
+
+def _runs(flat) -> "Any":
+  """Run lengths of alternating 0/1 voxels, starting with a (possibly empty) run of zeros."""
+  import numpy as np
+
+  changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+  bounds = np.concatenate(([0], changes, [flat.size]))
+  runs = np.diff(bounds).astype("<u4")
+  return np.concatenate((np.zeros(1, "<u4"), runs)) if flat[0] else runs
+
+
+def _bounding_boxes(labels, counts) -> List[Tuple[int, List[int]]]:
+  """(value, [z0, z1, y0, y1, x0, x1]) for every label present, from one pass over the volume."""
+  import numpy as np
+
+  present = [int(v) for v in np.flatnonzero(counts) if v != 0]
+  try:
+    from scipy import ndimage  # type: ignore
+  except ImportError:
+    boxes = []
+    for value in present:
+      hits = np.nonzero(labels == value)
+      boxes.append((value, [int(v) for axis in hits for v in (axis.min(), axis.max() + 1)]))
+    return boxes
+  objects = ndimage.find_objects(labels)
+  return [(value, [int(v) for axis in objects[value - 1] for v in (axis.start, axis.stop)]) for value in present]
+
+
+def encode(labels, spacing: Sequence[float], origin: Sequence[float], direction: Sequence[float]) -> bytes:
+  """``labels`` is a (z, y, x) integer array; geometry is in (x, y, z) as SimpleITK reports it."""
+  import numpy as np
+
+  if labels.dtype.kind not in "iu" or (labels.size and labels.min() < 0):
+    raise ValueError("Label maps must hold non-negative integers")
+  codec, compress = _compressor()
+  entries: List[Dict[str, Any]] = []
+  blobs: List[bytes] = []
+  offset = 0
+  counts = np.bincount(labels.ravel()) if labels.size else np.zeros(1, dtype=np.intp)
+  for value, bbox in _bounding_boxes(labels, counts):
+    z0, z1, y0, y1, x0, x1 = bbox
+    flat = (labels[z0:z1, y0:y1, x0:x1] == value).ravel()
+    runs = _runs(flat)
+    if runs.nbytes < (flat.size + 7) // 8:
+      encoding, raw = "runs", runs.tobytes()
+    else:
+      encoding, raw = "bits", np.packbits(flat).tobytes()
+    blob = compress(raw)
+    entries.append({
+      "value": int(value), "bbox": bbox, "voxels": int(counts[value]), "encoding": encoding,
+      "offset": offset, "length": len(blob), "raw_bytes": len(raw),
+    })
+    blobs.append(blob)
+    offset += len(blob)
+  header = json.dumps({
+    "version": VERSION,
+    "shape": [int(n) for n in labels.shape],
+    "dtype": labels.dtype.str,
+    "spacing": [float(v) for v in spacing],
+    "origin": [float(v) for v in origin],
+    "direction": [float(v) for v in direction],
+    "codec": codec,
+    "labels": entries,
+  }, separators=(",", ":")).encode()
+  return MAGIC + struct.pack("<I", len(header)) + header + b"".join(blobs)
+
+
+def read_header(data: bytes) -> Tuple[Dict[str, Any], int]:
+  """The header dict and the offset of the first label blob."""
+  if data[:len(MAGIC)] != MAGIC:
+    raise ValueError("Not an .hpbm mask")
+  (length,) = struct.unpack_from("<I", data, len(MAGIC))
+  start = len(MAGIC) + 4
+  header = json.loads(data[start:start + length])
+  if header.get("version") != VERSION:
+    raise ValueError(f"Unsupported .hpbm version {header.get('version')}")
+  return header, start + length
+
+
+def decode(data: bytes, values: Optional[Sequence[int]] = None) -> Tuple[Any, Dict[str, Any]]:
+  """Returns the (z, y, x) label array and the header; ``values`` limits decoding to those labels."""
+  import numpy as np
+
+  header, base = read_header(data)
+  labels = np.zeros(header["shape"], dtype=np.dtype(header["dtype"]))
+  for entry in header["labels"]:
+    if values is not None and entry["value"] not in values:
+      continue
+    z0, z1, y0, y1, x0, x1 = entry["bbox"]
+    shape = (z1 - z0, y1 - y0, x1 - x0)
+    count = shape[0] * shape[1] * shape[2]
+    blob = data[base + entry["offset"]: base + entry["offset"] + entry["length"]]
+    raw = _decompress(header["codec"], blob, entry["raw_bytes"])
+    if entry["encoding"] == "runs":
+      runs = np.frombuffer(raw, dtype="<u4")
+      flat = np.repeat(np.arange(runs.size) % 2 == 1, runs)
+    else:
+      flat = np.unpackbits(np.frombuffer(raw, dtype=np.uint8), count=count).astype(bool)
+    region = labels[z0:z1, y0:y1, x0:x1]
+    region[flat.reshape(shape)] = entry["value"]
+  return labels, header
@@ -0,0 +1,123 @@
+"""Minimal Prometheus-style metrics registry exposed on GET /metrics."""
+import bisect
+import threading
+from typing import Callable, Dict, List, Sequence, Tuple
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def label_key(labels: Dict[str, str]) -> LabelKey:
+  return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt(labels: LabelKey, extra: Sequence[Tuple[str, str]] = ()) -> str:
+  pairs = list(labels) + list(extra)
+  if not pairs:
+    return ""
+  return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Counter:
+  def __init__(self, name: str, help_text: str) -> None:
+    self.name = name
+    self.help = help_text
+    self._values: Dict[LabelKey, float] = {}
+    self._lock = threading.Lock()
+
+  def inc(self, amount: float = 1.0, **labels: str) -> None:
+    key = label_key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0.0) + amount
+
+  def render(self) -> List[str]:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+    with self._lock:
+      for key, value in sorted(self._values.items()):
+        lines.append(f"{self.name}{_fmt(key)} {value}")
+    return lines
+
+
+class Gauge:
+  """Gauge whose samples are produced by a callback at scrape time."""
+
+  def __init__(self, name: str, help_text: str, collect: Callable[[], Dict[LabelKey, float]]) -> None:
+    self.name = name
+    self.help = help_text
+    self.collect = collect
+
+  def render(self) -> List[str]:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+    for key, value in sorted(self.collect().items()):
+      lines.append(f"{self.name}{_fmt(key)} {value}")
+    return lines
+
+
+class Histogram:
+  def __init__(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+    self.name = name
+    self.help = help_text
+    self.buckets = tuple(sorted(buckets))
+    self._series: Dict[LabelKey, List[float]] = {}
+    self._sums: Dict[LabelKey, float] = {}
+    self._lock = threading.Lock()
+
+  def observe(self, value: float, **labels: str) -> None:
+    key = label_key(labels)
+    with self._lock:
+      counts = self._series.setdefault(key, [0.0] * (len(self.buckets) + 1))
+      counts[bisect.bisect_left(self.buckets, value)] += 1
+      self._sums[key] = self._sums.get(key, 0.0) + value
+
+  def render(self) -> List[str]:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+    with self._lock:
+      for key, counts in sorted(self._series.items()):
+        running = 0.0
+        for bound, count in zip(self.buckets, counts):
+          running += count
+          lines.append(f"{self.name}_bucket{_fmt(key, [('le', str(bound))])} {running}")
+        running += counts[-1]
+        lines.append(f"{self.name}_bucket{_fmt(key, [('le', '+Inf')])} {running}")
+        lines.append(f"{self.name}_sum{_fmt(key)} {self._sums[key]}")
+        lines.append(f"{self.name}_count{_fmt(key)} {running}")
+    return lines
+
+
+class Registry:
+  def __init__(self) -> None:
+    self._metrics: list = []
+
+  def register(self, metric):
+    self._metrics.append(metric)
+    return metric
+
+  def counter(self, name: str, help_text: str) -> Counter:
+    return self.register(Counter(name, help_text))
+
+  def histogram(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return self.register(Histogram(name, help_text, buckets))
+
+  def gauge(self, name: str, help_text: str, collect: Callable[[], Dict[LabelKey, float]]) -> Gauge:
+    return self.register(Gauge(name, help_text, collect))
+
+  def render(self) -> str:
+    lines: List[str] = []
+    for metric in self._metrics:
+      lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+JOBS_TOTAL = REGISTRY.counter("hpb_jobs_total", "Finished jobs by kind, priority class and status")
+QUEUE_WAIT = REGISTRY.histogram("hpb_queue_wait_seconds", "Time jobs spent queued before a worker claimed them")
+PREEMPTIONS = REGISTRY.counter("hpb_preemptions_total", "Bulk jobs paused at a stage boundary for interactive work")
+CLIENT_COMPUTE = REGISTRY.counter("hpb_client_compute_seconds_total", "Inference seconds used per client")
+CLIENT_THROTTLED = REGISTRY.counter("hpb_client_throttled_total", "Requests rejected because the client's compute budget was spent")
+INPUT_REJECTED = REGISTRY.counter("hpb_input_rejected_total", "Uploads rejected by validation, by reason")
+S3_PUBLISHED_BYTES = REGISTRY.counter("hpb_s3_published_bytes_total", "Result bytes uploaded to the assets bucket")
+PACKAGE_SECONDS = REGISTRY.histogram("hpb_package_seconds", "Time spent packaging a result (links + zip)",
+                                     buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+PACKAGE_BYTES = REGISTRY.counter("hpb_package_bytes_total", "Bytes written to disk while packaging results")
@@ -0,0 +1,234 @@
+"""Registry of models kept resident in the API process, loaded on first use and evicted LRU."""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List
+
+from .config import get_settings
+
+TASK008_CHECKPOINT = "model_final_checkpoint"
+
+
+def task008_folder() -> Path:
+  results = Path(os.environ.get("RESULTS_FOLDER", "/models/nnunet_v1"))
+  return results / "nnUNet" / "3d_fullres" / "Task008_HepaticVessel" / "nnUNetTrainerV2__nnUNetPlansv2.1"
+
+
+def file_bytes(*paths: Path) -> int:
+  return sum(p.stat().st_size for p in paths if p.exists())
+
+
+def tensor_bytes(obj: Any) -> int:
+  """Bytes held by the tensors in a module, state dict or checkpoint; 0 when torch is absent."""
+  if hasattr(obj, "parameters") and callable(obj.parameters):
+    return sum(p.numel() * p.element_size() for p in obj.parameters())
+  if hasattr(obj, "numel") and hasattr(obj, "element_size"):
+    return obj.numel() * obj.element_size()
+  if isinstance(obj, dict):
+    return sum(tensor_bytes(v) for v in obj.values())
+  if isinstance(obj, (list, tuple)):
+    return sum(tensor_bytes(v) for v in obj)
+  return 0
+
+
+@dataclass
+class ModelSpec:
+  name: str
+  load: Callable[[], Any]
+  # Footprint guess before loading (used to make room); replaced by ``measure`` afterwards.
+  estimate_bytes: Callable[[], int]
+  measure: Callable[[Any], int] = tensor_bytes
+  # Models that are mutated during inference (e.g. fold weights swapped into one network)
+  # serve one job at a time.
+  exclusive: bool = False
+
+
+@dataclass
+class ResidentModel:
+  spec: ModelSpec
+  value: Any
+  bytes: int
+  loaded_at: float = field(default_factory=time.time)
+  last_used: float = field(default_factory=time.time)
+  pins: int = 0
+  hits: int = 0
+  load_seconds: float = 0.0
+  lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+class ModelRegistry:
+  """
+  Loads models lazily and keeps them until the memory budget is exceeded, then evicts the
+  least recently used ones. Models held by a running job (``acquire``) are pinned and never evicted.
+  """
+
+  def __init__(self, budget_bytes: int) -> None:
+    self.budget_bytes = budget_bytes
+    self._specs: Dict[str, ModelSpec] = {}
+    self._resident: Dict[str, ResidentModel] = {}
+    self._loading: Dict[str, threading.Event] = {}
+    self._lock = threading.Lock()
+    self.loads = 0
+    self.hits = 0
+    self.evictions = 0
+    self.over_budget = 0
+
+  def register(self, spec: ModelSpec) -> None:
+    self._specs[spec.name] = spec
+
+  def _resident_bytes(self) -> int:
+    return sum(model.bytes for model in self._resident.values())
+
+  def _evict_for(self, needed: int) -> None:
+    victims = sorted((m for m in self._resident.values() if m.pins == 0), key=lambda m: m.last_used)
+    for model in victims:
+      if self._resident_bytes() + needed <= self.budget_bytes:
+        return
+      del self._resident[model.spec.name]
+      self.evictions += 1
+      print(f"[models] evicted {model.spec.name} ({model.bytes / 1e9:.2f} GB)", flush=True)
+    if self._resident_bytes() + needed > self.budget_bytes:
+      # Everything left is pinned by running jobs; load anyway rather than fail the job.
+      self.over_budget += 1
+
+  def _get_pinned(self, name: str) -> ResidentModel:
+    spec = self._specs[name]
+    while True:
+      with self._lock:
+        model = self._resident.get(name)
+        if model is not None:
+          model.pins += 1
+          model.hits += 1
+          model.last_used = time.time()
+          self.hits += 1
+          return model
+        loading = self._loading.get(name)
+        if loading is None:
+          self._loading[name] = threading.Event()
+          self._evict_for(spec.estimate_bytes())
+          break
+      # Another thread is loading the same model; wait for it instead of loading twice.
+      loading.wait()
+
+    started = time.time()
+    try:
+      value = spec.load()
+    except BaseException:
+      with self._lock:
+        self._loading.pop(name).set()
+      raise
+    model = ResidentModel(spec=spec, value=value, bytes=spec.measure(value) or spec.estimate_bytes(), pins=1)
+    model.load_seconds = time.time() - started
+    print(f"[models] loaded {name} ({model.bytes / 1e9:.2f} GB) in {model.load_seconds:.1f}s", flush=True)
+    with self._lock:
+      self._resident[name] = model
+      self.loads += 1
+      self._evict_for(0)
+      self._loading.pop(name).set()
+    return model
+
+  @contextmanager
+  def acquire(self, name: str) -> Iterator[Any]:
+    """Yields the loaded model, pinned for the duration of the block."""
+    model = self._get_pinned(name)
+    try:
+      if model.spec.exclusive:
+        with model.lock:
+          yield model.value
+      else:
+        yield model.value
+    finally:
+      with self._lock:
+        model.pins -= 1
+        model.last_used = time.time()
+        if name in self._resident:
+          self._evict_for(0)
+
+  def evict(self, name: str) -> bool:
+    with self._lock:
+      model = self._resident.get(name)
+      if model is None or model.pins:
+        return False
+      del self._resident[name]
+      self.evictions += 1
+      return True
+
+  def stats(self) -> Dict[str, Any]:
+    with self._lock:
+      resident: List[Dict[str, Any]] = [
+        {
+          "name": name,
+          "gb": round(model.bytes / 1e9, 3),
+          "pins": model.pins,
+          "hits": model.hits,
+          "load_seconds": round(model.load_seconds, 2),
+          "loaded_at": model.loaded_at,
+          "last_used": model.last_used,
+        }
+        for name, model in sorted(self._resident.items(), key=lambda item: -item[1].last_used)
+      ]
+      lookups = self.loads + self.hits
+      return {
+        "enabled": get_settings().resident_models,
+        "budget_gb": round(self.budget_bytes / 1e9, 2),
+        "resident_gb": round(self._resident_bytes() / 1e9, 3),
+        "resident": resident,
+        "registered": sorted(self._specs),
+        "loads": self.loads,
+        "hits": self.hits,
+        "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        "evictions": self.evictions,
+        "over_budget_loads": self.over_budget,
+      }
+
+
+def _load_task008_trainer() -> Any:
+  from nnunet.training.model_restore import restore_model  # type: ignore
+
+  folder = task008_folder()
+  trainer = restore_model(str(folder / "fold_0" / f"{TASK008_CHECKPOINT}.model.pkl"), fp16=True)
+  trainer.output_folder = str(folder)
+  trainer.output_folder_base = str(folder)
+  trainer.update_fold(0)
+  trainer.initialize(False)
+  return trainer
+
+
+def _load_task008_fold(fold: int) -> Callable[[], Any]:
+  def load() -> Any:
+    import torch  # type: ignore
+
+    return torch.load(str(task008_folder() / f"fold_{fold}" / f"{TASK008_CHECKPOINT}.model"), map_location="cpu")
+
+  return load
+
+
+def register_task008(registry: ModelRegistry) -> None:
+  """Task008 is kept as one network plus per-fold weights that are swapped in for each fold."""
+  folder = task008_folder()
+  registry.register(ModelSpec(
+    name="task008/network",
+    load=_load_task008_trainer,
+    estimate_bytes=lambda: file_bytes(folder / "fold_0" / f"{TASK008_CHECKPOINT}.model"),
+    measure=lambda trainer: tensor_bytes(trainer.network),
+    exclusive=True,
+  ))
+  for fold in range(5):
+    path = folder / f"fold_{fold}" / f"{TASK008_CHECKPOINT}.model"
+    registry.register(ModelSpec(
+      name=f"task008/fold_{fold}",
+      load=_load_task008_fold(fold),
+      estimate_bytes=lambda path=path: file_bytes(path),
+      measure=lambda checkpoint: tensor_bytes(checkpoint.get("state_dict", checkpoint)),
+    ))
+
+
+@lru_cache
+def get_model_registry() -> ModelRegistry:
+  registry = ModelRegistry(int(get_settings().resident_budget_gb * 1e9))
+  register_task008(registry)
+  return registry
@@ -0,0 +1,136 @@
+import struct
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Dict, Tuple
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# NIfTI datatype code -> (numpy dtype string, bytes per voxel)
+DATATYPES: Dict[int, Tuple[str, int]] = {
+  2: ("u1", 1),
+  4: ("i2", 2),
+  8: ("i4", 4),
+  16: ("f4", 4),
+  64: ("f8", 8),
+  256: ("i1", 1),
+  512: ("u2", 2),
+  768: ("u4", 4),
+  1024: ("i8", 8),
+  1280: ("u8", 8),
+}
+
+
+class NiftiError(ValueError):
+  pass
+
+
+@dataclass
+class NiftiHeader:
+  version: int
+  endian: str
+  shape: Tuple[int, ...]
+  spacing: Tuple[float, ...]
+  datatype: int
+  bitpix: int
+  vox_offset: int
+  scl_slope: float
+  scl_inter: float
+
+  @property
+  def voxels(self) -> int:
+    total = 1
+    for n in self.shape:
+      total *= n
+    return total
+
+  @property
+  def dtype(self) -> str:
+    if self.datatype not in DATATYPES:
+      raise NiftiError(f"Unsupported NIfTI datatype {self.datatype}")
+    return self.endian + DATATYPES[self.datatype][0]
+
+  @property
+  def data_bytes(self) -> int:
+    return self.voxels * max(1, self.bitpix // 8)
+
+  @property
+  def extent_mm(self) -> Tuple[float, ...]:
+    return tuple(n * s for n, s in zip(self.shape[:3], self.spacing[:3]))
+
+  def features(self) -> Dict[str, float]:
+    return {
+      "nx": self.shape[0] if len(self.shape) > 0 else 1,
+      "ny": self.shape[1] if len(self.shape) > 1 else 1,
+      "nz": self.shape[2] if len(self.shape) > 2 else 1,
+      "sx": self.spacing[0] if len(self.spacing) > 0 else 1.0,
+      "sy": self.spacing[1] if len(self.spacing) > 1 else 1.0,
+      "sz": self.spacing[2] if len(self.spacing) > 2 else 1.0,
+      "datatype": self.datatype,
+      "bitpix": self.bitpix,
+    }
+
+
+def parse_header(raw: bytes) -> NiftiHeader:
+  """Parses a NIfTI-1 or NIfTI-2 header from the first bytes of an uncompressed stream."""
+  if len(raw) < NIFTI1_HEADER_SIZE:
+    raise NiftiError("File too short for a NIfTI header")
+  for endian in ("<", ">"):
+    sizeof_hdr = struct.unpack(f"{endian}i", raw[:4])[0]
+    if sizeof_hdr == NIFTI1_HEADER_SIZE:
+      dim = struct.unpack(f"{endian}8h", raw[40:56])
+      datatype, bitpix = struct.unpack(f"{endian}2h", raw[70:74])
+      pixdim = struct.unpack(f"{endian}8f", raw[76:108])
+      vox_offset = struct.unpack(f"{endian}f", raw[108:112])[0]
+      scl_slope, scl_inter = struct.unpack(f"{endian}2f", raw[112:120])
+      version = 1
+      break
+    if sizeof_hdr == NIFTI2_HEADER_SIZE:
+      if len(raw) < NIFTI2_HEADER_SIZE:
+        raise NiftiError("File too short for a NIfTI-2 header")
+      datatype, bitpix = struct.unpack(f"{endian}2h", raw[12:16])
+      dim = struct.unpack(f"{endian}8q", raw[16:80])
+      pixdim = struct.unpack(f"{endian}8d", raw[104:168])
+      vox_offset = struct.unpack(f"{endian}q", raw[168:176])[0]
+      scl_slope, scl_inter = struct.unpack(f"{endian}2d", raw[176:192])
+      version = 2
+      break
+  else:
+    raise NiftiError("Not a NIfTI file (bad sizeof_hdr)")
+
+  ndim = dim[0]
+  if not 1 <= ndim <= 7:
+    raise NiftiError(f"Invalid NIfTI dimension count {ndim}")
+  return NiftiHeader(
+    version=version,
+    endian=endian,
+    shape=tuple(int(n) for n in dim[1:ndim + 1]),
+    spacing=tuple(abs(float(s)) for s in pixdim[1:ndim + 1]),
+    datatype=int(datatype),
+    bitpix=int(bitpix),
+    vox_offset=int(vox_offset),
+    scl_slope=float(scl_slope),
+    scl_inter=float(scl_inter),
+  )
+
+
+def read_header_stream(stream: BinaryIO, *, limit: int = NIFTI2_HEADER_SIZE) -> NiftiHeader:
+  """Reads just enough of a (possibly gzipped) stream to parse its header; never reads the voxel data."""
+  first = stream.read(2)
+  if first == b"\x1f\x8b":
+    inflater = zlib.decompressobj(wbits=31)
+    raw = inflater.decompress(first, limit)
+    while len(raw) < limit:
+      chunk = stream.read(4096)
+      if not chunk:
+        break
+      raw += inflater.decompress(inflater.unconsumed_tail + chunk, limit - len(raw))
+  else:
+    raw = first + stream.read(limit - len(first))
+  return parse_header(raw)
+
+
+def read_header(path: Path) -> NiftiHeader:
+  with path.open("rb") as f:
+    return read_header_stream(f)
@@ -0,0 +1,65 @@
+"""
+Parallel gzip for the NIfTI files the service writes. The input is cut into fixed blocks, and each
+block is deflated as its own gzip member on a shared thread pool (zlib releases the GIL). The
+members are written in order. Concatenated members make a standard multi-member gzip stream, which
+gzip, zlib, ITK/SimpleITK, nibabel and ingest.py all read as one file.
+"""
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, Deque, Optional
+
+from .config import get_settings
+
+BLOCK_BYTES = 4 * 1024 * 1024
+
+
+def gzip_threads() -> int:
+  return get_settings().gzip_threads or min(16, os.cpu_count() or 4)
+
+
+@lru_cache
+def get_gzip_pool() -> ThreadPoolExecutor:
+  return ThreadPoolExecutor(max_workers=gzip_threads(), thread_name_prefix="hpb-gzip")
+
+
+def compress_member(block: bytes, level: int) -> bytes:
+  deflater = zlib.compressobj(level, zlib.DEFLATED, 31)
+  return deflater.compress(block) + deflater.flush()
+
+
+def compress_stream(source: BinaryIO, out: BinaryIO, *, level: Optional[int] = None) -> int:
+  """Gzips ``source`` into ``out`` with up to two blocks per thread in flight; returns the bytes written."""
+  level = get_settings().gzip_level if level is None else level
+  threads = gzip_threads()
+  written = 0
+  if threads <= 1:
+    while block := source.read(BLOCK_BYTES):
+      written += out.write(compress_member(block, level))
+    return written or out.write(compress_member(b"", level))
+  pool = get_gzip_pool()
+  pending: Deque = deque()
+  while block := source.read(BLOCK_BYTES):
+    pending.append(pool.submit(compress_member, block, level))
+    if len(pending) >= 2 * threads:
+      written += out.write(pending.popleft().result())
+  while pending:
+    written += out.write(pending.popleft().result())
+  return written or out.write(compress_member(b"", level))
+
+
+def compress_file(source: Path, target: Path, *, level: Optional[int] = None, remove_source: bool = False) -> Path:
+  """Writes ``target`` as the gzip of ``source`` (atomically); ``remove_source`` deletes the input afterwards."""
+  tmp = target.with_name(f".{target.name}.tmp")
+  try:
+    with source.open("rb") as src, tmp.open("wb") as out:
+      compress_stream(src, out, level=level)
+    os.replace(tmp, target)
+  finally:
+    tmp.unlink(missing_ok=True)
+  if remove_source:
+    source.unlink(missing_ok=True)
+  return target
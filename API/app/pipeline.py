@@ -0,0 +1,320 @@
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import maskcodec
+from .cache import get_result_cache
+from .config import get_settings
+from .ingest import uncompressed_path
+from .metrics import PACKAGE_BYTES, PACKAGE_SECONDS
+from .planner import TASK008_LABELS, MergePlan, plan_merge, plan_structures
+from .runners import (
+  assemble_label_map,
+  crop_to_mask,
+  nnunet_v1_task008,
+  nnunet_v1_task008_resident,
+  paste_mask,
+  prepare_package,
+  totalseg_liver_only,
+  totalseg_multilabel,
+  totalseg_roi_subset,
+)
+from .utils import PeakMemory, Timer, link_or_copy, log_execution, package_outputs
+from .volumes import VolumeExchange, nifti_suffix, read_volume, with_nifti_suffix, write_compact, write_volume
+
+JOB_KINDS = ("task008", "liver", "totalseg", "both", "structures")
+
+RESULT_MEDIA_TYPES = {
+  "task008": "application/gzip",
+  "liver": "application/gzip",
+  "totalseg": "application/gzip",
+  "both": "application/zip",
+  "structures": "application/gzip",
+}
+
+
+class Preempted(Exception):
+  """Raised at a stage boundary when the scheduler asks a job to yield its slot."""
+
+
+# "compact" returns label maps as .hpbm (see maskcodec.py) instead of .nii.gz.
+MASK_FORMATS = ("nifti", "compact")
+
+
+def result_filename(kind: str, case_id: str, mask_format: str = "nifti") -> str:
+  if kind == "both":
+    return f"{case_id}_results.zip"
+  return f"{case_id}_{kind}{maskcodec.SUFFIX if mask_format == 'compact' else '.nii.gz'}"
+
+
+def result_media_type(kind: str, mask_format: str = "nifti") -> str:
+  if kind != "both" and mask_format == "compact":
+    return maskcodec.MEDIA_TYPE
+  return RESULT_MEDIA_TYPES[kind]
+
+
+def decoded_input(ct_path: Path) -> Path:
+  """The uncompressed copy written while the upload streamed in, if there is one (see ingest.py)."""
+  decoded = uncompressed_path(ct_path)
+  return decoded if decoded.exists() else ct_path
+
+
+def execute(kind: str, ct_path: Path, work_dir: Path, *, case_id: str, params: Dict[str, Any],
+            content_hash: Optional[str] = None,
+            should_yield: Optional[Callable[[], bool]] = None,
+            checkpoint: Optional[Callable[[str], Dict[str, int]]] = None) -> Tuple[Path, Dict[str, Any]]:
+  """
+  Runs one job kind against ``ct_path`` using ``work_dir`` as scratch.
+  Returns the artifact to hand back to the client plus job metadata.
+  Stage outputs are served from the node-local result cache when ``content_hash`` is known,
+  which is also what lets a job preempted via ``should_yield`` resume without redoing stages.
+  ``checkpoint`` is called after each stage with its name and returns the job's scratch usage (see scratch.py).
+  In-process steps hand volumes to each other as in-memory arrays (see volumes.py).
+  """
+  with VolumeExchange() as volumes:
+    return _execute(kind, ct_path, work_dir, volumes, case_id=case_id, params=params, content_hash=content_hash,
+                    should_yield=should_yield, checkpoint=checkpoint)
+
+
+def _execute(kind: str, ct_path: Path, work_dir: Path, volumes: VolumeExchange, *, case_id: str,
+             params: Dict[str, Any], content_hash: Optional[str],
+             should_yield: Optional[Callable[[], bool]],
+             checkpoint: Optional[Callable[[str], Dict[str, int]]]) -> Tuple[Path, Dict[str, Any]]:
+  in_dir = work_dir / "in"
+  out_dir = work_dir / "out"
+  in_dir.mkdir(parents=True, exist_ok=True)
+  out_dir.mkdir(parents=True, exist_ok=True)
+  fast = bool(params.get("fast", False))
+  folds = str(params.get("folds", "0"))
+  cache = get_result_cache()
+  cache_stats = {"hits": 0, "misses": 0}
+  task008 = nnunet_v1_task008_resident if get_settings().resident_models else nnunet_v1_task008
+  # TotalSegmentator and the SimpleITK steps read the uncompressed volume instead of gunzipping
+  # the upload again; nnU-Net v1 still expects the .nii.gz it was given.
+  source_ct = decoded_input(ct_path)
+  compact = params.get("mask_format") == "compact"
+  compact_bytes: Dict[str, Dict[str, int]] = {}
+
+  def compact_mask(name: str, mask: Path, target: Path) -> Path:
+    """The .hpbm form of a final mask, with its size next to the .nii.gz it replaces."""
+    output = write_compact(volumes.load(name, mask), target)
+    compact_bytes[output.name] = {"bytes": output.stat().st_size, "nifti_bytes": mask.stat().st_size}
+    return output
+
+  def mask_metadata() -> Dict[str, Any]:
+    return {"mask_format": {"format": "compact", "artifacts": compact_bytes}} if compact else {}
+
+  # Per-stage timings and peak memory feed the coordinator's cost model (see costmodel.py).
+  # DICOM uploads are converted when they arrive; that counts as the first stage.
+  stages: List[Dict[str, Any]] = [dict(params["conversion"])] if params.get("conversion") else []
+
+  def stage(name: str, stage_params: Dict[str, Any], target: Path, produce) -> Tuple[Path, float]:
+    with Timer() as timer, PeakMemory() as memory:
+      output, hit = cache.fetch_or_run(content_hash, name, stage_params, target, produce)
+    cache_stats["hits" if hit else "misses"] += 1
+    stages.append({
+      "stage": name,
+      "params": stage_params,
+      "seconds": round(timer.duration, 3),
+      "peak_rss_bytes": memory.peak_bytes,
+      "cached": hit,
+    })
+    if checkpoint is not None:
+      stages[-1]["scratch"] = checkpoint(name)
+    log_execution(f"{name}:{case_id}{' (cached)' if hit else ''}", timer.duration)
+    return output, timer.duration
+
+  def run_task008(task_in: Path, task_out: Path, *, liver_mask: Optional[Path] = None,
+                  liver_label: Optional[int] = None, liver_params: Optional[Dict[str, Any]] = None,
+                  final: bool = True) -> Tuple[Path, float]:
+    """
+    ``final=False`` when the mask only feeds later steps: a pasted crop is then kept as plain .nii.
+    ``liver_params`` are the stage params of the run that produced ``liver_mask``.
+    """
+    crop = bool(params.get("crop", False)) and liver_mask is not None
+    target = task_out / f"{case_id}{'.nii.gz' if final else '.nii'}"
+
+    def produce() -> Path:
+      if crop:
+        # Cascade: run Task008 on the liver bounding box only, then paste back into the full grid.
+        # The CT and liver mask are read once; only the crop nnU-Net reads is written out.
+        crop_in = work_dir / "crop_in"
+        crop_out = work_dir / "crop_out"
+        ct = volumes.load("ct", source_ct)
+        region = crop_to_mask(ct, volumes.load("liver", liver_mask), crop_in / f"{case_id}_0000.nii.gz",
+                              label=liver_label)
+        if region is not None:
+          cropped = read_volume(task008(crop_in, crop_out, case_id=case_id, folds=folds))
+          pasted = volumes.put("task008", paste_mask(cropped, ct, region[0]), source=target)
+          return write_volume(pasted, target)
+      return task008(task_in, task_out, case_id=case_id, folds=folds)
+
+    stage_params: Dict[str, Any] = {"folds": folds, "crop": crop}
+    if crop:
+      # A cropped result depends on the liver mask the crop came from (fast vs full TotalSegmentator).
+      stage_params["liver"] = liver_params
+    if task008 is nnunet_v1_task008_resident:
+      # Kept apart from nnUNet_predict results: the in-process path is a separate implementation.
+      stage_params["runner"] = "resident"
+    output, seconds = stage("task008", stage_params, target, produce)
+    if final and nifti_suffix(output) != ".nii.gz":
+      # Cached by a run that only needed it as an intermediate.
+      output = write_volume(volumes.load("task008", output), with_nifti_suffix(output, ".nii.gz"))
+    return output, seconds
+
+  def run_liver(source: Path, liver_out: Path) -> Tuple[Path, float]:
+    return stage(
+      "liver", {"fast": fast}, liver_out / "liver.nii.gz",
+      lambda: totalseg_liver_only(source, liver_out, fast=fast),
+    )
+
+  def run_roi(roi_subset: List[str], roi_dir: Path) -> Path:
+    """One TotalSegmentator --roi_subset run as a label map, ``roi_subset[i]`` as label i + 1 (kept as plain .nii)."""
+
+    def produce_roi() -> Path:
+      masks = totalseg_roi_subset(source_ct, roi_dir, roi_subset, fast=fast)
+      labels = assemble_label_map(
+        volumes.load("ct", source_ct),
+        [(read_volume(masks[name]), {1: index + 1}) for index, name in enumerate(roi_subset)],
+      )
+      target = roi_dir / "roi_labels.nii"
+      return write_volume(volumes.put("roi_labels", labels, source=target), target)
+
+    roi_labels, _ = stage("totalseg", {"fast": fast, "roi_subset": roi_subset}, roi_dir / "roi_labels.nii", produce_roi)
+    return roi_labels
+
+  if kind == "task008":
+    link_or_copy(ct_path, in_dir / f"{case_id}_0000.nii.gz")
+    output_path, seconds = run_task008(in_dir, out_dir)
+    if compact:
+      output_path = compact_mask("task008", output_path, work_dir / result_filename(kind, case_id, "compact"))
+    return output_path, {"task008_seconds": round(seconds, 2), "cache": cache_stats, "stages": stages, **mask_metadata()}
+
+  if kind == "liver":
+    output_path, seconds = run_liver(source_ct, out_dir)
+    if compact:
+      output_path = compact_mask("liver", output_path, work_dir / result_filename(kind, case_id, "compact"))
+    return output_path, {"liver_seconds": round(seconds, 2), "cache": cache_stats, "stages": stages, **mask_metadata()}
+
+  if kind == "totalseg":
+    output_path, seconds = stage(
+      "totalseg", {"fast": fast}, out_dir / "segmentations.nii.gz",
+      lambda: totalseg_multilabel(source_ct, out_dir, fast=fast),
+    )
+    if compact:
+      output_path = compact_mask("totalseg", output_path, work_dir / result_filename(kind, case_id, "compact"))
+    return output_path, {"totalseg_seconds": round(seconds, 2), "cache": cache_stats, "stages": stages, **mask_metadata()}
+
+  if kind == "structures":
+    # One TotalSegmentator run limited to the models holding the requested organs, Task008 only
+    # if vessels/tumours were asked for, then a single label map in request order.
+    plan = plan_structures(params.get("structures"), crop=bool(params.get("crop", False)))
+    label_of = {name: int(value) for value, name in plan.labels().items()}
+    layers = []
+    roi_labels = None
+    if plan.roi_subset:
+      roi_labels = run_roi(plan.roi_subset, out_dir / "totalseg")
+      layers.append((volumes.load("roi_labels", roi_labels), {
+        index + 1: label_of[name] for index, name in enumerate(plan.roi_subset) if name in label_of
+      }))
+    if plan.task008:
+      link_or_copy(ct_path, in_dir / f"{case_id}_0000.nii.gz")
+      task_dir = out_dir / "task008"
+      task_dir.mkdir(parents=True, exist_ok=True)
+      liver_label = plan.roi_subset.index("liver") + 1 if "liver" in plan.roi_subset else None
+      task008_path, _ = run_task008(
+        in_dir, task_dir, liver_mask=roi_labels if liver_label else None, liver_label=liver_label,
+        liver_params={"fast": fast, "roi_subset": plan.roi_subset}, final=False,
+      )
+      layers.append((volumes.load("task008", task008_path),
+                     {value: label_of[name] for name, value in TASK008_LABELS.items() if name in label_of}))
+    label_map = assemble_label_map(volumes.load("ct", source_ct), layers)
+    if compact:
+      # Encoded straight from memory; no .nii.gz is written at all.
+      output_path = write_compact(label_map, work_dir / result_filename(kind, case_id, "compact"))
+      compact_bytes[output_path.name] = {"bytes": output_path.stat().st_size}
+    else:
+      output_path = write_volume(label_map, work_dir / result_filename(kind, case_id))
+    return output_path, {
+      "labels": plan.labels(), "plan": plan.describe(), "cache": cache_stats, "stages": stages, **mask_metadata(),
+    }
+
+  def merged_labels(merge: MergePlan, liver_path: Path, task008_path: Path) -> Path:
+    """
+    The liver, Task008 and requested organ masks painted into one label map. Each structure is its
+    own layer, painted lowest precedence first so the highest one ends up on top where they overlap.
+    """
+    sources = {"liver": (volumes.load("liver", liver_path), 1)}
+    task008_mask = volumes.load("task008", task008_path)
+    sources.update({name: (task008_mask, value) for name, value in TASK008_LABELS.items()})
+    if merge.organs:
+      roi_subset = sorted(merge.organs)
+      roi_labels = volumes.load("roi_labels", run_roi(roi_subset, out_dir / "organs"))
+      sources.update({name: (roi_labels, roi_subset.index(name) + 1) for name in merge.organs})
+    label_of = {name: int(value) for value, name in merge.labels().items()}
+    label_map = assemble_label_map(
+      volumes.load("ct", source_ct),
+      [(sources[name][0], {sources[name][1]: label_of[name]}) for name in reversed(merge.precedence)],
+    )
+    if compact:
+      output = write_compact(label_map, out_dir / f"labels{maskcodec.SUFFIX}")
+      compact_bytes[output.name] = {"bytes": output.stat().st_size}
+      return output
+    return write_volume(label_map, out_dir / "labels.nii.gz")
+
+  if kind == "both":
+    raw_ct = link_or_copy(ct_path, in_dir / f"{case_id}.nii.gz")
+    link_or_copy(raw_ct, in_dir / f"{case_id}_0000.nii.gz")
+    liver_dir = out_dir / "totalseg"
+    task_dir = out_dir / "task008"
+    liver_dir.mkdir(parents=True, exist_ok=True)
+    task_dir.mkdir(parents=True, exist_ok=True)
+
+    liver_path, liver_seconds = run_liver(source_ct, liver_dir)
+    if should_yield is not None and content_hash and should_yield():
+      raise Preempted(f"{case_id} paused after liver stage")
+    merge = plan_merge(params.get("structures"), params.get("precedence")) if params.get("merged") else None
+    # A merged package ships one label map, so the Task008 mask is only an intermediate then.
+    task008_path, task008_seconds = run_task008(
+      in_dir, task_dir, liver_mask=liver_path, liver_params={"fast": fast}, final=merge is None,
+    )
+
+    metadata = {
+      "case_id": case_id,
+      "labels_task008": {"1": "hepatic_vessels", "2": "liver_tumors"},
+      "liver_seconds": round(liver_seconds, 2),
+      "task008_seconds": round(task008_seconds, 2),
+      "timestamp": time.time(),
+      "stages": stages,
+    }
+    if merge is not None:
+      masks = {"labels": merged_labels(merge, liver_path, task008_path)}
+      del metadata["labels_task008"]
+      metadata["labels"] = merge.labels()
+      metadata["merge"] = merge.describe()
+    elif compact:
+      masks = {
+        "liver": compact_mask("liver", liver_path, out_dir / f"liver{maskcodec.SUFFIX}"),
+        "task008": compact_mask("task008", task008_path, out_dir / f"task008{maskcodec.SUFFIX}"),
+      }
+    else:
+      masks = {"liver": liver_path, "task008": task008_path}
+    metadata.update(mask_metadata())
+    if params.get("auto_config"):
+      # actual_seconds is added by the queue that took the job (JobQueue.complete), on its own clock.
+      metadata["auto_config"] = {k: v for k, v in params["auto_config"].items() if k != "submitted_at"}
+    with Timer() as timer:
+      pkg_dir, written = prepare_package(out_dir, masks=masks, metadata=metadata)
+      archive_path = package_outputs(pkg_dir, base_name=case_id, dest_dir=work_dir)
+    packaging = {
+      "seconds": round(timer.duration, 3),
+      "bytes_written": written + archive_path.stat().st_size,
+      "archive_bytes": archive_path.stat().st_size,
+    }
+    if checkpoint is not None:
+      packaging["scratch"] = checkpoint("package")
+    PACKAGE_SECONDS.observe(timer.duration)
+    PACKAGE_BYTES.inc(packaging["bytes_written"])
+    return archive_path, {**metadata, "cache": cache_stats, "stages": stages, "packaging": packaging}
+
+  raise ValueError(f"Unknown job kind: {kind}")
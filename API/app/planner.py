@@ -0,0 +1,141 @@
+"""Maps a requested list of structures to the smallest set of model runs that produces them."""
+from dataclasses import dataclass
+from typing import Dict, List
+
+# TotalSegmentator v2 splits the 1.5 mm "total" task into five nnU-Net models; --roi_subset only
+# runs the models that contain a requested class. The 3 mm --fast model covers every class at once.
+TOTALSEG_PARTS: Dict[str, List[str]] = {
+  "organs": [
+    "spleen", "kidney_right", "kidney_left", "gallbladder", "liver", "stomach", "pancreas",
+    "adrenal_gland_right", "adrenal_gland_left", "lung_upper_lobe_left", "lung_lower_lobe_left",
+    "lung_upper_lobe_right", "lung_middle_lobe_right", "lung_lower_lobe_right", "esophagus", "trachea",
+    "thyroid_gland", "small_bowel", "duodenum", "colon", "urinary_bladder", "prostate",
+    "kidney_cyst_left", "kidney_cyst_right",
+  ],
+  "vertebrae": ["sacrum", "vertebrae_S1"]
+  + [f"vertebrae_L{i}" for i in range(5, 0, -1)]
+  + [f"vertebrae_T{i}" for i in range(12, 0, -1)]
+  + [f"vertebrae_C{i}" for i in range(7, 0, -1)],
+  "cardiac": [
+    "heart", "aorta", "pulmonary_vein", "brachiocephalic_trunk", "subclavian_artery_right",
+    "subclavian_artery_left", "common_carotid_artery_right", "common_carotid_artery_left",
+    "brachiocephalic_vein_left", "brachiocephalic_vein_right", "atrial_appendage_left",
+    "superior_vena_cava", "inferior_vena_cava", "portal_vein_and_splenic_vein", "iliac_artery_left",
+    "iliac_artery_right", "iliac_vena_left", "iliac_vena_right",
+  ],
+  "muscles": [
+    "humerus_left", "humerus_right", "scapula_left", "scapula_right", "clavicula_left", "clavicula_right",
+    "femur_left", "femur_right", "hip_left", "hip_right", "spinal_cord", "gluteus_maximus_left",
+    "gluteus_maximus_right", "gluteus_medius_left", "gluteus_medius_right", "gluteus_minimus_left",
+    "gluteus_minimus_right", "autochthon_left", "autochthon_right", "iliopsoas_left", "iliopsoas_right",
+    "brain", "skull",
+  ],
+  "ribs": [f"rib_{side}_{i}" for side in ("left", "right") for i in range(1, 13)] + ["sternum", "costal_cartilages"],
+}
+TOTALSEG_PART_OF = {name: part for part, names in TOTALSEG_PARTS.items() for name in names}
+
+# Labels in the Task008 (hepatic vessel + tumour) output.
+TASK008_LABELS = {"hepatic_vessels": 1, "liver_tumors": 2}
+
+ALIASES = {
+  "portal_vein": "portal_vein_and_splenic_vein",
+  "ivc": "inferior_vena_cava",
+  "hepatic_vessel": "hepatic_vessels",
+  "vessels": "hepatic_vessels",
+  "liver_tumor": "liver_tumors",
+  "tumors": "liver_tumors",
+}
+
+
+@dataclass
+class StructurePlan:
+  structures: List[str]
+  roi_subset: List[str]
+  totalseg_parts: List[str]
+  task008: bool
+
+  def labels(self) -> Dict[str, str]:
+    """Label value -> structure name in the assembled map (request order)."""
+    return {str(index + 1): name for index, name in enumerate(self.structures)}
+
+  def describe(self) -> Dict[str, object]:
+    return {
+      "structures": self.structures,
+      "roi_subset": self.roi_subset,
+      "totalseg_models": self.totalseg_parts,
+      "task008": self.task008,
+    }
+
+
+def totalseg_parts(roi_subset: List[str]) -> List[str]:
+  return sorted({TOTALSEG_PART_OF[name] for name in roi_subset}, key=list(TOTALSEG_PARTS).index)
+
+
+def parse_structures(raw) -> List[str]:
+  names = raw if isinstance(raw, list) else str(raw or "").replace(",", " ").split()
+  resolved: List[str] = []
+  for name in names:
+    name = ALIASES.get(name.strip().lower(), name.strip())
+    if name and name not in resolved:
+      resolved.append(name)
+  return resolved
+
+
+def plan_structures(raw, *, crop: bool = False) -> StructurePlan:
+  """Raises ValueError for unknown structure names."""
+  structures = parse_structures(raw)
+  if not structures:
+    raise ValueError("structures must list at least one structure")
+  unknown = [name for name in structures if name not in TOTALSEG_PART_OF and name not in TASK008_LABELS]
+  if unknown:
+    raise ValueError(f"Unknown structures: {', '.join(unknown)}")
+  task008 = any(name in TASK008_LABELS for name in structures)
+  roi = sorted(name for name in structures if name in TOTALSEG_PART_OF)
+  if task008 and crop and "liver" not in roi:
+    # Cascade cropping of the Task008 input needs the liver; it shares the organs model anyway.
+    roi.append("liver")
+    roi.sort()
+  return StructurePlan(structures=structures, roi_subset=roi, totalseg_parts=totalseg_parts(roi), task008=task008)
+
+
+# The merged /segment/both label map always holds these, with these values; requested organs follow.
+MERGED_BASE = ["liver", "hepatic_vessels", "liver_tumors"]
+# Default overlap rule: lesions and vessels lie inside the liver and are painted over it; the liver
+# in turn wins over organs from the separate TotalSegmentator run where their borders disagree.
+MERGED_PRECEDENCE = ["liver_tumors", "hepatic_vessels", "liver"]
+
+
+@dataclass
+class MergePlan:
+  structures: List[str]
+  # Highest first: where masks overlap, the voxel gets the label listed first.
+  precedence: List[str]
+
+  @property
+  def organs(self) -> List[str]:
+    """TotalSegmentator classes beyond the liver, for one --roi_subset run."""
+    return self.structures[len(MERGED_BASE):]
+
+  def labels(self) -> Dict[str, str]:
+    return {str(index + 1): name for index, name in enumerate(self.structures)}
+
+  def describe(self) -> Dict[str, object]:
+    return {"labels": self.labels(), "precedence": self.precedence, "totalseg_models": totalseg_parts(self.organs)}
+
+
+def plan_merge(raw_organs=None, raw_precedence=None) -> MergePlan:
+  """
+  Label table and overlap order for a merged package. ``raw_precedence`` lists structures highest
+  first; the ones it leaves out keep the default order below it. Raises ValueError for unknown names.
+  """
+  organs = [name for name in parse_structures(raw_organs) if name not in MERGED_BASE]
+  unknown = [name for name in organs if name not in TOTALSEG_PART_OF]
+  if unknown:
+    raise ValueError(f"Unknown TotalSegmentator structures: {', '.join(unknown)}")
+  structures = MERGED_BASE + organs
+  requested = parse_structures(raw_precedence)
+  unknown = [name for name in requested if name not in structures]
+  if unknown:
+    raise ValueError(f"precedence names structures not in the merged map: {', '.join(unknown)}")
+  default = MERGED_PRECEDENCE + organs
+  return MergePlan(structures=structures, precedence=requested + [name for name in default if name not in requested])
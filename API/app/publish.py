@@ -0,0 +1,120 @@
+"""Publishes result packages into the assets bucket layout the viewer reads (liverCases/<case>/segmentations/)."""
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .config import get_settings
+from .metrics import S3_PUBLISHED_BYTES
+from .s3 import get_s3_client
+
+CONTENT_TYPES = {".gz": "application/gzip", ".json": "application/json", ".zip": "application/zip"}
+
+
+@dataclass
+class PublishedCase:
+  case_id: str
+  keys: List[str] = field(default_factory=list)
+  bytes: int = 0
+  started_at: float = 0.0
+  seconds: float = 0.0
+  error: Optional[str] = None
+
+
+def result_bucket() -> str:
+  bucket = get_settings().s3_bucket
+  if not bucket:
+    raise ValueError("HPB_S3_BUCKET is not set; nothing to publish to")
+  return bucket
+
+
+def case_prefix(case_id: str) -> str:
+  return f"{get_settings().s3_result_prefix.strip('/')}/{case_id}/segmentations"
+
+
+def transfer_config():
+  """Multipart above one part size, with that many parts of each file in flight at once."""
+  from boto3.s3.transfer import TransferConfig
+
+  settings = get_settings()
+  part = max(5 * 1024 * 1024, int(settings.s3_part_mb * 1024 * 1024))  # S3 minimum part size is 5 MB
+  return TransferConfig(multipart_threshold=part, multipart_chunksize=part,
+                        max_concurrency=settings.s3_concurrency, use_threads=True)
+
+
+def publish_package(case_id: str, package: Path) -> PublishedCase:
+  """Uploads every file of a result zip (or a single result file) under the case's segmentations prefix."""
+  bucket = result_bucket()
+  client = get_s3_client()
+  config = transfer_config()
+  published = PublishedCase(case_id=case_id, started_at=time.time())
+  prefix = case_prefix(case_id)
+  if zipfile.is_zipfile(package):
+    with zipfile.ZipFile(package) as archive:
+      for info in archive.infolist():
+        if info.is_dir():
+          continue
+        key = f"{prefix}/{info.filename}"
+        with archive.open(info) as body:
+          client.upload_fileobj(body, bucket, key, Config=config,
+                                ExtraArgs={"ContentType": CONTENT_TYPES.get(Path(info.filename).suffix, "application/octet-stream")})
+        published.keys.append(key)
+        published.bytes += info.file_size
+  else:
+    key = f"{prefix}/{package.name}"
+    client.upload_file(str(package), bucket, key, Config=config,
+                       ExtraArgs={"ContentType": CONTENT_TYPES.get(package.suffix, "application/octet-stream")})
+    published.keys.append(key)
+    published.bytes += package.stat().st_size
+  published.seconds = time.time() - published.started_at
+  S3_PUBLISHED_BYTES.inc(published.bytes)
+  return published
+
+
+class ResultPublisher:
+  """
+  Uploads packages in the background as cases finish, so in a batch the upload of one case runs
+  while the next case is still in inference. ``finish`` waits and reports throughput.
+  """
+
+  def __init__(self, workers: int = 2) -> None:
+    self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hpb-publish")
+    self._futures: List[Future] = []
+    self._lock = threading.Lock()
+
+  def submit(self, case_id: str, package: Path) -> Future:
+    """Queues the upload; the returned future is done once ``package`` is no longer read."""
+    with self._lock:
+      future = self._pool.submit(self._publish, case_id, package)
+      self._futures.append(future)
+    return future
+
+  @staticmethod
+  def _publish(case_id: str, package: Path) -> PublishedCase:
+    try:
+      return publish_package(case_id, package)
+    except Exception as exc:
+      print(f"[publish] {case_id} failed: {exc}", flush=True)
+      return PublishedCase(case_id=case_id, started_at=time.time(), error=str(exc))
+
+  def finish(self) -> Dict[str, Any]:
+    """Waits for the uploads; ``mb_per_s`` is per upload, ``span_seconds`` from first start to last finish."""
+    with self._lock:
+      futures = list(self._futures)
+    cases = [future.result() for future in futures]
+    self._pool.shutdown()
+    total = sum(case.bytes for case in cases)
+    span = (max(c.started_at + c.seconds for c in cases) - min(c.started_at for c in cases)) if cases else 0.0
+    return {
+      "bucket": get_settings().s3_bucket,
+      "cases": {case.case_id: {"keys": case.keys, "bytes": case.bytes, "seconds": round(case.seconds, 3),
+                               **({"error": case.error} if case.error else {})} for case in cases},
+      "bytes": total,
+      "upload_seconds": round(sum(case.seconds for case in cases), 3),
+      "span_seconds": round(span, 3),
+      "mb_per_s": round(total / 1e6 / max(sum(case.seconds for case in cases), 1e-6), 2) if total else None,
+      "failed": [case.case_id for case in cases if case.error],
+    }
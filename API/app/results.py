@@ -0,0 +1,153 @@
+"""Finished results kept on local disk for re-download, evicted by age and total size."""
+import json
+import os
+import shutil
+import threading
+import time
+import zipfile
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .config import get_settings
+from .utils import hash_file, place_file
+
+RECORD = "record.json"
+
+
+@dataclass
+class StoredResult:
+  job_id: str
+  kind: str
+  case_id: str
+  content_hash: Optional[str]
+  created_at: float
+  # artifact name -> {"bytes": ..., "etag": ...}
+  artifacts: Dict[str, Dict] = field(default_factory=dict)
+  primary: str = ""
+  # The submitting client; only it can look the result up (records from older versions have none).
+  client: Optional[str] = None
+
+  @property
+  def bytes(self) -> int:
+    return sum(entry["bytes"] for entry in self.artifacts.values())
+
+
+class ResultStore:
+  """
+  One directory per job holding its result file (and, for zip packages, each member as its own
+  artifact) plus a record with strong ETags. Lookups are by job id or by the input's content hash,
+  and only find results stored for the same client.
+  Entries older than ``ttl_seconds`` are dropped, then the least recently used until under ``max_bytes``.
+  """
+
+  def __init__(self, root: Path, max_bytes: int, ttl_seconds: float) -> None:
+    self.root = root
+    self.max_bytes = max_bytes
+    self.ttl_seconds = ttl_seconds
+    self._entries: Dict[str, StoredResult] = {}
+    self._used: Dict[str, float] = {}
+    self._lock = threading.Lock()
+    self.root.mkdir(parents=True, exist_ok=True)
+    self._load()
+
+  def _load(self) -> None:
+    for record in self.root.glob(f"*/{RECORD}"):
+      try:
+        entry = StoredResult(**json.loads(record.read_text()))
+      except (ValueError, TypeError):
+        shutil.rmtree(record.parent, ignore_errors=True)
+        continue
+      self._entries[entry.job_id] = entry
+      self._used[entry.job_id] = record.stat().st_mtime
+
+  @property
+  def enabled(self) -> bool:
+    return self.max_bytes > 0
+
+  def put(self, job_id: str, kind: str, case_id: str, content_hash: Optional[str], result: Path,
+          filename: str, *, client: str) -> Optional[StoredResult]:
+    """Links ``result`` into the store under ``filename``; zip members become artifacts too."""
+    if not self.enabled:
+      return None
+    with self._lock:
+      if job_id in self._entries:
+        return self._entries[job_id]
+    folder = self.root / job_id
+    staging = self.root / f".{job_id}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+    place_file(result, staging / filename)
+    names = [filename]
+    if zipfile.is_zipfile(result):
+      with zipfile.ZipFile(result) as archive:
+        for info in archive.infolist():
+          name = Path(info.filename).name
+          if info.is_dir() or not name or name in names or name == RECORD:
+            continue
+          with archive.open(info) as src, (staging / name).open("wb") as out:
+            shutil.copyfileobj(src, out, 1024 * 1024)
+          names.append(name)
+    entry = StoredResult(
+      job_id=job_id, kind=kind, case_id=case_id, content_hash=content_hash, created_at=time.time(), primary=filename,
+      client=client,
+      artifacts={name: {"bytes": (staging / name).stat().st_size, "etag": f'"{hash_file(staging / name)}"'}
+                 for name in names},
+    )
+    (staging / RECORD).write_text(json.dumps(asdict(entry), indent=2))
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(staging, folder)
+    with self._lock:
+      self._entries[job_id] = entry
+      self._used[job_id] = time.time()
+    self.evict()
+    return entry
+
+  def get(self, key: str, client: str) -> Optional[StoredResult]:
+    """By job id, else the newest result for an input content hash; another client's result is not found."""
+    self.evict()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry.client != client:
+        entry = None
+      if entry is None:
+        matches = [e for e in self._entries.values() if e.content_hash == key and e.client == client]
+        entry = max(matches, key=lambda e: e.created_at) if matches else None
+      if entry is not None:
+        self._used[entry.job_id] = time.time()
+      return entry
+
+  def path(self, entry: StoredResult, artifact: str) -> Optional[Path]:
+    if artifact not in entry.artifacts:
+      return None
+    return self.root / entry.job_id / artifact
+
+  def evict(self) -> List[str]:
+    now = time.time()
+    with self._lock:
+      expired = [job_id for job_id, e in self._entries.items()
+                 if self.ttl_seconds > 0 and now - e.created_at > self.ttl_seconds]
+      total = sum(e.bytes for job_id, e in self._entries.items() if job_id not in expired)
+      for job_id in sorted(self._entries, key=lambda j: self._used.get(j, 0.0)):
+        if total <= self.max_bytes:
+          break
+        if job_id not in expired:
+          expired.append(job_id)
+          total -= self._entries[job_id].bytes
+      for job_id in expired:
+        self._entries.pop(job_id, None)
+        self._used.pop(job_id, None)
+    for job_id in expired:
+      shutil.rmtree(self.root / job_id, ignore_errors=True)
+    return expired
+
+  def stats(self) -> Dict[str, float]:
+    with self._lock:
+      return {"results": len(self._entries), "bytes": sum(e.bytes for e in self._entries.values())}
+
+
+@lru_cache
+def get_result_store() -> ResultStore:
+  settings = get_settings()
+  return ResultStore(settings.result_root, int(settings.result_max_gb * 1024 ** 3), settings.result_ttl_hours * 3600)
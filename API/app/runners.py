@@ -1,9 +1,11 @@
 import json
 import os
-import shutil
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-from .utils import run
+from .pgzip import compress_file
+from .utils import place_file, run
+from .volumes import FAST_COMPRESSION, Volume, nifti_suffix, write_volume
 
 
 def nnunet_v1_task008(in_dir: Path, out_dir: Path, *, case_id: str, folds: str = "0") -> Path:
@@ -33,6 +35,54 @@ def nnunet_v1_task008(in_dir: Path, out_dir: Path, *, case_id: str, folds: str =
   raise RuntimeError(f"Task008: expected output not found for {case_id}")
 
 
+def nnunet_v1_task008_resident(in_dir: Path, out_dir: Path, *, case_id: str, folds: str = "0") -> Path:
+  """
+  The ``nnunet_v1_task008`` prediction (no TTA) computed in-process, using the network and fold
+  weights held by the model registry so repeated cases skip model loading. Like nnUNet_predict it
+  then applies the model's postprocessing.json (largest connected component per class).
+  """
+  import numpy as np
+  from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax  # type: ignore
+  from nnunet.postprocessing.connected_components import load_postprocessing, load_remove_save  # type: ignore
+
+  from .models import get_model_registry, task008_folder
+
+  registry = get_model_registry()
+  out_dir.mkdir(parents=True, exist_ok=True)
+  output = out_dir / f"{case_id}.nii.gz"
+  # nnU-Net writes the mask uncompressed; it is gzipped block-parallel below.
+  plain = out_dir / f"{case_id}.nii"
+  raw = out_dir / f"{case_id}_before_pp.nii"
+  with registry.acquire("task008/network") as trainer:
+    data, _, properties = trainer.preprocess_patient([str(in_dir / f"{case_id}_0000.nii.gz")])
+    softmax = []
+    for fold in folds.replace(",", " ").split():
+      with registry.acquire(f"task008/fold_{int(fold)}") as checkpoint:
+        trainer.load_checkpoint_ram(checkpoint, False)
+        softmax.append(trainer.predict_preprocessed_data_return_seg_and_softmax(
+          data, do_mirroring=False, mirror_axes=trainer.data_aug_params["mirror_axes"],
+          use_sliding_window=True, step_size=0.5, use_gaussian=True, all_in_gpu=False, mixed_precision=True,
+        )[1][None])
+    softmax_mean = np.vstack(softmax).mean(0)
+    transpose_backward = trainer.plans.get("transpose_backward")
+    if trainer.plans.get("transpose_forward") is not None and transpose_backward is not None:
+      softmax_mean = softmax_mean.transpose([0] + [i + 1 for i in transpose_backward])
+    export = trainer.segmentation_export_params
+    save_segmentation_nifti_from_softmax(
+      softmax_mean, str(raw), properties, export.get("interpolation_order", 1),
+      getattr(trainer, "regions_class_order", None), None, None, None, None,
+      export.get("force_separate_z"), export.get("interpolation_order_z", 0),
+    )
+  postprocessing = task008_folder() / "postprocessing.json"
+  if postprocessing.exists():
+    for_which_classes, min_valid_obj_size = load_postprocessing(str(postprocessing))
+    load_remove_save(str(raw), str(plain), for_which_classes, min_valid_obj_size)
+    raw.unlink()
+  else:
+    raw.replace(plain)
+  return compress_file(plain, output, remove_source=True)
+
+
 def totalseg_liver_only(in_path: Path, out_dir: Path, *, fast: bool = False) -> Path:
   flags = ["--fast"] if fast else []
   flag_str = " ".join(flags)
@@ -63,16 +113,83 @@ def totalseg_multilabel(in_path: Path, out_dir: Path, *, fast: bool = False) ->
   raise RuntimeError("TotalSegmentator multi-label output missing")
 
 
-def prepare_package(case_root: Path, *, liver_mask: Path, task008_mask: Path, metadata: dict) -> Path:
+def totalseg_roi_subset(in_path: Path, out_dir: Path, roi_subset: List[str], *, fast: bool = False) -> Dict[str, Path]:
+  """Runs only the TotalSegmentator models that contain ``roi_subset``; returns one mask per structure."""
+  flag_str = "--fast" if fast else ""
+  cmd = f"TotalSegmentator -i {in_path} -o {out_dir} --roi_subset {' '.join(roi_subset)} {flag_str}".strip()
+  run(cmd)
+  masks = {name: out_dir / f"{name}.nii.gz" for name in roi_subset}
+  missing = [name for name, path in masks.items() if not path.exists()]
+  if missing:
+    raise RuntimeError(f"TotalSegmentator roi_subset: missing {', '.join(missing)}")
+  return masks
+
+
+def assemble_label_map(reference: Volume, layers: List[Tuple[Volume, Dict[int, int]]]) -> Volume:
+  """
+  Paints each layer into one uint8 label map on the grid of ``reference``. A layer maps the values
+  of its mask to output labels; later layers win where masks overlap.
+  """
+  import numpy as np
+
+  labels = np.zeros(reference.array.shape, dtype=np.uint8)
+  for layer, mapping in layers:
+    for source, target in mapping.items():
+      labels[layer.array == source] = target
+  return reference.like(labels)
+
+
+def prepare_package(case_root: Path, *, masks: Dict[str, Path], metadata: dict) -> Tuple[Path, int]:
+  """
+  Links the masks into ``package/`` next to meta.json, each under its key with its own suffix
+  (``liver.nii.gz``, ``task008.hpbm``, ``labels.nii.gz``); returns the directory and the bytes written.
+  """
   pkg_dir = case_root / "package"
   pkg_dir.mkdir(parents=True, exist_ok=True)
 
-  target_liver = pkg_dir / "liver.nii.gz"
-  target_task8 = pkg_dir / "task008.nii.gz"
-  shutil.copy2(liver_mask, target_liver)
-  shutil.copy2(task008_mask, target_task8)
+  written = 0
+  for name, mask in masks.items():
+    written += place_file(mask, pkg_dir / f"{name}{nifti_suffix(mask)}")
 
   meta_path = pkg_dir / "meta.json"
   meta_path.write_text(json.dumps(metadata, indent=2))
-
-  return pkg_dir
+  written += meta_path.stat().st_size
+
+  return pkg_dir, written
+
+
+def crop_to_mask(ct: Volume, mask: Volume, out_path: Path, *, margin_mm: float = 15.0,
+                 label: Optional[int] = None):
+  """
+  Crops ``ct`` to the bounding box of ``mask`` (or of ``label`` within it) plus a margin (cascade
+  cropping) and writes the crop for nnU-Net. Returns the (index, size) of the region in voxels
+  (x, y, z), or None if the mask is empty.
+  """
+  import math
+
+  import numpy as np
+
+  voxels = np.argwhere(mask.array > 0 if label is None else mask.array == label)
+  if voxels.size == 0:
+    return None
+  lower = voxels.min(axis=0)[::-1]
+  upper = voxels.max(axis=0)[::-1] + 1
+  pad = [int(math.ceil(margin_mm / spacing)) for spacing in mask.geometry.spacing]
+  index = [max(0, int(lo) - p) for lo, p in zip(lower, pad)]
+  stop = [min(int(n), int(hi) + p) for hi, p, n in zip(upper, pad, mask.size)]
+  size = [hi - lo for lo, hi in zip(index, stop)]
+
+  region = ct.array[index[2]:stop[2], index[1]:stop[1], index[0]:stop[0]]
+  write_volume(Volume(region, ct.geometry.shifted(index)), out_path, compression=FAST_COMPRESSION)
+  return index, size
+
+
+def paste_mask(cropped: Volume, reference: Volume, index) -> Volume:
+  """Places a mask predicted on a crop back into the full field of view of ``reference``."""
+  import numpy as np
+
+  full = np.zeros(reference.array.shape, dtype=np.uint8)
+  x, y, z = (int(i) for i in index)
+  depth, height, width = cropped.array.shape
+  full[z:z + depth, y:y + height, x:x + width] = cropped.array
+  return reference.like(full)
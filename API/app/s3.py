@@ -0,0 +1,105 @@
+"""S3 access shared by the API and workers: one pooled client, ranged parallel reads, input probing."""
+import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Deque, List, Optional, Tuple
+
+from .config import get_settings
+from .ingest import IngestResult, NiftiSink, uncompressed_path
+from .nifti import NiftiHeader, read_header_stream
+
+# Enough for the NIfTI header even when the first gzip block is poorly compressed.
+PROBE_BYTES = 64 * 1024
+
+
+@lru_cache
+def get_s3_client():
+  """
+  One client per process: boto3 clients are thread-safe, and sharing one keeps a single
+  connection pool sized for the ranged downloads and multipart uploads that run in parallel.
+  """
+  import boto3
+  from botocore.config import Config
+
+  settings = get_settings()
+  config = Config(
+    max_pool_connections=max(10, settings.s3_concurrency * 2),
+    retries={"max_attempts": 5, "mode": "adaptive"},
+  )
+  return boto3.client("s3", region_name=settings.aws_region, endpoint_url=settings.s3_endpoint, config=config)
+
+
+def input_buckets() -> List[str]:
+  settings = get_settings()
+  listed = [name.strip() for name in (settings.s3_input_buckets or "").split(",") if name.strip()]
+  return listed or ([settings.s3_bucket] if settings.s3_bucket else [])
+
+
+def parse_s3_uri(uri: str) -> Tuple[str, str]:
+  """Raises ValueError for malformed URIs and buckets the service may not read from."""
+  if not uri.startswith("s3://"):
+    raise ValueError("Input URI must start with s3://")
+  bucket, _, key = uri[len("s3://"):].partition("/")
+  if not bucket or not key:
+    raise ValueError(f"Input URI {uri} needs a bucket and a key")
+  if bucket not in input_buckets():
+    raise ValueError(f"Bucket {bucket} is not an allowed input bucket")
+  return bucket, key
+
+
+def error_status(exc: Exception) -> Optional[int]:
+  """HTTP status of a botocore ClientError (404 for missing objects), None for other errors."""
+  response = getattr(exc, "response", None)
+  if not isinstance(response, dict):
+    return None
+  status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+  return int(status) if status else None
+
+
+def read_range(bucket: str, key: str, start: int, end: int) -> bytes:
+  """Bytes ``start``..``end`` inclusive."""
+  response = get_s3_client().get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")
+  return response["Body"].read()
+
+
+def probe(uri: str) -> Tuple[int, Optional[NiftiHeader]]:
+  """Object size and NIfTI header from one small ranged GET; the header is None for zip archives."""
+  bucket, key = parse_s3_uri(uri)
+  size = get_s3_client().head_object(Bucket=bucket, Key=key)["ContentLength"]
+  head = read_range(bucket, key, 0, min(size, PROBE_BYTES) - 1) if size else b""
+  if head[:2] == b"PK":
+    return size, None
+  return size, read_header_stream(io.BytesIO(head))
+
+
+def fetch_input(uri: str, gz_path: Path) -> IngestResult:
+  """
+  Downloads ``uri`` with concurrent ranged GETs. Parts are consumed in order as they complete, so
+  the file is stored, hashed and gunzipped into the uncompressed copy while later parts are still
+  in flight; at most ``HPB_S3_CONCURRENCY`` parts are held in memory.
+  """
+  settings = get_settings()
+  bucket, key = parse_s3_uri(uri)
+  size = get_s3_client().head_object(Bucket=bucket, Key=key)["ContentLength"]
+  part = max(1, int(settings.s3_part_mb * 1024 * 1024))
+  ranges = [(start, min(start + part, size) - 1) for start in range(0, size, part)]
+  sink = NiftiSink(gz_path, uncompressed_path(gz_path))
+  try:
+    with ThreadPoolExecutor(max_workers=settings.s3_concurrency, thread_name_prefix="hpb-s3-get") as pool:
+      pending = iter(ranges)
+      in_flight: Deque = deque()
+      for start, end in pending:
+        in_flight.append(pool.submit(read_range, bucket, key, start, end))
+        if len(in_flight) >= settings.s3_concurrency:
+          break
+      while in_flight:
+        sink.feed(in_flight.popleft().result())
+        following = next(pending, None)
+        if following is not None:
+          in_flight.append(pool.submit(read_range, bucket, key, *following))
+    return sink.close()
+  except BaseException:
+    sink.abort()
+    raise
@@ -0,0 +1,155 @@
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import get_settings
+from .costmodel import CostModel, get_cost_model
+from .jobs import PRIORITY_RANK, RUNNING, JobQueue, get_job_queue
+from .planner import plan_structures
+
+ALL_FOLDS = "0 1 2 3 4"
+
+# Most accurate configuration first; deadline selection walks down the list.
+CONFIG_LADDERS: Dict[str, List[Dict[str, Any]]] = {
+  "liver": [{"fast": False}, {"fast": True}],
+  "totalseg": [{"fast": False}, {"fast": True}],
+  "task008": [{"folds": ALL_FOLDS}, {"folds": "0 1 2"}, {"folds": "0"}],
+  "both": [
+    {"fast": False, "folds": ALL_FOLDS, "crop": False},
+    {"fast": False, "folds": ALL_FOLDS, "crop": True},
+    {"fast": False, "folds": "0 1 2", "crop": True},
+    {"fast": False, "folds": "0", "crop": True},
+    {"fast": True, "folds": "0", "crop": True},
+  ],
+}
+CONFIG_LADDERS["structures"] = CONFIG_LADDERS["both"]
+
+
+class AdmissionError(Exception):
+  """The job cannot run on this deployment (e.g. it is predicted to exceed worker memory)."""
+
+
+def task008_params(params: Dict[str, Any]) -> Dict[str, Any]:
+  # pipeline.execute runs Task008 in process when models are resident and tags that stage apart.
+  if get_settings().resident_models:
+    return {**params, "runner": "resident"}
+  return params
+
+
+def stage_plan(kind: str, params: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+  """The stages a job runs, with the same stage parameters pipeline.execute reports."""
+  fast = bool(params.get("fast", False))
+  folds = str(params.get("folds", "0"))
+  if kind == "liver":
+    return [("liver", {"fast": fast})]
+  if kind == "totalseg":
+    return [("totalseg", {"fast": fast})]
+  if kind == "task008":
+    return [("task008", task008_params({"folds": folds, "crop": False}))]
+  if kind == "both":
+    crop = bool(params.get("crop", False))
+    task008: Dict[str, Any] = {"folds": folds, "crop": crop, **({"liver": {"fast": fast}} if crop else {})}
+    stages: List[Tuple[str, Dict[str, Any]]] = [("liver", {"fast": fast}), ("task008", task008_params(task008))]
+    if params.get("merged") and params.get("structures"):
+      # Organs requested for a merged package come from one more --roi_subset run.
+      stages.append(("totalseg", {"fast": fast, "roi_subset": sorted(params["structures"])}))
+    return stages
+  if kind == "structures":
+    plan = plan_structures(params.get("structures"), crop=bool(params.get("crop", False)))
+    stages = []
+    if plan.roi_subset:
+      stages.append(("totalseg", {"fast": fast, "roi_subset": plan.roi_subset}))
+    if plan.task008:
+      # The crop comes from the ROI run's liver (the planner adds it), as in pipeline.run_task008.
+      crop = bool(params.get("crop", False))
+      liver = {"liver": {"fast": fast, "roi_subset": plan.roi_subset}} if crop else {}
+      stages.append(("task008", task008_params({"folds": folds, "crop": crop, **liver})))
+    return stages
+  return []
+
+
+def predict_seconds(kind: str, params: Dict[str, Any], features: Optional[Dict[str, float]]) -> float:
+  return get_cost_model().predict(stage_plan(kind, params), features)["seconds"]
+
+
+def queue_delay(queue: JobQueue, model: CostModel, priority: str) -> float:
+  """Predicted seconds before a new job of ``priority`` starts, given the work queued ahead of it."""
+  now = time.time()
+  rank = PRIORITY_RANK[priority]
+  ahead = 0.0
+  for job in queue.snapshot():
+    predicted = model.predict(stage_plan(job.kind, job.params), job.features)["seconds"]
+    if job.status == RUNNING:
+      ahead += max(0.0, predicted - (now - (job.started_at or now)))
+    elif PRIORITY_RANK[job.priority] <= rank:
+      ahead += predicted
+  return ahead / max(1, queue.total_capacity())
+
+
+def estimate(kind: str, params: Dict[str, Any], features: Optional[Dict[str, float]], *, priority: str) -> Dict[str, Any]:
+  model = get_cost_model()
+  prediction = model.predict(stage_plan(kind, params), features)
+  delay = queue_delay(get_job_queue(), model, priority)
+  limit = get_settings().max_job_memory_gb * 1e9
+  return {
+    "kind": kind,
+    "params": {k: v for k, v in params.items() if k != "auto_config"},
+    "stages": [
+      {
+        "stage": s["stage"],
+        "params": s["params"],
+        "seconds": round(s["seconds"], 2),
+        "peak_gb": round(s["peak_bytes"] / 1e9, 2),
+        "mvox": round(s["mvox"], 2),
+      }
+      for s in prediction["stages"]
+    ],
+    "run_seconds": round(prediction["seconds"], 2),
+    "queue_delay_seconds": round(delay, 2),
+    "eta_seconds": round(delay + prediction["seconds"], 2),
+    "peak_gb": round(prediction["peak_bytes"] / 1e9, 2),
+    "admissible": prediction["peak_bytes"] <= limit,
+  }
+
+
+def admit(kind: str, params: Dict[str, Any], features: Optional[Dict[str, float]], *, flexible: bool = False) -> None:
+  """
+  Rejects jobs whose predicted peak memory exceeds what a worker can hold. ``flexible`` jobs
+  (those with a deadline) are checked against the lightest configuration they may be given.
+  """
+  if flexible:
+    params = {**params, **CONFIG_LADDERS[kind][-1]}
+  peak = get_cost_model().predict(stage_plan(kind, params), features)["peak_bytes"]
+  limit = get_settings().max_job_memory_gb
+  if peak > limit * 1e9:
+    raise AdmissionError(f"Predicted peak memory {peak / 1e9:.1f} GB exceeds the {limit:g} GB worker limit")
+
+
+def plan_for_deadline(kind: str, params: Dict[str, Any], features: Optional[Dict[str, float]], *,
+                      deadline_s: float, priority: str) -> Dict[str, Any]:
+  """
+  Picks the most accurate configuration predicted to finish within ``deadline_s`` at the
+  current queue depth, falling back to the fastest one. Returns the updated job params.
+  """
+  model = get_cost_model()
+  delay = queue_delay(get_job_queue(), model, priority)
+  limit = get_settings().max_job_memory_gb * 1e9
+  ladder = CONFIG_LADDERS[kind]
+  chosen, predicted = ladder[-1], delay + model.predict(stage_plan(kind, {**params, **ladder[-1]}), features)["seconds"]
+  for config in ladder:
+    prediction = model.predict(stage_plan(kind, {**params, **config}), features)
+    if prediction["peak_bytes"] > limit:
+      continue
+    if delay + prediction["seconds"] <= deadline_s:
+      chosen, predicted = config, delay + prediction["seconds"]
+      break
+  return {
+    **params,
+    **chosen,
+    "auto_config": {
+      "deadline_s": deadline_s,
+      "chosen": chosen,
+      "queue_delay_seconds": round(delay, 2),
+      "predicted_seconds": round(predicted, 2),
+      "submitted_at": time.time(),
+    },
+  }
@@ -0,0 +1,186 @@
+"""
+Job scratch space. Stage work directories go to RAM (a tmpfs such as /dev/shm) while the node's RAM
+budget has room and to HPB_OUT_ROOT otherwise. Usage is measured at every stage boundary. Files that
+outgrow the job's RAM reservation are spilled to disk there, and the per-job and node-wide disk
+quotas are enforced.
+"""
+import os
+import shutil
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Optional
+
+from .config import get_settings
+from .ingest import uncompressed_path
+from .metrics import REGISTRY, label_key
+
+# Without a decoded volume to size from, a gzipped CT is assumed to expand about this much.
+GZIP_RATIO = 4
+MIN_RESERVATION = 64 * 1024 * 1024
+
+
+class ScratchQuotaExceeded(RuntimeError):
+  pass
+
+
+@dataclass
+class JobScratch:
+  job_id: str
+  # Where the job's stages write: the RAM directory if a reservation was granted, else ``disk``.
+  root: Path
+  disk: Path
+  ram_reserved: int = 0
+  ram_bytes: int = 0
+  disk_bytes: int = 0
+  spilled_bytes: int = 0
+
+  @property
+  def in_ram(self) -> bool:
+    return self.ram_reserved > 0
+
+  def usage(self) -> Dict[str, int]:
+    return {"ram_bytes": self.ram_bytes, "disk_bytes": self.disk_bytes, "spilled_bytes": self.spilled_bytes}
+
+
+def tree_bytes(root: Path) -> int:
+  """Bytes in regular files under ``root``; spilled files' symlinks are not followed."""
+  total = 0
+  for dirpath, _, filenames in os.walk(root):
+    for name in filenames:
+      try:
+        stat = os.lstat(os.path.join(dirpath, name))
+      except OSError:
+        continue
+      if not os.path.islink(os.path.join(dirpath, name)):
+        total += stat.st_size
+  return total
+
+
+def expected_bytes(ct_path: Path) -> int:
+  """RAM to reserve for a job: about one decoded volume (crops, copies and compressed masks fit in that)."""
+  decoded = uncompressed_path(ct_path)
+  if decoded.exists():
+    return max(decoded.stat().st_size, MIN_RESERVATION)
+  if ct_path.exists():
+    return max(ct_path.stat().st_size * GZIP_RATIO, MIN_RESERVATION)
+  return MIN_RESERVATION
+
+
+class ScratchManager:
+  def __init__(self, disk_root: Path, ram_root: Optional[Path], ram_bytes: int, job_bytes: int,
+               disk_bytes: int) -> None:
+    self.disk_root = disk_root
+    self.ram_root = ram_root if ram_root is not None and ram_bytes > 0 else None
+    self.ram_bytes = ram_bytes if self.ram_root is not None else 0
+    self.job_bytes = job_bytes
+    self.disk_bytes = disk_bytes
+    self._jobs: Dict[str, JobScratch] = {}
+    self._lock = threading.Lock()
+    if self.ram_root is not None:
+      try:
+        self.ram_root.mkdir(parents=True, exist_ok=True)
+      except OSError as exc:
+        print(f"[scratch] RAM scratch disabled: {exc}", flush=True)
+        self.ram_root, self.ram_bytes = None, 0
+
+  def _reserved(self) -> int:
+    return sum(scratch.ram_reserved for scratch in self._jobs.values())
+
+  def open(self, job_id: str, expected: int) -> JobScratch:
+    """The job's scratch; a job resumed after preemption gets the directory it already had."""
+    disk = self.disk_root / job_id
+    disk.mkdir(parents=True, exist_ok=True)
+    with self._lock:
+      scratch = self._jobs.get(job_id)
+      if scratch is not None:
+        return scratch
+      scratch = JobScratch(job_id=job_id, root=disk, disk=disk)
+      if self.ram_root is not None and self._reserved() + expected <= self.ram_bytes:
+        # The budget is ours, but the tmpfs may be shared (or a container's 64 MB /dev/shm).
+        if shutil.disk_usage(self.ram_root).free >= expected:
+          scratch.root = self.ram_root / job_id
+          scratch.ram_reserved = expected
+      self._jobs[job_id] = scratch
+    scratch.root.mkdir(parents=True, exist_ok=True)
+    return scratch
+
+  def checkpoint(self, scratch: JobScratch, stage: str) -> Dict[str, int]:
+    """Measures the job after ``stage``, spills RAM overflow to disk and enforces the quotas."""
+    if scratch.in_ram:
+      scratch.ram_bytes = tree_bytes(scratch.root)
+      if scratch.ram_bytes > scratch.ram_reserved:
+        self._spill(scratch)
+    scratch.disk_bytes = tree_bytes(scratch.disk) + tree_bytes(get_settings().in_root / scratch.job_id)
+    job_total = scratch.ram_bytes + scratch.disk_bytes
+    if self.job_bytes and job_total > self.job_bytes:
+      raise ScratchQuotaExceeded(
+        f"Job {scratch.job_id} uses {job_total / 1024 ** 3:.1f} GB of scratch after {stage} "
+        f"(limit {self.job_bytes / 1024 ** 3:.1f} GB)"
+      )
+    with self._lock:
+      disk_total = sum(job.disk_bytes for job in self._jobs.values())
+    if self.disk_bytes and disk_total > self.disk_bytes:
+      raise ScratchQuotaExceeded(
+        f"Scratch disk is over its {self.disk_bytes / 1024 ** 3:.1f} GB quota "
+        f"({disk_total / 1024 ** 3:.1f} GB across {len(self._jobs)} jobs)"
+      )
+    return scratch.usage()
+
+  def _spill(self, scratch: JobScratch) -> None:
+    """Moves the largest RAM files to the same relative path on disk, leaving symlinks behind."""
+    files = []
+    for dirpath, _, filenames in os.walk(scratch.root):
+      for name in filenames:
+        path = Path(dirpath) / name
+        if not path.is_symlink():
+          files.append((path.stat().st_size, path))
+    for size, path in sorted(files, reverse=True):
+      if scratch.ram_bytes <= scratch.ram_reserved:
+        break
+      target = scratch.disk / path.relative_to(scratch.root)
+      target.parent.mkdir(parents=True, exist_ok=True)
+      shutil.move(str(path), target)
+      path.symlink_to(target)
+      scratch.ram_bytes -= size
+      scratch.spilled_bytes += size
+      SCRATCH_SPILLED.inc(size)
+
+  def close(self, job_id: str, *, keep: bool = False) -> None:
+    with self._lock:
+      self._jobs.pop(job_id, None)
+    if not keep:
+      if self.ram_root is not None:
+        shutil.rmtree(self.ram_root / job_id, ignore_errors=True)
+      shutil.rmtree(self.disk_root / job_id, ignore_errors=True)
+
+  def stats(self) -> Dict[str, float]:
+    with self._lock:
+      jobs = list(self._jobs.values())
+    return {
+      "jobs": len(jobs),
+      "jobs_in_ram": sum(1 for job in jobs if job.in_ram),
+      "ram_budget_bytes": self.ram_bytes,
+      "ram_reserved_bytes": sum(job.ram_reserved for job in jobs),
+      "ram_bytes": sum(job.ram_bytes for job in jobs),
+      "disk_bytes": sum(job.disk_bytes for job in jobs),
+      "spilled_bytes": sum(job.spilled_bytes for job in jobs),
+    }
+
+
+@lru_cache
+def get_scratch_manager() -> ScratchManager:
+  settings = get_settings()
+  return ScratchManager(
+    settings.out_root, settings.scratch_ram_root, int(settings.scratch_ram_gb * 1024 ** 3),
+    int(settings.scratch_job_gb * 1024 ** 3), int(settings.scratch_disk_gb * 1024 ** 3),
+  )
+
+
+SCRATCH_SPILLED = REGISTRY.counter("hpb_scratch_spilled_bytes_total", "Scratch bytes moved from RAM to disk at stage boundaries")
+REGISTRY.gauge(
+  "hpb_scratch_bytes",
+  "Scratch bytes held by running jobs, by tier (as of their last stage boundary)",
+  lambda: {label_key({"tier": tier}): get_scratch_manager().stats()[f"{tier}_bytes"] for tier in ("ram", "disk")},
+)
@@ -0,0 +1,324 @@
+"""
+Resumable CT uploads following tus 1.0 (core plus the creation, checksum, termination and expiration
+extensions). Each PATCH is written straight into the upload's scratch file and fed to the same
+hashing/gunzipping sink as a single-shot upload, so finalizing an upload into a job costs nothing.
+"""
+import base64
+import binascii
+import dataclasses
+import hashlib
+import json
+import shutil
+import threading
+import time
+from dataclasses import dataclass, field
+from email.utils import formatdate
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import APIRouter, Depends, Header, Request, Response
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+
+from .clients import resolve_client
+from .config import get_settings
+from .ingest import BLOCK_BYTES, IngestResult, NiftiSink, ingest_file, uncompressed_path
+from .metrics import INPUT_REJECTED
+from .nifti import NiftiError
+from .utils import uuid4_hex
+from .validation import InputRejected, check_header
+
+TUS_VERSION = "1.0.0"
+TUS_EXTENSIONS = "creation,checksum,termination,expiration"
+CHECKSUM_ALGORITHMS = {"sha1": hashlib.sha1, "sha256": hashlib.sha256, "md5": hashlib.md5}
+# A PATCH with Upload-Checksum is held in memory until it is verified, so those chunks are bounded.
+MAX_CHECKSUM_CHUNK = 256 * 1024 * 1024
+STATE = "upload.json"
+
+
+class UploadError(ValueError):
+  def __init__(self, status_code: int, message: str) -> None:
+    super().__init__(message)
+    self.status_code = status_code
+
+
+@dataclass
+class Upload:
+  upload_id: str
+  length: int
+  client: str
+  offset: int = 0
+  created_at: float = field(default_factory=time.time)
+  expires_at: float = 0.0
+  metadata: Dict[str, str] = field(default_factory=dict)
+  # Not persisted: after a restart the bytes already on disk are hashed and expanded at finalize.
+  sink: Optional[NiftiSink] = field(default=None, repr=False)
+  busy: bool = field(default=False, repr=False)
+  folder: Path = field(default=Path(), repr=False)
+
+  @property
+  def gz_path(self) -> Path:
+    return self.folder / "input.nii.gz"
+
+  def state(self) -> Dict:
+    return {f.name: getattr(self, f.name) for f in dataclasses.fields(self) if f.name not in ("sink", "busy", "folder")}
+
+
+def parse_metadata(header: Optional[str]) -> Dict[str, str]:
+  """tus ``Upload-Metadata``: comma-separated ``key base64(value)`` pairs."""
+  metadata: Dict[str, str] = {}
+  for pair in filter(None, (item.strip() for item in (header or "").split(","))):
+    key, _, value = pair.partition(" ")
+    try:
+      metadata[key] = base64.b64decode(value).decode("utf-8") if value else ""
+    except (binascii.Error, UnicodeDecodeError) as exc:
+      raise UploadError(400, f"Bad Upload-Metadata value for {key}") from exc
+  return metadata
+
+
+class UploadStore:
+  def __init__(self, root: Path, max_bytes: int, ttl_seconds: float) -> None:
+    self.root = root
+    self.max_bytes = max_bytes
+    self.ttl_seconds = ttl_seconds
+    self._uploads: Dict[str, Upload] = {}
+    self._lock = threading.Lock()
+    self.root.mkdir(parents=True, exist_ok=True)
+    self._load()
+
+  def _load(self) -> None:
+    for state in self.root.glob(f"*/{STATE}"):
+      try:
+        upload = Upload(**json.loads(state.read_text()), folder=state.parent)
+      except (ValueError, TypeError):
+        shutil.rmtree(state.parent, ignore_errors=True)
+        continue
+      # Bytes the previous process had not flushed are gone; HEAD tells the client where to resume.
+      upload.offset = upload.gz_path.stat().st_size if upload.gz_path.exists() else 0
+      self._uploads[upload.upload_id] = upload
+
+  def _save(self, upload: Upload) -> None:
+    (upload.folder / STATE).write_text(json.dumps(upload.state()))
+
+  def expire(self) -> None:
+    now = time.time()
+    with self._lock:
+      expired = [u for u in self._uploads.values() if u.expires_at and u.expires_at < now and not u.busy]
+      for upload in expired:
+        del self._uploads[upload.upload_id]
+    for upload in expired:
+      self._discard(upload)
+
+  def _discard(self, upload: Upload) -> None:
+    if upload.sink is not None:
+      upload.sink.abort()
+    shutil.rmtree(upload.folder, ignore_errors=True)
+
+  def create(self, length: int, metadata: Dict[str, str], client: str) -> Upload:
+    if length < 0:
+      raise UploadError(400, "Upload-Length must not be negative")
+    if length > self.max_bytes:
+      raise UploadError(413, f"Upload-Length {length} exceeds the maximum of {self.max_bytes} bytes")
+    self.expire()
+    upload_id = uuid4_hex()
+    upload = Upload(upload_id=upload_id, length=length, client=client, metadata=metadata, folder=self.root / upload_id)
+    upload.expires_at = upload.created_at + self.ttl_seconds if self.ttl_seconds > 0 else 0.0
+    upload.folder.mkdir(parents=True)
+    # The header is checked as soon as the first chunk carries it, so a non-CT upload stops early.
+    upload.sink = NiftiSink(upload.gz_path, uncompressed_path(upload.gz_path), check_header=check_header)
+    self._save(upload)
+    with self._lock:
+      self._uploads[upload.upload_id] = upload
+    return upload
+
+  def get(self, upload_id: str, client: str) -> Upload:
+    with self._lock:
+      upload = self._uploads.get(upload_id)
+    if upload is None or upload.client != client:
+      raise UploadError(404, f"Unknown upload {upload_id}")
+    if upload.expires_at and upload.expires_at < time.time():
+      raise UploadError(410, f"Upload {upload_id} has expired")
+    return upload
+
+  def _write(self, upload: Upload, data: bytes) -> None:
+    if upload.sink is not None:
+      upload.sink.feed(data)
+    else:
+      with upload.gz_path.open("ab") as handle:
+        handle.write(data)
+    upload.offset += len(data)
+
+  async def append(self, upload: Upload, offset: int, chunks: AsyncIterator[bytes],
+                   checksum: Optional[str] = None) -> int:
+    """Writes one PATCH body at ``offset``; without a checksum, bytes received before a disconnect count."""
+    if upload.busy:
+      raise UploadError(409, f"Upload {upload.upload_id} is receiving another PATCH")
+    if offset != upload.offset:
+      raise UploadError(409, f"Upload-Offset {offset} does not match the current offset {upload.offset}")
+    digest = None
+    if checksum:
+      algorithm, _, expected = checksum.partition(" ")
+      if algorithm not in CHECKSUM_ALGORITHMS:
+        raise UploadError(400, f"Unsupported checksum algorithm {algorithm}")
+      digest = CHECKSUM_ALGORITHMS[algorithm]()
+    upload.busy = True
+    block = bytearray()
+    try:
+      async for chunk in chunks:
+        if upload.offset + len(block) + len(chunk) > upload.length:
+          raise UploadError(413, "Chunk runs past Upload-Length")
+        block += chunk
+        if digest is not None:
+          if len(block) > MAX_CHECKSUM_CHUNK:
+            raise UploadError(413, f"Chunks with Upload-Checksum are limited to {MAX_CHECKSUM_CHUNK} bytes")
+        elif len(block) >= BLOCK_BYTES:
+          await run_in_threadpool(self._write, upload, bytes(block))
+          block.clear()
+      if digest is not None:
+        digest.update(block)
+        if base64.b64encode(digest.digest()).decode() != expected.strip():
+          raise UploadError(460, "Checksum mismatch; the chunk was discarded")
+      if block:
+        await run_in_threadpool(self._write, upload, bytes(block))
+    except ClientDisconnect:
+      if digest is None and block:
+        await run_in_threadpool(self._write, upload, bytes(block))
+    except UploadError:
+      raise
+    except Exception:
+      # Rejected by the header check (or unwritable): the upload cannot become a job.
+      self.delete(upload.upload_id, upload.client)
+      raise
+    finally:
+      upload.busy = False
+      if upload.folder.exists():
+        if upload.sink is not None:
+          upload.sink.flush()
+        self._save(upload)
+    return upload.offset
+
+  def take(self, upload_id: str, client: str, gz_path: Path) -> IngestResult:
+    """Finalizes a complete upload: its files move to ``gz_path`` (and its .nii) and the upload is gone."""
+    upload = self.get(upload_id, client)
+    if upload.busy:
+      raise UploadError(409, f"Upload {upload_id} is still receiving data")
+    if upload.offset != upload.length:
+      raise UploadError(409, f"Upload {upload_id} has {upload.offset} of {upload.length} bytes")
+    with self._lock:
+      self._uploads.pop(upload_id, None)
+    try:
+      gz_path.parent.mkdir(parents=True, exist_ok=True)
+      nii_path = uncompressed_path(gz_path)
+      if upload.sink is not None:
+        received = upload.sink.close()
+        if upload.gz_path.exists():
+          upload.gz_path.replace(gz_path)
+        if received.nii_path is not None:
+          received.nii_path.replace(nii_path)
+          received = dataclasses.replace(received, nii_path=nii_path)
+        return received
+      upload.gz_path.replace(gz_path)
+      return ingest_file(gz_path, nii_path, check_header=check_header)
+    finally:
+      shutil.rmtree(upload.folder, ignore_errors=True)
+
+  def delete(self, upload_id: str, client: str) -> None:
+    upload = self.get(upload_id, client)
+    with self._lock:
+      self._uploads.pop(upload_id, None)
+    self._discard(upload)
+
+
+@lru_cache
+def get_upload_store() -> UploadStore:
+  settings = get_settings()
+  return UploadStore(settings.in_root / "uploads", int(settings.upload_max_gb * 1024 ** 3),
+                     settings.upload_ttl_hours * 3600)
+
+
+router = APIRouter(prefix="/uploads", tags=["uploads"])
+
+
+def tus_headers(upload: Optional[Upload] = None) -> Dict[str, str]:
+  headers = {"Tus-Resumable": TUS_VERSION, "Cache-Control": "no-store"}
+  if upload is not None:
+    headers["Upload-Offset"] = str(upload.offset)
+    headers["Upload-Length"] = str(upload.length)
+    if upload.expires_at:
+      headers["Upload-Expires"] = formatdate(upload.expires_at, usegmt=True)
+  return headers
+
+
+def upload_error(exc: UploadError) -> JSONResponse:
+  return JSONResponse({"detail": str(exc)}, status_code=exc.status_code, headers=tus_headers())
+
+
+@router.options("")
+def tus_options() -> Response:
+  return Response(status_code=204, headers={
+    "Tus-Resumable": TUS_VERSION,
+    "Tus-Version": TUS_VERSION,
+    "Tus-Extension": TUS_EXTENSIONS,
+    "Tus-Max-Size": str(get_upload_store().max_bytes),
+    "Tus-Checksum-Algorithm": ",".join(CHECKSUM_ALGORITHMS),
+  })
+
+
+@router.post("", status_code=201)
+def create_upload(
+  upload_length: Optional[int] = Header(default=None),
+  upload_metadata: Optional[str] = Header(default=None),
+  client: str = Depends(resolve_client),
+) -> Response:
+  """Creates an empty upload of ``Upload-Length`` bytes; PATCH it, then pass ``upload=<id>`` to /segment/*."""
+  if upload_length is None:
+    return upload_error(UploadError(400, "Upload-Length is required (Upload-Defer-Length is not supported)"))
+  try:
+    upload = get_upload_store().create(upload_length, parse_metadata(upload_metadata), client)
+  except UploadError as exc:
+    return upload_error(exc)
+  return Response(status_code=201, headers={**tus_headers(upload), "Location": f"/uploads/{upload.upload_id}"})
+
+
+@router.head("/{upload_id}")
+def upload_offset(upload_id: str, client: str = Depends(resolve_client)) -> Response:
+  try:
+    upload = get_upload_store().get(upload_id, client)
+  except UploadError as exc:
+    return Response(status_code=exc.status_code, headers=tus_headers())
+  return Response(status_code=200, headers=tus_headers(upload))
+
+
+@router.patch("/{upload_id}")
+async def append_upload(
+  upload_id: str,
+  request: Request,
+  upload_offset: int = Header(...),
+  upload_checksum: Optional[str] = Header(default=None),
+  client: str = Depends(resolve_client),
+) -> Response:
+  if request.headers.get("content-type") != "application/offset+octet-stream":
+    return upload_error(UploadError(415, "PATCH bodies must be application/offset+octet-stream"))
+  store = get_upload_store()
+  try:
+    upload = store.get(upload_id, client)
+    await store.append(upload, upload_offset, request.stream(), upload_checksum)
+  except UploadError as exc:
+    return upload_error(exc)
+  except (InputRejected, NiftiError) as exc:
+    # The header arrived and is not a usable CT; the upload has been discarded.
+    rejection = exc if isinstance(exc, InputRejected) else InputRejected("malformed", str(exc))
+    INPUT_REJECTED.inc(reason=rejection.reason)
+    return JSONResponse({"detail": str(rejection)}, status_code=rejection.status_code, headers=tus_headers())
+  return Response(status_code=204, headers=tus_headers(upload))
+
+
+@router.delete("/{upload_id}")
+def delete_upload(upload_id: str, client: str = Depends(resolve_client)) -> Response:
+  try:
+    get_upload_store().delete(upload_id, client)
+  except UploadError as exc:
+    return upload_error(exc)
+  return Response(status_code=204, headers={"Tus-Resumable": TUS_VERSION})
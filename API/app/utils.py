@@ -1,17 +1,14 @@
-import json
+import hashlib
 import os
 import shlex
 import shutil
 import subprocess
-import tarfile
 import tempfile
+import threading
 import time
 import zipfile
-from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Iterable, Iterator, Optional
-
-from fastapi import UploadFile
+from typing import Dict, Optional
 
 from .config import get_settings
 
@@ -25,13 +22,21 @@ def run(cmd: str, *, env: Optional[Dict[str, str]] = None, cwd: Optional[Path] =
   if env:
     full_env.update(env)
 
-  processed = subprocess.run(
-    shlex.split(cmd),
-    capture_output=True,
-    text=True,
-    cwd=str(cwd) if cwd else None,
-    env=full_env,
-  )
+  # Reap the child with wait4 so its peak RSS can feed the cost model (see PeakMemory).
+  args = shlex.split(cmd)
+  with tempfile.TemporaryFile("w+") as stdout, tempfile.TemporaryFile("w+") as stderr:
+    # Own session so a SIGTERM/SIGINT aimed at the API's process group does not kill inference
+    # mid-stage; the API drains and lets the child finish (see drain.py).
+    proc = subprocess.Popen(
+      args, stdout=stdout, stderr=stderr, text=True, cwd=str(cwd) if cwd else None, env=full_env,
+      start_new_session=True,
+    )
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    stdout.seek(0)
+    stderr.seek(0)
+    processed = subprocess.CompletedProcess(args, proc.returncode, stdout.read(), stderr.read())
+  _record_child_rss(usage.ru_maxrss * 1024)
   if processed.returncode != 0:
     print("---- STDOUT ----\n" + processed.stdout, flush=True)
     print("---- STDERR ----\n" + processed.stderr, flush=True)
@@ -54,61 +59,71 @@ def uuid4_hex(length: int = 8) -> str:
   return uuid.uuid4().hex[:length]
 
 
-@contextmanager
-def temp_case_dirs(case_id: str) -> Iterator[Dict[str, Path]]:
-  settings = get_settings()
-  in_dir = settings.in_root / case_id
-  out_dir = settings.out_root / case_id
-  in_dir.mkdir(parents=True, exist_ok=True)
-  out_dir.mkdir(parents=True, exist_ok=True)
-  try:
-    yield {"in": in_dir, "out": out_dir}
-  finally:
-    if not settings.keep_intermediate:
-      shutil.rmtree(in_dir, ignore_errors=True)
-      shutil.rmtree(out_dir, ignore_errors=True)
+def hash_file(path: Path) -> str:
+  digest = hashlib.sha256()
+  with path.open("rb") as f:
+    while chunk := f.read(1024 * 1024):
+      digest.update(chunk)
+  return digest.hexdigest()
 
 
-def read_upload(file: UploadFile, target: Path) -> None:
-  data = file.file.read()
-  target.write_bytes(data)
+# Linux ioctl that makes ``target`` share the extents of ``source`` (reflink) on btrfs, XFS and similar.
+FICLONE = 0x40049409
 
 
-def package_outputs(source_dir: Path, *, base_name: str) -> Path:
-  temp_dir = Path(tempfile.gettempdir())
-  archive_path = temp_dir / f"{base_name}_results.zip"
-  if archive_path.exists():
-    archive_path.unlink()
-  shutil.make_archive(archive_path.with_suffix(""), "zip", source_dir)
-  return archive_path
+def _reflink(source: Path, target: Path) -> bool:
+  try:
+    import fcntl
+  except ImportError:
+    return False
+  with source.open("rb") as src, target.open("wb") as dst:
+    try:
+      fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+      return True
+    except OSError:
+      pass
+  target.unlink(missing_ok=True)
+  return False
+
+
+def place_file(source: Path, target: Path) -> int:
+  """
+  Puts ``source`` at ``target`` as a hardlink, else a reflink, else a copy.
+  Returns the bytes actually copied (0 unless it had to fall back to a copy).
+  """
+  if target.exists():
+    target.unlink()
+  try:
+    os.link(source, target)
+    return 0
+  except OSError:
+    pass
+  if _reflink(source, target):
+    return 0
+  shutil.copy2(source, target)
+  return target.stat().st_size
 
 
-def write_metadata(destination: Path, payload: Dict) -> Path:
-  destination.write_text(json.dumps(payload, indent=2))
-  return destination
+def link_or_copy(source: Path, target: Path) -> Path:
+  place_file(source, target)
+  return target
 
 
-def extract_archive(upload: UploadFile, work_dir: Path) -> Iterable[Path]:
+def package_outputs(source_dir: Path, *, base_name: str, dest_dir: Optional[Path] = None) -> Path:
   """
-  Supports .zip or .tar(.gz) archives. Returns directories for each case.
+  Zips ``source_dir`` into a uniquely named archive. Members that are already compressed
+  (.nii.gz masks) are stored, so packaging is a sequential copy rather than a second deflate.
   """
-  tmp_path = work_dir / upload.filename
-  with tmp_path.open("wb") as f:
-    shutil.copyfileobj(upload.file, f)
-
-  case_dirs: list[Path] = []
-  if zipfile.is_zipfile(tmp_path):
-    with zipfile.ZipFile(tmp_path) as zf:
-      zf.extractall(work_dir)
-    case_dirs = [d for d in (work_dir).iterdir() if d.is_dir()]
-  elif tarfile.is_tarfile(tmp_path):
-    with tarfile.open(tmp_path) as tf:
-      tf.extractall(work_dir)
-    case_dirs = [d for d in (work_dir).iterdir() if d.is_dir()]
-  else:
-    raise ValueError("Unsupported archive type; provide .zip or .tar.gz")
-  tmp_path.unlink(missing_ok=True)
-  return case_dirs
+  from .zipstream import compression_for
+
+  fd, name = tempfile.mkstemp(prefix=f"{base_name}_", suffix="_results.zip", dir=dest_dir)
+  archive_path = Path(name)
+  with os.fdopen(fd, "wb") as handle, zipfile.ZipFile(handle, "w", allowZip64=True) as archive:
+    for path in sorted(source_dir.rglob("*")):
+      if path.is_file():
+        arcname = path.relative_to(source_dir).as_posix()
+        archive.write(path, arcname, compress_type=compression_for(arcname))
+  return archive_path
 
 
 class Timer:
@@ -120,5 +135,26 @@ class Timer:
     self.duration = time.time() - self.start
 
 
+_memory = threading.local()
+
+
+class PeakMemory:
+  """Peak RSS (bytes) of the child processes started via ``run`` on this thread inside the block."""
+
+  def __enter__(self):
+    self.peak_bytes = 0
+    _memory.tracker = self
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    _memory.tracker = None
+
+
+def _record_child_rss(peak_bytes: int) -> None:
+  tracker = getattr(_memory, "tracker", None)
+  if tracker is not None:
+    tracker.peak_bytes = max(tracker.peak_bytes, peak_bytes)
+
+
 def log_execution(label: str, seconds: float) -> None:
   print(f"[{label}] {seconds:.2f}s", flush=True)
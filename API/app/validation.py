@@ -0,0 +1,92 @@
+"""Cheap checks that turn unusable uploads into specific 4xx errors before anything is queued."""
+from typing import Optional
+
+from .config import get_settings
+from .nifti import NiftiError, NiftiHeader
+
+# Plausible CT voxel sizes in mm (in-plane, slice direction).
+INPLANE_SPACING_MM = (0.1, 5.0)
+SLICE_SPACING_MM = (0.1, 20.0)
+MIN_INPLANE_VOXELS = 32
+# Every body CT contains air (about -1000 HU) around the patient; MR, PET and unscaled
+# exports do not. Anything outside the wider window is not in Hounsfield units at all.
+AIR_HU = -500.0
+HU_LIMITS = (-10000.0, 40000.0)
+SAMPLE_VOXELS = 4096
+
+REJECT_STATUS = {
+  "malformed": 400,
+  "truncated": 400,
+  "too_large": 413,
+  "datatype": 415,
+  "dimensions": 422,
+  "spacing": 422,
+  "not_ct": 422,
+}
+
+
+class InputRejected(ValueError):
+  def __init__(self, reason: str, message: str) -> None:
+    super().__init__(message)
+    self.reason = reason
+    self.status_code = REJECT_STATUS[reason]
+
+
+def check_header(header: NiftiHeader) -> None:
+  """Dimensionality, voxel spacing, size and datatype; raises InputRejected."""
+  settings = get_settings()
+  shape = header.shape
+  if len(shape) < 3 or any(n != 1 for n in shape[3:]):
+    raise InputRejected("dimensions", f"Expected a single 3D CT volume, got shape {list(shape)}")
+  nx, ny, nz = shape[:3]
+  if min(nx, ny) < MIN_INPLANE_VOXELS or nz < settings.min_slices:
+    raise InputRejected(
+      "dimensions",
+      f"Volume {nx}x{ny}x{nz} is too small (need at least {MIN_INPLANE_VOXELS}x{MIN_INPLANE_VOXELS}"
+      f"x{settings.min_slices})",
+    )
+  for axis, spacing in enumerate(header.spacing[:3]):
+    low, high = SLICE_SPACING_MM if axis == 2 else INPLANE_SPACING_MM
+    if not low <= spacing <= high:
+      raise InputRejected("spacing", f"Voxel spacing {spacing:g} mm on axis {axis} is outside {low:g}-{high:g} mm")
+  if header.voxels > settings.max_voxels:
+    raise InputRejected("too_large", f"Volume has {header.voxels} voxels; the limit is {settings.max_voxels}")
+  try:
+    header.dtype
+  except NiftiError as exc:
+    raise InputRejected("datatype", str(exc)) from exc
+
+
+def check_intensities(volume, header: NiftiHeader, samples: int = SAMPLE_VOXELS) -> None:
+  """Reads an evenly strided sample of voxels (a few pages of a memory map) and checks the HU range."""
+  import numpy as np
+
+  if not get_settings().check_hu:
+    return
+  flat = volume.reshape(-1, order="F")
+  picked = np.asarray(flat[np.linspace(0, flat.size - 1, min(samples, flat.size)).astype(np.int64)], dtype=np.float64)
+  slope = header.scl_slope if header.scl_slope != 0 and np.isfinite(header.scl_slope) else 1.0
+  inter = header.scl_inter if np.isfinite(header.scl_inter) else 0.0
+  values = picked * slope + inter
+  if not np.isfinite(values).all():
+    raise InputRejected("not_ct", "Volume contains NaN or infinite values")
+  low, high = float(values.min()), float(values.max())
+  if low < HU_LIMITS[0] or high > HU_LIMITS[1]:
+    raise InputRejected("not_ct", f"Intensities {low:g}..{high:g} are not Hounsfield units")
+  if low > AIR_HU:
+    raise InputRejected(
+      "not_ct", f"No air found (lowest sampled value {low:g} > {AIR_HU:g} HU); the volume does not look like CT",
+    )
+
+
+def validate_volume(header: Optional[NiftiHeader], complete: bool, volume_of) -> None:
+  """
+  Full check of an ingested upload: ``header`` is None when it was not NIfTI, ``complete`` is False
+  when it ended before the voxel data did, and ``volume_of()`` maps the voxels.
+  """
+  if header is None:
+    raise InputRejected("malformed", "Upload is not a NIfTI volume")
+  check_header(header)
+  if not complete:
+    raise InputRejected("truncated", "Upload ends before the voxel data does")
+  check_intensities(volume_of(), header)
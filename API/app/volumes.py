@@ -0,0 +1,165 @@
+"""
+Volumes handed between in-process stages as numpy arrays with their geometry. Before, one stage
+wrote a .nii.gz and the next gunzipped it again. Every consumer runs in the job's own process, so
+the arrays are plain numpy arrays; the decoded upload is memory-mapped where it lies. Compressed
+NIfTI is only written for final artifacts; intermediates that the stage cache keeps are written as
+plain .nii.
+"""
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from . import maskcodec
+from .config import get_settings
+from .nifti import read_header
+from .pgzip import compress_file, gzip_threads
+
+# Inputs written for external tools (the nnU-Net crop) only need to be valid .nii.gz, not small.
+FAST_COMPRESSION = 1
+
+
+@dataclass(frozen=True)
+class Geometry:
+  spacing: Tuple[float, ...]
+  origin: Tuple[float, ...]
+  direction: Tuple[float, ...]
+
+  @classmethod
+  def of(cls, image) -> "Geometry":
+    """From a SimpleITK image or ImageFileReader."""
+    return cls(tuple(image.GetSpacing()), tuple(image.GetOrigin()), tuple(image.GetDirection()))
+
+  def apply(self, image) -> None:
+    image.SetSpacing(self.spacing)
+    image.SetOrigin(self.origin)
+    image.SetDirection(self.direction)
+
+  def shifted(self, index) -> "Geometry":
+    """The geometry of a region starting at voxel ``index`` (x, y, z)."""
+    import numpy as np
+
+    dims = len(self.spacing)
+    offset = np.array(self.direction).reshape(dims, dims) @ (np.array(index, dtype=float) * np.array(self.spacing))
+    return Geometry(self.spacing, tuple(float(v) for v in np.array(self.origin) + offset), self.direction)
+
+
+@dataclass
+class Volume:
+  # (z, y, x) like SimpleITK's GetArrayFromImage.
+  array: Any
+  geometry: Geometry
+
+  @property
+  def size(self) -> Tuple[int, ...]:
+    """(x, y, z) as SimpleITK reports it."""
+    return tuple(int(n) for n in self.array.shape[::-1])
+
+  def like(self, array) -> "Volume":
+    return Volume(array, self.geometry)
+
+  def image(self):
+    import SimpleITK as sitk
+
+    image = sitk.GetImageFromArray(self.array)
+    self.geometry.apply(image)
+    return image
+
+
+def nifti_suffix(path: Path) -> str:
+  return ".nii.gz" if path.name.endswith(".nii.gz") else path.suffix
+
+
+def with_nifti_suffix(path: Path, suffix: str) -> Path:
+  return path.with_name(path.name[: -len(nifti_suffix(path))] + suffix)
+
+
+def _mapped(path: Path) -> Optional[Volume]:
+  """Maps an uncompressed 3D .nii without copying when its voxels need no scaling."""
+  import numpy as np
+  import SimpleITK as sitk
+
+  if nifti_suffix(path) != ".nii":
+    return None
+  header = read_header(path)
+  if len(header.shape) != 3 or header.scl_slope not in (0.0, 1.0) or header.scl_inter != 0.0:
+    return None
+  reader = sitk.ImageFileReader()
+  reader.SetFileName(str(path))
+  reader.ReadImageInformation()
+  if tuple(reader.GetSize()) != header.shape:
+    return None
+  data = np.memmap(path, dtype=header.dtype, mode="r", offset=header.vox_offset, shape=header.shape, order="F")
+  return Volume(data.T, Geometry.of(reader))
+
+
+def read_volume(path: Path) -> Volume:
+  import SimpleITK as sitk
+
+  mapped = _mapped(path)
+  if mapped is not None:
+    return mapped
+  image = sitk.ReadImage(str(path))
+  return Volume(sitk.GetArrayFromImage(image), Geometry.of(image))
+
+
+def write_volume(volume: Volume, path: Path, *, compression: Optional[int] = None) -> Path:
+  """
+  Writes plain .nii or, by ``path``'s suffix, .nii.gz. For .nii.gz the plain file is gzipped
+  block-parallel (see pgzip.py) at ``compression``, which defaults to HPB_GZIP_LEVEL.
+  """
+  import SimpleITK as sitk
+
+  path.parent.mkdir(parents=True, exist_ok=True)
+  if nifti_suffix(path) != ".nii.gz":
+    sitk.WriteImage(volume.image(), str(path), False)
+    return path
+  if gzip_threads() <= 1:
+    # One thread gains nothing from blocks, and ITK's own deflate is at least as fast as Python's zlib.
+    sitk.WriteImage(volume.image(), str(path), True, get_settings().gzip_level if compression is None else compression)
+    return path
+  plain = path.with_name(f".{path.name[:-3]}")
+  sitk.WriteImage(volume.image(), str(plain), False)
+  return compress_file(plain, path, level=compression, remove_source=True)
+
+
+def write_compact(volume: Volume, path: Path) -> Path:
+  """Writes a label map in the compact .hpbm format (see maskcodec.py)."""
+  g = volume.geometry
+  path.parent.mkdir(parents=True, exist_ok=True)
+  path.write_bytes(maskcodec.encode(volume.array, g.spacing, g.origin, g.direction))
+  return path
+
+
+class VolumeExchange:
+  """
+  One job's named volumes. ``load`` reads a stage's output file at most once, whichever stage asks
+  first; ``put`` registers a volume a stage computed. ``close`` drops every reference.
+  """
+
+  def __init__(self) -> None:
+    self._volumes: Dict[str, Volume] = {}
+    self._sources: Dict[str, Path] = {}
+
+  def __enter__(self) -> "VolumeExchange":
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.close()
+
+  def put(self, name: str, volume: Volume, source: Optional[Path] = None) -> Volume:
+    self._sources.pop(name, None)
+    self._volumes[name] = volume
+    if source is not None:
+      self._sources[name] = source
+    return volume
+
+  def load(self, name: str, path: Path) -> Volume:
+    """The volume read from (or produced for) ``path`` under any name, else ``path`` read now as ``name``."""
+    for known, source in self._sources.items():
+      if source == path:
+        return self._volumes[known]
+    return self.put(name, read_volume(path), source=path)
+
+  def close(self) -> None:
+    self._volumes.clear()
+    self._sources.clear()
@@ -0,0 +1,271 @@
+"""Inference workers: the in-process pool and the remote `python -m app.worker` node."""
+import argparse
+import json
+import shutil
+import signal
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .config import get_settings
+from .dicom import expand_archive
+from .jobs import Job, JobQueue, job_scratch
+from .pipeline import Preempted, execute
+from .s3 import fetch_input
+from .scratch import expected_bytes, get_scratch_manager
+from .validation import InputRejected, check_header, validate_volume
+
+LOCAL_WORKER_ID = "local"
+
+
+def fetch_job_input(uri: str, ct_path: Path, params: Dict[str, Any]) -> str:
+  """Pulls an s3:// input onto this node, converts/validates it like an upload and returns its content hash."""
+  received = expand_archive(fetch_input(uri, ct_path), ct_path, params, check_header=check_header)
+  validate_volume(received.header, received.complete, received.volume)
+  return received.content_hash
+
+
+def process_job(queue: JobQueue, job: Job) -> None:
+  job_scratch(job.job_id)
+  scratch_manager = get_scratch_manager()
+  try:
+    if job.input_uri and not job.input_path.exists():
+      job.content_hash = fetch_job_input(job.input_uri, job.input_path, job.params)
+    # Stages write to RAM when the node has room for this volume; release_job frees it.
+    scratch = scratch_manager.open(job.job_id, expected_bytes(job.input_path))
+    result_path, metadata = execute(
+      job.kind, job.input_path, scratch.root, case_id=job.case_id, params=job.params, content_hash=job.content_hash,
+      should_yield=lambda: queue.should_preempt(job.job_id),
+      checkpoint=lambda stage: scratch_manager.checkpoint(scratch, stage),
+    )
+  except Preempted:
+    queue.requeue(job.job_id, worker_id=job.worker_id)
+    return
+  except InputRejected as exc:
+    queue.fail(job.job_id, str(exc), rejected=exc.reason)
+    return
+  except Exception as exc:
+    queue.fail(job.job_id, str(exc))
+    return
+  queue.complete(job.job_id, result_path, metadata)
+
+
+class LocalWorkerPool:
+  """Threads that claim jobs from the shared queue and run them on this host."""
+
+  def __init__(self, queue: JobQueue, size: int) -> None:
+    self.queue = queue
+    self.size = size
+    self._stop = threading.Event()
+    self._threads: List[threading.Thread] = []
+
+  def start(self) -> None:
+    if self.size <= 0:
+      return
+    self.queue.register_worker(socket.gethostname(), capacity=self.size, worker_id=LOCAL_WORKER_ID)
+    for index in range(self.size):
+      thread = threading.Thread(target=self._loop, name=f"hpb-local-{index}", daemon=True)
+      thread.start()
+      self._threads.append(thread)
+
+  def stop(self) -> None:
+    self._stop.set()
+    for thread in self._threads:
+      thread.join(timeout=1.0)
+
+  def _loop(self) -> None:
+    while not self._stop.is_set():
+      self.queue.heartbeat(LOCAL_WORKER_ID)
+      job = self.queue.claim(LOCAL_WORKER_ID, timeout=1.0)
+      if job is not None:
+        process_job(self.queue, job)
+
+
+class WorkerReaper:
+  """Requeues jobs held by remote workers whose heartbeats have stopped."""
+
+  def __init__(self, queue: JobQueue, timeout: float) -> None:
+    self.queue = queue
+    self.timeout = timeout
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._loop, name="hpb-reaper", daemon=True)
+
+  def start(self) -> None:
+    self._thread.start()
+
+  def stop(self) -> None:
+    self._stop.set()
+
+  def _loop(self) -> None:
+    while not self._stop.wait(self.timeout / 3):
+      for worker_id in self.queue.expire_workers(self.timeout, keep=(LOCAL_WORKER_ID,)):
+        print(f"[reaper] worker {worker_id} expired; requeued its jobs", flush=True)
+
+
+class RemoteWorker:
+  """Registers with a coordinator over HTTP, pulls jobs, runs them locally and pushes results back."""
+
+  def __init__(self, coordinator_url: str, *, name: str, token: str, capacity: int = 1,
+               poll_seconds: float = 20.0) -> None:
+    self.base_url = coordinator_url.rstrip("/")
+    self.token = token
+    self.name = name
+    self.capacity = max(1, capacity)
+    self.poll_seconds = poll_seconds
+    self.worker_id: Optional[str] = None
+    self.heartbeat_seconds = 10.0
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._exited = threading.Event()
+
+  def _request(self, method: str, path: str, *, payload: Any = None, data: Optional[bytes] = None,
+               headers: Optional[Dict[str, str]] = None, timeout: float = 60.0):
+    headers = {**(headers or {}), "X-Worker-Token": self.token}
+    if payload is not None:
+      data = json.dumps(payload).encode()
+      headers["Content-Type"] = "application/json"
+    request = urllib.request.Request(f"{self.base_url}{path}", data=data, method=method, headers=headers)
+    return urllib.request.urlopen(request, timeout=timeout)
+
+  def register(self) -> str:
+    with self._request("POST", "/workers/register", payload={"name": self.name, "capacity": self.capacity}) as resp:
+      body = json.loads(resp.read())
+    with self._lock:
+      self.worker_id = body["worker_id"]
+      self.heartbeat_seconds = float(body.get("heartbeat_seconds", self.heartbeat_seconds))
+    print(f"[worker] registered as {self.worker_id}", flush=True)
+    return self.worker_id
+
+  def _heartbeat_loop(self) -> None:
+    # Keeps beating while a stopping worker finishes its current jobs.
+    while not self._exited.wait(self.heartbeat_seconds):
+      try:
+        with self._request("POST", f"/workers/{self.worker_id}/heartbeat"):
+          pass
+      except urllib.error.HTTPError as exc:
+        if exc.code == 404:
+          self.register()
+      except OSError as exc:
+        print(f"[worker] heartbeat failed: {exc}", flush=True)
+
+  def _claim(self) -> Optional[Dict[str, Any]]:
+    path = f"/workers/{self.worker_id}/claim?wait={self.poll_seconds}"
+    with self._request("POST", path, timeout=self.poll_seconds + 30) as resp:
+      if resp.status == 204:
+        return None
+      return json.loads(resp.read())
+
+  def _should_yield(self, worker_id: str, job_id: str) -> bool:
+    try:
+      with self._request("GET", f"/workers/{worker_id}/jobs/{job_id}/preempt") as resp:
+        return bool(json.loads(resp.read()).get("preempt"))
+    except OSError:
+      return False
+
+  def _run_one(self, spec: Dict[str, Any]) -> None:
+    settings = get_settings()
+    job_id = spec["job_id"]
+    worker_id = self.worker_id
+    in_dir = settings.in_root / job_id
+    in_dir.mkdir(parents=True, exist_ok=True)
+    ct_path = in_dir / "input.nii.gz"
+    scratch_manager = get_scratch_manager()
+    content_hash = spec.get("content_hash")
+    try:
+      if not spec.get("input_uri"):
+        with self._request("GET", f"/workers/{worker_id}/jobs/{job_id}/input", timeout=600) as resp, ct_path.open("wb") as f:
+          shutil.copyfileobj(resp, f)
+      try:
+        if spec.get("input_uri"):
+          content_hash = fetch_job_input(spec["input_uri"], ct_path, spec["params"])
+        scratch = scratch_manager.open(job_id, expected_bytes(ct_path))
+        result_path, metadata = execute(
+          spec["kind"], ct_path, scratch.root,
+          case_id=spec["case_id"], params=spec["params"], content_hash=content_hash,
+          should_yield=lambda: self._should_yield(worker_id, job_id),
+          checkpoint=lambda stage: scratch_manager.checkpoint(scratch, stage),
+        )
+      except Preempted:
+        self._request("POST", f"/workers/{worker_id}/jobs/{job_id}/requeue").close()
+        return
+      except InputRejected as exc:
+        payload = {"error": str(exc), "rejected": exc.reason}
+        self._request("POST", f"/workers/{worker_id}/jobs/{job_id}/fail", payload=payload).close()
+        return
+      except Exception as exc:
+        self._request("POST", f"/workers/{worker_id}/jobs/{job_id}/fail", payload={"error": str(exc)}).close()
+        return
+      headers = {
+        "Content-Type": "application/octet-stream",
+        "Content-Length": str(result_path.stat().st_size),
+        "X-Job-Metadata": json.dumps(metadata),
+      }
+      with result_path.open("rb") as body:
+        self._request("PUT", f"/workers/{worker_id}/jobs/{job_id}/result", data=body, headers=headers, timeout=600).close()
+    finally:
+      scratch_manager.close(job_id, keep=settings.keep_intermediate)
+      if not settings.keep_intermediate:
+        shutil.rmtree(in_dir, ignore_errors=True)
+
+  def _slot_loop(self) -> None:
+    while not self._stop.is_set():
+      try:
+        spec = self._claim()
+      except urllib.error.HTTPError as exc:
+        if exc.code == 404:
+          self.register()
+        else:
+          time.sleep(2.0)
+        continue
+      except OSError as exc:
+        print(f"[worker] coordinator unreachable: {exc}", flush=True)
+        time.sleep(2.0)
+        continue
+      if spec is None:
+        continue
+      try:
+        self._run_one(spec)
+      except OSError as exc:
+        print(f"[worker] job {spec['job_id']} aborted: {exc}", flush=True)
+
+  def serve_forever(self) -> None:
+    self.register()
+    threading.Thread(target=self._heartbeat_loop, name="hpb-heartbeat", daemon=True).start()
+    slots = [threading.Thread(target=self._slot_loop, name=f"hpb-slot-{i}", daemon=True) for i in range(self.capacity)]
+    for slot in slots:
+      slot.start()
+    try:
+      while any(slot.is_alive() for slot in slots):
+        time.sleep(1.0)
+    except KeyboardInterrupt:
+      self._stop.set()
+    self._exited.set()
+
+  def stop(self) -> None:
+    """Stops claiming; jobs already running finish and push their results first."""
+    print("[worker] stopping after current jobs", flush=True)
+    self._stop.set()
+
+
+def main() -> None:
+  settings = get_settings()
+  parser = argparse.ArgumentParser(description="Run an HPB inference worker against a coordinator")
+  parser.add_argument("--coordinator", default=settings.coordinator_url)
+  parser.add_argument("--name", default=socket.gethostname())
+  parser.add_argument("--capacity", type=int, default=1, help="Concurrent jobs on this worker")
+  parser.add_argument("--poll", type=float, default=20.0, help="Long-poll seconds per claim")
+  args = parser.parse_args()
+  if not settings.worker_token:
+    parser.error("HPB_WORKER_TOKEN must be set to the coordinator's worker token")
+  worker = RemoteWorker(args.coordinator, name=args.name, token=settings.worker_token, capacity=args.capacity,
+                        poll_seconds=args.poll)
+  signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+  worker.serve_forever()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,70 @@
+"""Zip archives written as a stream, so a response can start before its last member exists."""
+import zipfile
+from typing import BinaryIO, Iterator
+
+CHUNK_BYTES = 1024 * 1024
+# Members that are already compressed are stored; deflating them again only costs CPU.
+PRECOMPRESSED_SUFFIXES = (".gz", ".zip", ".npz", ".png", ".jpg")
+
+
+def compression_for(name: str) -> int:
+  return zipfile.ZIP_STORED if name.lower().endswith(PRECOMPRESSED_SUFFIXES) else zipfile.ZIP_DEFLATED
+
+
+class StreamingZip:
+  """
+  ``zipfile`` writer over an in-memory buffer without ``seek``: zipfile then emits data descriptors
+  instead of patching local headers, and every ``add_*`` generator yields the finished bytes as it goes.
+  """
+
+  def __init__(self) -> None:
+    self._buffer = bytearray()
+    self._position = 0
+    self._zip = zipfile.ZipFile(self, "w", allowZip64=True)
+
+  # File protocol used by zipfile.
+  def write(self, data: bytes) -> int:
+    self._buffer += data
+    self._position += len(data)
+    return len(data)
+
+  def tell(self) -> int:
+    return self._position
+
+  def flush(self) -> None:
+    pass
+
+  def _drain(self) -> bytes:
+    data, self._buffer = bytes(self._buffer), bytearray()
+    return data
+
+  def add_stream(self, arcname: str, source: BinaryIO, size: int) -> Iterator[bytes]:
+    info = zipfile.ZipInfo(arcname)
+    info.compress_type = compression_for(arcname)
+    info.file_size = size
+    with self._zip.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+      while chunk := source.read(CHUNK_BYTES):
+        member.write(chunk)
+        if len(self._buffer) >= CHUNK_BYTES:
+          yield self._drain()
+    yield self._drain()
+
+  def add_bytes(self, arcname: str, data: bytes) -> Iterator[bytes]:
+    info = zipfile.ZipInfo(arcname)
+    info.compress_type = compression_for(arcname)
+    self._zip.writestr(info, data)
+    yield self._drain()
+
+  def add_zip(self, prefix: str, path) -> Iterator[bytes]:
+    """Copies every member of the zip at ``path`` under ``prefix/``."""
+    with zipfile.ZipFile(path) as source:
+      for info in source.infolist():
+        if info.is_dir():
+          continue
+        with source.open(info) as member:
+          yield from self.add_stream(f"{prefix}/{info.filename}", member, info.file_size)
+
+  def close(self) -> Iterator[bytes]:
+    """Writes the central directory."""
+    self._zip.close()
+    yield self._drain()
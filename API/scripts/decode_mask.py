@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Converts a compact .hpbm mask (``mask_format=compact``) back to NIfTI, or checks it against one."""
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+
+# app/maskcodec.py only needs numpy (and zstandard); clients can also copy it next to this script.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from app.maskcodec import decode  # noqa: E402
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("mask", type=Path, help=".hpbm file from the API")
+  parser.add_argument("-o", "--output", type=Path, help="Write the label map as .nii/.nii.gz")
+  parser.add_argument("--compare", type=Path, help="NIfTI mask the .hpbm must match voxel for voxel")
+  args = parser.parse_args()
+
+  labels, header = decode(args.mask.read_bytes())
+  present = {entry["value"]: entry["voxels"] for entry in header["labels"]}
+  print(f"{args.mask.name}: shape {tuple(header['shape'][::-1])} (x, y, z), codec {header['codec']}, labels {present}")
+
+  if args.output:
+    image = sitk.GetImageFromArray(labels)
+    image.SetSpacing(header["spacing"])
+    image.SetOrigin(header["origin"])
+    image.SetDirection(header["direction"])
+    sitk.WriteImage(image, str(args.output), args.output.name.endswith(".gz"))
+    print(f"Wrote {args.output}")
+
+  if args.compare:
+    reference = sitk.ReadImage(str(args.compare))
+    expected = sitk.GetArrayFromImage(reference)
+    problems = []
+    if expected.shape != labels.shape:
+      problems.append(f"shape {labels.shape} != {expected.shape}")
+    elif not np.array_equal(expected, labels):
+      problems.append(f"{int(np.count_nonzero(expected != labels))} voxels differ")
+    for name, value in (("spacing", reference.GetSpacing()), ("origin", reference.GetOrigin()),
+                        ("direction", reference.GetDirection())):
+      if not np.allclose(header[name], value, atol=1e-5):
+        problems.append(f"{name} {header[name]} != {list(value)}")
+    if problems:
+      print(f"Mismatch against {args.compare}: {'; '.join(problems)}")
+      sys.exit(1)
+    print(f"Matches {args.compare}")
+
+
+if __name__ == "__main__":
+  main()
@@ -29,18 +29,31 @@ def main() -> None:
   parser.add_argument("cases", type=Path, help="Directory with case subfolders")
   parser.add_argument("--endpoint", default="http://localhost:8080/segment/batch")
   parser.add_argument("--fast", action="store_true", help="Enable TotalSegmentator fast mode")
+  parser.add_argument("--api-key", help="Sent as X-API-Key; usage is accounted to the key's client")
+  parser.add_argument("--publish", action="store_true", help="Have the server upload each case to HPB_S3_BUCKET")
   args = parser.parse_args()
 
   archive_bytes = build_archive(args.cases)
   files = {"bundle": ("batch.zip", archive_bytes, "application/zip")}
-  data = {"fast": str(args.fast).lower()}
-  response = requests.post(args.endpoint, files=files, data=data, timeout=3600)
-  response.raise_for_status()
-
+  params = {"fast": str(args.fast).lower(), "publish": str(args.publish).lower()}
+  headers = {"X-API-Key": args.api_key} if args.api_key else {}
   output_path = Path("batch_results.zip")
-  output_path.write_bytes(response.content)
+  # The server streams the zip as cases finish; write it out as it arrives.
+  with requests.post(args.endpoint, files=files, params=params, headers=headers, timeout=3600, stream=True) as response:
+    response.raise_for_status()
+    with output_path.open("wb") as out:
+      for chunk in response.iter_content(chunk_size=1024 * 1024):
+        out.write(chunk)
   print(f"Results saved to {output_path.resolve()}")
 
+  with zipfile.ZipFile(output_path) as zf:
+    manifest = json.loads(zf.read("manifest.json"))
+  if manifest.get("failed"):
+    print(f"Failed cases: {', '.join(manifest['failed'])}")
+  if "publish" in manifest:
+    published = manifest["publish"]
+    print(f"Published to S3: {json.dumps({k: published[k] for k in ('bytes', 'mb_per_s', 'span_seconds', 'failed')})}")
+
 
 if __name__ == "__main__":
   main()
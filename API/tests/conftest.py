@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# Settings are read once per process (get_settings is cached), so point every root at a scratch
+# directory before the app is imported. RAM scratch is off so tests never touch /dev/shm.
+ROOT = Path(tempfile.mkdtemp(prefix="hpb-tests-"))
+os.environ.update({
+  "HPB_IN_ROOT": str(ROOT / "in"),
+  "HPB_OUT_ROOT": str(ROOT / "out"),
+  "HPB_CACHE_ROOT": str(ROOT / "cache"),
+  "HPB_RESULT_ROOT": str(ROOT / "results"),
+  "HPB_SCRATCH_RAM_GB": "0",
+  "HPB_LOCAL_WORKERS": "0",
+})
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+@pytest.fixture
+def settings():
+  from app.config import get_settings
+
+  return get_settings()
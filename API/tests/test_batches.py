@@ -0,0 +1,121 @@
+import json
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+
+from app.batches import FAILED, PENDING, BatchCase, BatchRun, get_batch_registry
+from app.drain import batch_state_path, restore_jobs, save_batches, save_jobs, state_path
+from app.jobs import DONE, PERSISTED, Job, JobQueue
+
+
+def make_job(case: BatchCase) -> Job:
+  return Job(job_id=f"job-{case.case_id}", kind="both", case_id=case.case_id,
+             input_path=Path(f"/nonexistent/{case.case_id}.nii.gz"), input_uri=case.source, client="alice")
+
+
+def make_run(batch_id: str, *, stop, started, finished, record=None, jobs=None) -> BatchRun:
+  def start_case(case):
+    job = make_job(case)
+    started.append(job)
+    return job
+
+  callbacks = {
+    "start_case": start_case,
+    "finish_case": lambda case, job: finished.append(case.case_id),
+    "finish_batch": lambda run: {"index_key": "done"},
+    "should_stop": lambda: stop[0],
+  }
+  if record is not None:
+    return BatchRun.from_record(record, jobs, **callbacks)
+  cases = [BatchCase(case_id=f"c{i}", source=f"s3://bucket/c{i}.nii.gz") for i in range(3)]
+  return BatchRun(batch_id, cases, chunk=1, client="alice", params={"fast": True},
+                  options={"priority": "bulk", "publish": False}, **callbacks)
+
+
+def complete(job: Job, status: str = DONE) -> None:
+  job.status = status
+  job.finish()
+
+
+def test_drained_batch_is_suspended_and_resumed_with_its_job():
+  stop, started, finished = [False], [], []
+  run = make_run("batch-t1", stop=stop, started=started, finished=finished).start()
+  while not started:
+    run.join(0.01)
+  # A drain: nothing new is queued and the running job is persisted.
+  stop[0] = True
+  complete(started[0], PERSISTED)
+  run.join(5)
+  assert run.suspended and run.finished_at is None
+  assert [case.status for case in run.cases] == [PERSISTED, PENDING, PENDING]
+
+  record = json.loads(json.dumps(run.to_record()))
+  restored = Job.from_record(started[0].to_record())
+  started.clear()
+  resumed = make_run("", stop=[False], started=started, finished=finished, record=record,
+                     jobs={restored.job_id: restored}).start()
+  complete(restored)
+  while resumed.finished_at is None:
+    for job in started:
+      if not job.done.is_set():
+        complete(job)
+    resumed.join(0.05)
+  assert finished == ["c0", "c1", "c2"]
+  assert resumed.created_at == run.created_at
+  assert resumed.describe()["index_key"] == "done"
+
+
+def test_restore_jobs_hands_saved_batches_their_jobs():
+  stop, started, finished = [True], [], []
+  run = make_run("batch-t2", stop=stop, started=started, finished=finished)
+  run.cases[0].status, run.cases[0].job_id = PERSISTED, "job-c0"
+  run.cases[1].status, run.cases[1].job_id = PERSISTED, "job-gone"
+  job = make_job(run.cases[0])
+  state_path().parent.mkdir(parents=True, exist_ok=True)
+  save_jobs(state_path(), [job])
+  save_batches(batch_state_path(), [run])
+
+  resumed = []
+  queue = JobQueue()
+  restored = restore_jobs(queue, resume_batch=lambda record, jobs: resumed.append(
+    BatchRun.from_record(record, jobs, start_case=make_job, finish_case=None, finish_batch=None,
+                         should_stop=lambda: True)))
+  assert [j.job_id for j in restored] == ["job-c0"]
+  assert not state_path().exists() and not batch_state_path().exists()
+  assert [case.status for case in resumed[0].cases] == ["queued", FAILED, PENDING]
+  assert resumed[0]._attached == {"job-c0": restored[0]}
+  queue.take_pending()
+
+
+def test_only_the_owner_can_cancel_a_batch():
+  from app.main import app
+
+  stop, started, finished = [True], [], []
+  run = make_run("batch-t3", stop=stop, started=started, finished=finished)
+  get_batch_registry().add(run)
+  client = TestClient(app)
+  assert client.delete("/batches/batch-t3", headers={"X-Client-Id": "mallory"}).status_code == 404
+  assert not run.cancelled
+  response = client.delete("/batches/batch-t3", headers={"X-Client-Id": "alice"})
+  assert response.status_code == 200 and run.cancelled
+
+
+def test_batches_are_only_visible_to_their_owner():
+  from app.main import app
+
+  stop, started, finished = [True], [], []
+  run = make_run("batch-t4", stop=stop, started=started, finished=finished)
+  get_batch_registry().add(run)
+  client = TestClient(app)
+  alice, mallory = {"X-Client-Id": "alice"}, {"X-Client-Id": "mallory"}
+  assert "batch-t4" in [b["batch_id"] for b in client.get("/batches", headers=alice).json()["batches"]]
+  assert "batch-t4" not in [b["batch_id"] for b in client.get("/batches", headers=mallory).json()["batches"]]
+  assert client.get("/batches/batch-t4", headers=alice).status_code == 200
+  assert client.get("/batches/batch-t4", headers=mallory).status_code == 404
+  assert client.get("/batches/batch-t4/index", headers=alice).status_code == 202
+  assert client.get("/batches/batch-t4/index", headers=mallory).status_code == 404
+  # A finished index on disk still knows its owner after the registry has forgotten the batch.
+  run._checkpoint(force=True)
+  get_batch_registry()._runs.pop("batch-t4")
+  assert client.get("/batches/batch-t4/index", headers=alice).status_code == 200
+  assert client.get("/batches/batch-t4/index", headers=mallory).status_code == 404
@@ -0,0 +1,100 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from app.bundle import ZIP_DESCRIPTOR, BundleError, extract_cases
+from app.validation import InputRejected
+from app.zipstream import StreamingZip
+
+
+def streamed_zip(members):
+  archive = StreamingZip()
+  data = b""
+  for name, payload in members.items():
+    data += b"".join(archive.add_stream(name, io.BytesIO(payload), len(payload)))
+  return data + b"".join(archive.close())
+
+
+def extract(data, dest, max_cases=10, max_bytes=1 << 30):
+  cases = []
+  count = extract_cases(io.BytesIO(data), dest, cases.append, max_cases=max_cases, max_bytes=max_bytes)
+  assert count == len(cases)
+  return [case.case_id for case in cases]
+
+
+def test_streamed_zip_with_stored_members_round_trips(tmp_path):
+  # Stored .gz members with data descriptors, as in a downloaded batch zip; the payload also holds
+  # a descriptor signature that must not be taken for the end of the member.
+  members = {
+    "c1/raw.nii.gz": os.urandom(3 * 1024 * 1024) + ZIP_DESCRIPTOR + os.urandom(100),
+    "c1/notes.txt": b"liver " * 1000,
+    "c2/raw.nii.gz": ZIP_DESCRIPTOR * 10,
+    "c3/raw.nii.gz": b"",
+  }
+  data = streamed_zip(members)
+  with zipfile.ZipFile(io.BytesIO(data)) as check:
+    assert all(info.flag_bits & 0x08 for info in check.infolist())
+    assert check.getinfo("c1/raw.nii.gz").compress_type == zipfile.ZIP_STORED
+
+  assert extract(data, tmp_path) == ["c1", "c2", "c3"]
+  for name, payload in members.items():
+    assert (tmp_path / name).read_bytes() == payload
+
+
+def test_corrupt_stored_member_is_rejected(tmp_path):
+  data = bytearray(streamed_zip({"c1/raw.nii.gz": b"x" * 5000}))
+  data[100] ^= 0xFF
+  with pytest.raises(BundleError):
+    extract(bytes(data), tmp_path)
+
+
+def test_tar_bundle_and_skipped_members(tmp_path):
+  buffer = io.BytesIO()
+  with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+    for name, payload in (("c1/raw.nii.gz", b"one"), ("__MACOSX/c1/._raw", b"junk"), ("c2/raw.nii.gz", b"two")):
+      info = tarfile.TarInfo(name)
+      info.size = len(payload)
+      archive.addfile(info, io.BytesIO(payload))
+  assert extract(buffer.getvalue(), tmp_path) == ["c1", "c2"]
+  assert (tmp_path / "c2" / "raw.nii.gz").read_bytes() == b"two"
+  assert not (tmp_path / "__MACOSX").exists()
+
+
+def test_split_case_and_unsafe_paths_are_rejected(tmp_path):
+  with pytest.raises(BundleError, match="not together"):
+    extract(streamed_zip({"c1/a.txt": b"a", "c2/a.txt": b"b", "c1/b.txt": b"c"}), tmp_path / "split")
+  with pytest.raises(BundleError, match="outside"):
+    extract(streamed_zip({"../c1/a.txt": b"a"}), tmp_path / "escape")
+  with pytest.raises(BundleError, match="Too many"):
+    extract(streamed_zip({"c1/a.txt": b"a", "c2/a.txt": b"b"}), tmp_path / "many", max_cases=1)
+
+
+def test_bundle_that_expands_beyond_the_limit_is_rejected(tmp_path):
+  # 8 MB of zeros deflates to a few KB; the limit applies to what the members expand to.
+  buffer = io.BytesIO()
+  with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+    archive.writestr("c1/raw.nii.gz", b"\0" * (4 << 20))
+    archive.writestr("c2/raw.nii.gz", b"\0" * (4 << 20))
+  assert len(buffer.getvalue()) < 64 * 1024
+  assert extract(buffer.getvalue(), tmp_path / "fits", max_bytes=8 << 20) == ["c1", "c2"]
+  with pytest.raises(InputRejected) as caught:
+    extract(buffer.getvalue(), tmp_path / "bomb", max_bytes=6 << 20)
+  assert caught.value.reason == "too_large" and caught.value.status_code == 413
+  # Skipped members count too.
+  with pytest.raises(InputRejected):
+    extract(streamed_zip({"__MACOSX/c1/x": b"x" * 2048}), tmp_path / "skipped", max_bytes=1024)
+
+
+def test_batch_endpoint_answers_413_for_an_oversized_bundle(settings, monkeypatch):
+  from fastapi.testclient import TestClient
+
+  from app.main import app
+
+  monkeypatch.setattr(settings, "bundle_max_gb", 1 / 1024)  # 1 MiB
+  bundle = streamed_zip({"c1/raw.nii.gz": os.urandom(2 << 20)})
+  response = TestClient(app).post("/segment/batch", content=bundle, headers={"Content-Type": "application/zip"})
+  assert response.status_code == 413
+  assert not list(settings.out_root.glob("batch_*"))
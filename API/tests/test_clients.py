@@ -0,0 +1,54 @@
+from pathlib import Path
+
+import pytest
+
+from app.clients import ClientRegistry
+from app.jobs import Job, JobQueue
+
+
+def make_job(job_id: str, cost: float) -> Job:
+  job = Job(job_id=job_id, kind="liver", case_id=job_id, input_path=Path(f"/nonexistent/{job_id}.nii.gz"),
+            client="alice")
+  job.cost_seconds = cost
+  return job
+
+
+@pytest.fixture
+def setup():
+  registry = ClientRegistry(rate=1.0, burst=500.0, weights={}, api_keys={})
+  queue = JobQueue()
+  queue.add_listener(registry.settle)
+  queue.register_worker("w", worker_id="w")
+  return registry, queue
+
+
+def run(registry, queue, job):
+  registry.charge(job.client, job.cost_seconds)
+  queue.submit(job)
+  return queue.claim("w")
+
+
+def account(registry):
+  return next(c for c in registry.snapshot()["clients"] if c["client"] == "alice")
+
+
+def test_completed_job_is_settled_at_the_compute_it_used(setup):
+  registry, queue = setup
+  job = run(registry, queue, make_job("done", 100.0))
+  stages = [{"stage": "liver", "seconds": 30.0}, {"stage": "task008", "seconds": 50.0, "cached": True}]
+  queue.complete(job.job_id, Path("/tmp/result"), {"stages": stages})
+  summary = account(registry)
+  assert summary["charged_seconds"] == 30.0 and summary["compute_seconds"] == 30.0
+  assert (summary["completed"], summary["failed"]) == (1, 0)
+
+
+@pytest.mark.parametrize("rejected", [None, "dimensions"])
+def test_failed_job_is_refunded(setup, rejected):
+  registry, queue = setup
+  job = run(registry, queue, make_job("failed", 100.0))
+  assert account(registry)["tokens"] < 401
+  queue.fail(job.job_id, "inference crashed", rejected=rejected)
+  summary = account(registry)
+  assert summary["charged_seconds"] == 0.0 and summary["compute_seconds"] == 0.0
+  assert (summary["completed"], summary["failed"]) == (0, 1)
+  assert summary["tokens"] > 499
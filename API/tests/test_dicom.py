@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from app import dicom
+from app.dicom import DicomSlice, convert_series
+from app.validation import InputRejected, check_header
+
+
+def write_slice(path, pixels, z, series="1.2.3"):
+  image = sitk.GetImageFromArray(pixels)
+  writer = sitk.ImageFileWriter()
+  writer.KeepOriginalImageUIDOn()
+  for tag, value in (("0020|000e", series), ("0020|0032", f"0\\0\\{z}"), ("0020|0037", "1\\0\\0\\0\\1\\0"),
+                     ("0028|0030", "0.8\\0.8"), ("0018|0050", "2.5")):
+    image.SetMetaData(tag, value)
+  writer.SetFileName(str(path))
+  writer.Execute(image)
+  return path
+
+
+def test_slices_are_stacked_in_position_order(tmp_path):
+  volume = np.random.default_rng(0).integers(-1000, 1000, size=(20, 64, 64)).astype(np.int16)
+  # Written in reverse so the order comes from ImagePositionPatient, not file names.
+  files = [write_slice(tmp_path / f"{i:03d}.dcm", volume[19 - i], 2.5 * (19 - i)) for i in range(20)]
+  result = convert_series(files, tmp_path / "ct.nii", tmp_path / "ct.nii.gz", check_header=check_header)
+  assert result.slices == 20 and result.header.shape[:3] == (64, 64, 20)
+  converted = sitk.ReadImage(str(tmp_path / "ct.nii.gz"))
+  assert np.array_equal(sitk.GetArrayFromImage(converted), volume)
+  assert converted.GetSpacing()[2] == pytest.approx(2.5)
+
+
+def test_single_slice_is_rejected(tmp_path):
+  path = write_slice(tmp_path / "one.dcm", np.zeros((64, 64), np.int16), 0)
+  with pytest.raises(InputRejected) as caught:
+    convert_series([path], tmp_path / "ct.nii", tmp_path / "ct.nii.gz", check_header=check_header)
+  assert caught.value.reason == "dimensions"
+
+
+def test_two_dimensional_image_is_rejected(tmp_path, monkeypatch):
+  # Some files are reported as plain 2D images, without a third size, spacing or direction axis.
+  flat = DicomSlice(path=tmp_path / "flat.dcm", series_uid="1", origin=(0, 0), direction=(1, 0, 0, 1),
+                    spacing=(0.8, 0.8), size=(64, 64), dtype="int16")
+  monkeypatch.setattr(dicom, "_read_info", lambda path: flat)
+  with pytest.raises(InputRejected) as caught:
+    convert_series([flat.path], tmp_path / "ct.nii", tmp_path / "ct.nii.gz")
+  assert caught.value.reason == "dimensions"
@@ -0,0 +1,38 @@
+from app.hashring import HashRing
+
+
+def owners(ring, keys):
+  return {key: next(ring.walk(key)) for key in keys}
+
+
+def test_walk_visits_every_node_once():
+  ring = HashRing()
+  for node in ("a", "b", "c"):
+    ring.add(node)
+  assert sorted(ring.walk("some-hash")) == ["a", "b", "c"]
+  assert list(HashRing().walk("x")) == []
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+  ring = HashRing()
+  for node in ("a", "b", "c"):
+    ring.add(node)
+  keys = [f"sha-{index}" for index in range(2000)]
+  before = owners(ring, keys)
+  ring.add("d")
+  after = owners(ring, keys)
+  moved = [key for key in keys if before[key] != after[key]]
+  assert all(after[key] == "d" for key in moved)
+  assert 0.1 < len(moved) / len(keys) < 0.4
+
+  ring.remove("d")
+  assert owners(ring, keys) == before
+  assert "d" not in ring and len(ring) == 3
+
+
+def test_weight_scales_the_share_of_keys():
+  ring = HashRing()
+  ring.add("small")
+  ring.add("big", weight=3)
+  shares = list(owners(ring, [f"k{index}" for index in range(4000)]).values())
+  assert 0.6 < shares.count("big") / len(shares) < 0.9
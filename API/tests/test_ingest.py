@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import struct
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from app.ingest import NiftiSink, ingest_file
+from app.nifti import NIFTI2_HEADER_SIZE, NiftiError, parse_header, read_header
+from app.validation import InputRejected, check_header
+
+
+def write_ct(path, shape=(20, 48, 40), spacing=(0.8, 0.8, 2.5)):
+  volume = np.random.default_rng(1).integers(-1000, 1500, size=shape).astype(np.int16)
+  image = sitk.GetImageFromArray(volume)
+  image.SetSpacing(spacing)
+  sitk.WriteImage(image, str(path), path.name.endswith(".gz"))
+  return volume
+
+
+def nifti2_header(shape, spacing, datatype=16, bitpix=32, endian="<"):
+  raw = bytearray(NIFTI2_HEADER_SIZE)
+  struct.pack_into(f"{endian}i", raw, 0, NIFTI2_HEADER_SIZE)
+  struct.pack_into(f"{endian}2h", raw, 12, datatype, bitpix)
+  struct.pack_into(f"{endian}8q", raw, 16, len(shape), *shape, *[1] * (7 - len(shape)))
+  struct.pack_into(f"{endian}8d", raw, 104, 1.0, *spacing, *[1.0] * (7 - len(spacing)))
+  struct.pack_into(f"{endian}q", raw, 168, 544)
+  struct.pack_into(f"{endian}2d", raw, 176, 1.0, 0.0)
+  return bytes(raw)
+
+
+def test_parse_header_of_a_simpleitk_file(tmp_path):
+  path = tmp_path / "ct.nii"
+  write_ct(path)
+  header = read_header(path)
+  assert header.version == 1 and header.endian == "<"
+  assert header.shape == (40, 48, 20)
+  assert header.spacing == pytest.approx((0.8, 0.8, 2.5))
+  assert header.dtype == "<i2" and header.data_bytes == 40 * 48 * 20 * 2
+  write_ct(tmp_path / "ct.nii.gz")
+  assert read_header(tmp_path / "ct.nii.gz").shape == header.shape
+
+
+def test_parse_header_big_endian_nifti1(tmp_path):
+  path = tmp_path / "ct.nii"
+  write_ct(path)
+  raw = bytearray(path.read_bytes()[:348])
+  little = parse_header(bytes(raw))
+  # Swap every field the parser reads.
+  struct.pack_into(">i", raw, 0, 348)
+  struct.pack_into(">8h", raw, 40, *struct.unpack_from("<8h", raw, 40))
+  struct.pack_into(">2h", raw, 70, *struct.unpack_from("<2h", raw, 70))
+  struct.pack_into(">12f", raw, 76, *struct.unpack_from("<12f", raw, 76))
+  big = parse_header(bytes(raw))
+  assert big.endian == ">" and big.dtype == ">i2"
+  assert (big.shape, big.spacing, big.vox_offset) == (little.shape, little.spacing, little.vox_offset)
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_parse_header_nifti2(endian):
+  header = parse_header(nifti2_header((512, 512, 300), (0.7, 0.7, 1.25), endian=endian))
+  assert header.version == 2 and header.shape == (512, 512, 300)
+  assert header.spacing == pytest.approx((0.7, 0.7, 1.25))
+  assert header.dtype == f"{endian}f4" and header.vox_offset == 544
+
+
+@pytest.mark.parametrize("raw, message", [
+  (b"\x00" * 100, "too short"),
+  (b"\x00" * 348, "bad sizeof_hdr"),
+  (struct.pack("<i", 540) + b"\x00" * 400, "NIfTI-2"),
+])
+def test_parse_header_rejects(raw, message):
+  with pytest.raises(NiftiError, match=message):
+    parse_header(raw)
+
+
+def feed_all(sink, data, chunk):
+  for start in range(0, len(data), chunk):
+    sink.feed(data[start:start + chunk])
+  return sink.close()
+
+
+@pytest.mark.parametrize("chunk", [1, 333, 1 << 20])
+def test_sink_expands_multi_member_gzip_in_any_chunking(tmp_path, chunk):
+  write_ct(tmp_path / "ct.nii")
+  plain = (tmp_path / "ct.nii").read_bytes()
+  # Several gzip members, as the parallel compressor writes them.
+  data = b"".join(gzip.compress(plain[i:i + 7000]) for i in range(0, len(plain), 7000))
+  if chunk == 1:
+    data = data[:20000]  # byte-at-a-time over the whole file takes too long; the header is what matters
+  sink = NiftiSink(tmp_path / "up.nii.gz", tmp_path / "up.nii", check_header=None)
+  result = feed_all(sink, data, chunk)
+  assert result.content_hash == hashlib.sha256(data).hexdigest()
+  assert (tmp_path / "up.nii.gz").read_bytes() == data
+  if chunk == 1:
+    assert not result.complete
+    assert (tmp_path / "up.nii").stat().st_size < len(plain)
+    return
+  assert result.complete and result.header.shape == (40, 48, 20)
+  assert (tmp_path / "up.nii").read_bytes() == plain
+  assert np.array_equal(np.asarray(result.volume()).T, sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / "ct.nii"))))
+
+
+def test_sink_accepts_uncompressed_and_checks_the_header_before_writing(tmp_path):
+  write_ct(tmp_path / "ct.nii", shape=(20, 48, 40))
+  data = (tmp_path / "ct.nii").read_bytes()
+  result = ingest_file(tmp_path / "ct.nii", tmp_path / "copy.nii", check_header=check_header)
+  assert result.complete and (tmp_path / "copy.nii").read_bytes() == data
+
+  write_ct(tmp_path / "tiny.nii", shape=(4, 48, 40))
+  sink = NiftiSink(tmp_path / "tiny.nii.gz", tmp_path / "tiny_up.nii", check_header=check_header)
+  with pytest.raises(InputRejected) as caught:
+    feed_all(sink, (tmp_path / "tiny.nii").read_bytes(), 100)
+  assert caught.value.reason == "dimensions"
+  # Nothing reached the disk for a volume refused on its header.
+  assert not (tmp_path / "tiny.nii.gz").exists() and not (tmp_path / "tiny_up.nii").exists()
+
+
+def test_sink_rejects_non_nifti_and_stores_archives(tmp_path):
+  sink = NiftiSink(tmp_path / "x.nii.gz", tmp_path / "x.nii", check_header=check_header)
+  with pytest.raises(NiftiError):
+    feed_all(sink, gzip.compress(b"hello" * 200), 64)
+  assert not (tmp_path / "x.nii.gz").exists()
+
+  sink = NiftiSink(tmp_path / "series.zip", tmp_path / "series.nii", check_header=check_header)
+  result = feed_all(sink, b"PK\x03\x04" + b"\x00" * 500, 50)
+  assert result.archive and result.header is None
+  assert (tmp_path / "series.zip").stat().st_size == 504
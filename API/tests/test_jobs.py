@@ -0,0 +1,170 @@
+import asyncio
+import threading
+import time
+from pathlib import Path
+
+from app.jobs import DONE, PERSISTED, QUEUED, Job, JobQueue
+
+
+def make_job(job_id: str, *, priority: str = "standard", client: str = "a", content_hash=None) -> Job:
+  return Job(job_id=job_id, kind="liver", case_id=job_id, input_path=Path(f"/nonexistent/{job_id}.nii.gz"),
+             priority=priority, client=client, content_hash=content_hash)
+
+
+def test_wait_async_wakes_when_another_thread_completes_the_job():
+  queue = JobQueue()
+  queue.register_worker("w", worker_id="w")
+  job = queue.submit(make_job("j1"))
+
+  async def main():
+    waiters = [asyncio.ensure_future(job.wait_async()) for _ in range(200)]
+    await asyncio.sleep(0)
+    claimed = queue.claim("w")
+    threading.Timer(0.05, queue.complete, args=(claimed.job_id, Path("/tmp/result"))).start()
+    await asyncio.wait_for(asyncio.gather(*waiters), 5)
+
+  asyncio.run(main())
+  assert job.status == DONE
+
+
+def test_wait_async_returns_at_once_for_a_finished_job():
+  job = make_job("j2")
+  job.finish()
+  asyncio.run(asyncio.wait_for(job.wait_async(), 1))
+
+
+def test_claim_async_picks_up_a_job_submitted_while_polling():
+  queue = JobQueue()
+  queue.register_worker("w", worker_id="w")
+
+  async def main():
+    claim = asyncio.ensure_future(queue.claim_async("w", timeout=5))
+    await asyncio.sleep(0.05)
+    threading.Thread(target=queue.submit, args=(make_job("j3"),)).start()
+    return await asyncio.wait_for(claim, 2)
+
+  job = asyncio.run(main())
+  assert job is not None and job.job_id == "j3" and job.worker_id == "w"
+
+
+def test_claim_async_times_out_empty():
+  queue = JobQueue()
+  queue.register_worker("w", worker_id="w")
+  assert asyncio.run(queue.claim_async("w", timeout=0.1)) is None
+  assert not queue._claim_waiters
+
+
+def test_complete_measures_auto_config_seconds_on_the_queue_clock():
+  queue = JobQueue()
+  queue.register_worker("w", worker_id="w")
+  job = make_job("j4")
+  job.params = {"auto_config": {"deadline_s": 60, "predicted_seconds": 30.0, "submitted_at": time.time() - 12}}
+  queue.submit(job)
+  queue.claim("w")
+  # A remote worker with a skewed clock reports its own figure; the queue's measurement wins.
+  worker_metadata = {"auto_config": {"deadline_s": 60, "predicted_seconds": 30.0, "actual_seconds": -3600.0}}
+  queue.complete("j4", Path("/tmp/result"), worker_metadata)
+  auto = job.metadata["auto_config"]
+  assert 12 <= auto["actual_seconds"] < 20
+  assert "submitted_at" not in auto and auto["predicted_seconds"] == 30.0
+
+
+def test_same_content_hash_is_routed_to_the_same_node():
+  queue = JobQueue(load_factor=10.0)
+  for name in ("a", "b", "c"):
+    queue.register_worker(name, worker_id=name)
+  first = queue.submit(make_job("h1", content_hash="sha-1"))
+  again = queue.submit(make_job("h2", content_hash="sha-1"))
+  assert first.assigned_to == again.assigned_to is not None
+  other = next(name for name in ("a", "b", "c") if name != first.assigned_to)
+  # Another node does not take a job assigned elsewhere while that node is registered.
+  assert queue.claim(other) is None
+  assert queue.claim(first.assigned_to).job_id == "h1"
+
+
+def test_bounded_load_spills_a_hot_hash_to_the_next_node():
+  queue = JobQueue(load_factor=1.0)
+  for name in ("a", "b"):
+    queue.register_worker(name, worker_id=name)
+  jobs = [queue.submit(make_job(f"hot{index}", content_hash="sha-hot")) for index in range(4)]
+  nodes = [job.assigned_to for job in jobs]
+  # With a load factor of 1, no node may hold more than its share of the queued work.
+  assert sorted(nodes.count(node) for node in ("a", "b")) == [2, 2]
+
+
+def test_expired_worker_gives_back_its_jobs():
+  queue = JobQueue(load_factor=10.0)
+  queue.register_worker("a", worker_id="a")
+  queue.register_worker("b", worker_id="b")
+  job = queue.submit(make_job("e1", content_hash="sha-e"))
+  owner = job.assigned_to
+  survivor = "b" if owner == "a" else "a"
+  queue.claim(owner)
+  queue._workers[owner].last_seen = 0
+  assert queue.expire_workers(60) == [owner]
+  assert job.status == QUEUED and job.assigned_to == survivor
+  assert queue.claim(survivor).job_id == "e1"
+
+
+def test_submitted_jobs_are_served_by_priority_then_fair_share():
+  queue = JobQueue()
+  queue.register_worker("w", worker_id="w")
+  for index in range(3):
+    queue.submit(make_job(f"big{index}", client="big"))
+  queue.submit(make_job("small0", client="small"))
+  queue.submit(make_job("urgent", priority="interactive", client="big"))
+  order = [queue.claim("w").job_id for _ in range(5)]
+  # Interactive first; then "small" is interleaved with "big" rather than waiting behind all of it.
+  assert order[0] == "urgent"
+  assert order.index("small0") <= 2
+  assert queue.claim("w") is None
+
+
+def test_bulk_job_is_preempted_for_interactive_work_and_requeued_on_its_node():
+  queue = JobQueue()
+  queue.register_worker("w", worker_id="w")
+  bulk = queue.submit(make_job("bulk", priority="bulk", content_hash="sha-b"))
+  queue.claim("w")
+  assert not queue.should_preempt("bulk")
+  queue.submit(make_job("urgent", priority="interactive"))
+  assert queue.should_preempt("bulk")
+  queue.requeue("bulk", worker_id="w")
+  assert bulk.status == QUEUED and bulk.preemptions == 1 and bulk.assigned_to == "w"
+  assert [queue.claim("w").job_id for _ in range(2)] == ["urgent", "bulk"]
+
+
+def test_preemption_needs_every_slot_busy():
+  queue = JobQueue()
+  queue.register_worker("a", worker_id="a")
+  queue.register_worker("b", worker_id="b")
+  queue.submit(make_job("bulk", priority="bulk", content_hash="sha-b"))
+  queue.claim(queue.get("bulk").assigned_to)
+  queue.submit(make_job("urgent", priority="interactive"))
+  assert not queue.should_preempt("bulk")
+
+
+def test_drain_persists_queued_and_running_jobs_for_the_next_process(settings):
+  from app.drain import Drainer, restore_jobs, state_path
+
+  queue = JobQueue()
+  queue.register_worker("w", worker_id="w")
+  running = queue.submit(make_job("d1", content_hash="sha-d1"))
+  queued = queue.submit(make_job("d2"))
+  for job in (running, queued):
+    job.input_uri = f"s3://bucket/{job.job_id}.nii.gz"
+  queue.claim("w")
+  drainer = Drainer(queue, grace_seconds=0.2)
+  finished = threading.Event()
+  assert drainer.start("test", on_finished=finished.set)
+  assert not drainer.start("again")
+  assert finished.wait(10)
+  # The running job asks to stop at its next stage boundary while the drain waits.
+  assert queue.claim("w") is None
+  assert {job.job_id for job in drainer.persisted} == {"d1", "d2"}
+  assert running.status == queued.status == PERSISTED and running.done.is_set()
+  assert state_path().exists()
+
+  fresh = JobQueue()
+  restored = restore_jobs(fresh)
+  assert sorted(job.job_id for job in restored) == ["d1", "d2"]
+  assert not state_path().exists() and fresh.depth() == 2
@@ -0,0 +1,86 @@
+import zlib
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from app import maskcodec
+
+SPACING = (0.78, 0.78, 2.5)
+ORIGIN = (-200.0, -180.5, 35.0)
+DIRECTION = (1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 1.0)
+
+
+def label_maps(dtype):
+  rng = np.random.default_rng(7)
+  shape = (24, 40, 36)
+  blobs = np.zeros(shape, dtype)
+  blobs[3:20, 5:30, 4:22] = 1
+  blobs[10:14, 12:18, 8:12] = 2
+  blobs[0, 0, 0] = 3  # a single voxel in the corner
+  blobs[-1, -1, -1] = 3
+  # Speckle favours the bit-packed encoding, large regions the run lengths.
+  noise = (rng.random(shape) < 0.3).astype(dtype) * 5
+  return {
+    "empty": np.zeros(shape, dtype),
+    "full": np.full(shape, 1, dtype),
+    "blobs": blobs,
+    "noise": noise,
+  }
+
+
+def cases():
+  values = {np.uint8: 250, np.int16: 3000}
+  for dtype, high in values.items():
+    for name, labels in label_maps(dtype).items():
+      yield pytest.param(labels, id=f"{np.dtype(dtype).name}-{name}")
+    high_label = np.zeros((8, 9, 10), dtype)
+    high_label[2:5, 3:7, 1:9] = high
+    yield pytest.param(high_label, id=f"{np.dtype(dtype).name}-high-value")
+
+
+@pytest.mark.parametrize("labels", list(cases()))
+def test_round_trip(labels):
+  decoded, header = maskcodec.decode(maskcodec.encode(labels, SPACING, ORIGIN, DIRECTION))
+  assert decoded.dtype == labels.dtype
+  assert np.array_equal(decoded, labels)
+  assert header["shape"] == list(labels.shape)
+  present = {entry["value"]: entry["voxels"] for entry in header["labels"]}
+  values, counts = np.unique(labels[labels != 0], return_counts=True)
+  assert present == dict(zip(values.tolist(), counts.tolist()))
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16])
+def test_matches_nifti_written_and_read_by_simpleitk(tmp_path, dtype):
+  labels = label_maps(dtype)["blobs"]
+  image = sitk.GetImageFromArray(labels)
+  image.SetSpacing(SPACING)
+  image.SetOrigin(ORIGIN)
+  image.SetDirection(DIRECTION)
+  path = tmp_path / "mask.nii.gz"
+  sitk.WriteImage(image, str(path), True)
+
+  reference = sitk.ReadImage(str(path))
+  expected = sitk.GetArrayFromImage(reference)
+  data = maskcodec.encode(expected, reference.GetSpacing(), reference.GetOrigin(), reference.GetDirection())
+  decoded, header = maskcodec.decode(data)
+  assert np.array_equal(decoded, expected) and np.array_equal(decoded, labels)
+  for name, value in (("spacing", reference.GetSpacing()), ("origin", reference.GetOrigin()),
+                      ("direction", reference.GetDirection())):
+    assert np.allclose(header[name], value, atol=1e-5)
+
+
+def test_zlib_fallback_and_partial_decode(monkeypatch):
+  labels = label_maps(np.uint8)["blobs"]
+  monkeypatch.setattr(maskcodec, "_compressor", lambda: ("zlib", lambda raw: zlib.compress(raw, 9)))
+  data = maskcodec.encode(labels, SPACING, ORIGIN, DIRECTION)
+  decoded, header = maskcodec.decode(data, values=[2])
+  assert header["codec"] == "zlib"
+  assert np.array_equal(decoded, np.where(labels == 2, labels, 0))
+
+
+def test_rejects_negative_labels_and_foreign_data():
+  with pytest.raises(ValueError):
+    maskcodec.encode(np.full((2, 2, 2), -1, np.int16), SPACING, ORIGIN, DIRECTION)
+  with pytest.raises(ValueError):
+    maskcodec.decode(b"not a mask")
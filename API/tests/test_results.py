@@ -0,0 +1,58 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.results import get_result_store
+
+ALICE = {"X-Client-Id": "alice"}
+
+
+@pytest.fixture
+def stored(tmp_path):
+  result = tmp_path / "case_liver.nii.gz"
+  result.write_bytes(bytes(range(256)) * 4)
+  entry = get_result_store().put("job_results_test", "liver", "case", None, result, "case_liver.nii.gz",
+                                   client="alice")
+  return entry, entry.artifacts["case_liver.nii.gz"]["etag"]
+
+
+def test_if_none_match_answers_304(stored):
+  _, etag = stored
+  response = TestClient(app).get(
+    "/results/job_results_test/case_liver.nii.gz", headers={**ALICE, "If-None-Match": etag},
+  )
+  assert response.status_code == 304
+  assert response.headers["etag"] == etag
+
+
+def test_range_resumes_when_if_range_matches_the_advertised_etag(stored):
+  _, etag = stored
+  response = TestClient(app).get(
+    "/results/job_results_test/case_liver.nii.gz", headers={**ALICE, "Range": "bytes=0-9", "If-Range": etag},
+  )
+  assert response.status_code == 206
+  assert response.content == bytes(range(10))
+
+
+def test_stale_if_range_gets_the_whole_file(stored):
+  response = TestClient(app).get(
+    "/results/job_results_test/case_liver.nii.gz", headers={**ALICE, "Range": "bytes=0-9", "If-Range": '"stale"'},
+  )
+  assert response.status_code == 200
+  assert len(response.content) == 1024
+
+
+def test_range_without_if_range(stored):
+  response = TestClient(app).get(
+    "/results/job_results_test/case_liver.nii.gz", headers={**ALICE, "Range": "bytes=10-19"},
+  )
+  assert response.status_code == 206
+  assert response.content == bytes(range(10, 20))
+
+
+def test_results_are_only_found_by_their_client(stored):
+  client = TestClient(app)
+  assert client.get("/results/job_results_test", headers=ALICE).json()["job_id"] == "job_results_test"
+  for who in ({"X-Client-Id": "mallory"}, {}):
+    assert client.get("/results/job_results_test", headers=who).status_code == 404
+    assert client.get("/results/job_results_test/case_liver.nii.gz", headers=who).status_code == 404
@@ -0,0 +1,152 @@
+import gzip
+import hashlib
+import io
+import json
+import threading
+import time
+import zipfile
+
+import boto3
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from moto import mock_aws
+
+from app.publish import ResultPublisher, publish_package
+from app.s3 import fetch_input, get_s3_client, parse_s3_uri, probe
+
+BUCKET = "hpb-test"
+
+
+@pytest.fixture
+def s3(settings, monkeypatch):
+  for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"):
+    monkeypatch.setenv(name, "testing")
+  monkeypatch.setattr(settings, "s3_bucket", BUCKET)
+  monkeypatch.setattr(settings, "s3_input_buckets", None)
+  monkeypatch.setattr(settings, "s3_endpoint", None)
+  # Small parts so a test volume is fetched as many concurrent ranges.
+  monkeypatch.setattr(settings, "s3_part_mb", 0.01)
+  monkeypatch.setattr(settings, "s3_concurrency", 4)
+  with mock_aws():
+    get_s3_client.cache_clear()
+    client = boto3.client("s3", region_name=settings.aws_region)
+    client.create_bucket(Bucket=BUCKET)
+    yield client
+  get_s3_client.cache_clear()
+
+
+def ct_gz(tmp_path):
+  volume = np.random.default_rng(5).integers(-1000, 1500, size=(20, 48, 40)).astype(np.int16)
+  image = sitk.GetImageFromArray(volume)
+  image.SetSpacing((0.8, 0.8, 2.5))
+  sitk.WriteImage(image, str(tmp_path / "ct.nii"))
+  return gzip.compress((tmp_path / "ct.nii").read_bytes()), (tmp_path / "ct.nii").read_bytes()
+
+
+def test_parse_s3_uri_only_allows_input_buckets(s3):
+  assert parse_s3_uri(f"s3://{BUCKET}/cases/a.nii.gz") == (BUCKET, "cases/a.nii.gz")
+  for uri in ("https://x/y", f"s3://{BUCKET}", "s3://other-bucket/a.nii.gz"):
+    with pytest.raises(ValueError):
+      parse_s3_uri(uri)
+
+
+def test_probe_and_fetch_input(s3, tmp_path):
+  data, plain = ct_gz(tmp_path)
+  assert len(data) > 5 * 10 * 1024  # spans several ranged parts
+  s3.put_object(Bucket=BUCKET, Key="cases/ct.nii.gz", Body=data)
+  uri = f"s3://{BUCKET}/cases/ct.nii.gz"
+
+  size, header = probe(uri)
+  assert size == len(data) and header.shape == (40, 48, 20)
+
+  result = fetch_input(uri, tmp_path / "job" / "input.nii.gz")
+  assert result.content_hash == hashlib.sha256(data).hexdigest()
+  assert result.complete and result.header.shape == (40, 48, 20)
+  assert (tmp_path / "job" / "input.nii.gz").read_bytes() == data
+  assert result.nii_path.read_bytes() == plain
+
+
+def test_probe_recognises_archives(s3):
+  s3.put_object(Bucket=BUCKET, Key="cases/series.zip", Body=b"PK\x03\x04" + b"\x00" * 100)
+  assert probe(f"s3://{BUCKET}/cases/series.zip") == (104, None)
+
+
+def test_publish_package_uploads_every_member(s3, settings, tmp_path):
+  package = tmp_path / "c1_results.zip"
+  with zipfile.ZipFile(package, "w") as archive:
+    archive.writestr("liver.nii.gz", b"liver-bytes")
+    archive.writestr("meta.json", b"{}")
+  published = publish_package("c1", package)
+  prefix = f"{settings.s3_result_prefix}/c1/segmentations"
+  assert sorted(published.keys) == [f"{prefix}/liver.nii.gz", f"{prefix}/meta.json"]
+  stored = s3.get_object(Bucket=BUCKET, Key=f"{prefix}/liver.nii.gz")
+  assert stored["Body"].read() == b"liver-bytes" and stored["ContentType"] == "application/gzip"
+  assert s3.head_object(Bucket=BUCKET, Key=f"{prefix}/meta.json")["ContentType"] == "application/json"
+
+
+def test_result_publisher_reports_failures(s3, settings, tmp_path):
+  single = tmp_path / "task008.nii.gz"
+  single.write_bytes(b"mask")
+  publisher = ResultPublisher()
+  publisher.submit("c2", single)
+  publisher.submit("c3", tmp_path / "missing.zip")
+  report = publisher.finish()
+  assert report["failed"] == ["c3"]
+  assert report["cases"]["c2"]["bytes"] == 4
+  key = f"{settings.s3_result_prefix}/c2/segmentations/task008.nii.gz"
+  assert s3.get_object(Bucket=BUCKET, Key=key)["Body"].read() == b"mask"
+
+
+def test_batch_publishes_each_case_before_its_scratch_is_released(s3, settings, tmp_path, monkeypatch):
+  from fastapi.testclient import TestClient
+
+  from app import publish, worker
+  from app.jobs import get_job_queue
+  from app.main import app
+
+  def fake_execute(kind, ct_path, scratch_root, *, case_id, **kwargs):
+    package = scratch_root / f"{case_id}_results.zip"
+    with zipfile.ZipFile(package, "w") as archive:
+      archive.writestr("liver.nii.gz", case_id.encode())
+    return package, {"case_id": case_id}
+
+  def slow_publish(case_id, package):
+    time.sleep(0.3)  # the stream has moved on to the next case by now
+    return upload(case_id, package)
+
+  upload = publish.publish_package
+  monkeypatch.setattr(worker, "execute", fake_execute)
+  monkeypatch.setattr(publish, "publish_package", slow_publish)
+  data, _ = ct_gz(tmp_path)
+  bundle = io.BytesIO()
+  with zipfile.ZipFile(bundle, "w") as archive:
+    for case_id in ("p1", "p2"):
+      archive.writestr(f"{case_id}/raw.nii.gz", data)
+
+  queue = get_job_queue()
+  queue.register_worker("publish-test", worker_id="publish-test")
+  stop = threading.Event()
+
+  def run_jobs():
+    while not stop.is_set():
+      job = queue.claim("publish-test", timeout=0.1)
+      if job is not None:
+        worker.process_job(queue, job)
+
+  thread = threading.Thread(target=run_jobs, daemon=True)
+  thread.start()
+  try:
+    response = TestClient(app).post("/segment/batch?publish=true", content=bundle.getvalue(),
+                                    headers={"Content-Type": "application/zip"})
+  finally:
+    stop.set()
+    thread.join(5)
+    queue.expire_workers(0)
+  assert response.status_code == 200
+  with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+    report = json.loads(archive.read("manifest.json"))["publish"]
+  assert report["failed"] == [] and sorted(report["cases"]) == ["p1", "p2"]
+  for case_id in ("p1", "p2"):
+    key = f"{settings.s3_result_prefix}/{case_id}/segmentations/liver.nii.gz"
+    assert s3.get_object(Bucket=BUCKET, Key=key)["Body"].read() == case_id.encode()
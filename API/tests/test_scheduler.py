@@ -0,0 +1,19 @@
+import pytest
+
+from app.scheduler import stage_plan
+
+
+@pytest.mark.parametrize("resident", [False, True])
+def test_task008_stages_carry_the_runner_the_pipeline_reports(settings, monkeypatch, resident):
+  monkeypatch.setattr(settings, "resident_models", resident)
+  plans = [
+    stage_plan("task008", {"folds": "0"}),
+    stage_plan("both", {"folds": "0", "crop": True}),
+    stage_plan("structures", {"structures": ["hepatic_vessels"], "crop": True}),
+  ]
+  for plan in plans:
+    task008 = [params for stage, params in plan if stage == "task008"]
+    assert task008 and all(("runner" in params) == resident for params in task008)
+    assert all("runner" not in params for stage, params in plan if stage != "task008")
+  if resident:
+    assert plans[0] == [("task008", {"folds": "0", "crop": False, "runner": "resident"})]
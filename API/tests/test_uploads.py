@@ -0,0 +1,106 @@
+import base64
+import gzip
+import hashlib
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from fastapi.testclient import TestClient
+
+from app.uploads import TUS_VERSION, UploadStore, get_upload_store
+
+TUS = {"Tus-Resumable": TUS_VERSION}
+
+
+@pytest.fixture(scope="module")
+def client():
+  from app.main import app
+
+  return TestClient(app)
+
+
+@pytest.fixture(scope="module")
+def ct_bytes(tmp_path_factory):
+  path = tmp_path_factory.mktemp("ct") / "ct.nii"
+  volume = np.random.default_rng(3).integers(-1000, 1500, size=(20, 48, 40)).astype(np.int16)
+  image = sitk.GetImageFromArray(volume)
+  image.SetSpacing((0.8, 0.8, 2.5))
+  sitk.WriteImage(image, str(path))
+  return gzip.compress(path.read_bytes())
+
+
+def create(client, length, who="alice"):
+  metadata = f"filename {base64.b64encode(b'ct.nii.gz').decode()}"
+  response = client.post("/uploads", headers={**TUS, "Upload-Length": str(length), "Upload-Metadata": metadata,
+                                              "X-Client-Id": who})
+  assert response.status_code == 201
+  return response.headers["Location"]
+
+
+def patch(client, location, offset, data, who="alice", **headers):
+  return client.patch(location, content=data, headers={
+    **TUS, "Upload-Offset": str(offset), "Content-Type": "application/offset+octet-stream", "X-Client-Id": who,
+    **headers,
+  })
+
+
+def test_options_advertise_the_extensions(client):
+  response = client.options("/uploads")
+  assert response.status_code == 204
+  assert set(response.headers["Tus-Extension"].split(",")) == {"creation", "checksum", "termination", "expiration"}
+
+
+def test_resumable_upload_state_machine(client, ct_bytes):
+  location = create(client, len(ct_bytes))
+  upload_id = location.rsplit("/", 1)[-1]
+  half = len(ct_bytes) // 2
+
+  assert client.head(location, headers={**TUS, "X-Client-Id": "alice"}).headers["Upload-Offset"] == "0"
+  assert patch(client, location, 0, ct_bytes[:half]).status_code == 204
+  # A retried PATCH at a stale offset is refused; HEAD tells the client where to resume.
+  assert patch(client, location, 0, ct_bytes[:half]).status_code == 409
+  assert client.head(location, headers={**TUS, "X-Client-Id": "alice"}).headers["Upload-Offset"] == str(half)
+  # Another client cannot see or touch the upload.
+  assert client.head(location, headers={**TUS, "X-Client-Id": "mallory"}).status_code == 404
+  assert patch(client, location, half, ct_bytes[half:], who="mallory").status_code == 404
+
+  wrong = base64.b64encode(hashlib.sha1(b"other").digest()).decode()
+  assert patch(client, location, half, ct_bytes[half:], **{"Upload-Checksum": f"sha1 {wrong}"}).status_code == 460
+  assert patch(client, location, half, ct_bytes[half:] + b"extra").status_code == 413
+  right = base64.b64encode(hashlib.sha1(ct_bytes[half:]).digest()).decode()
+  assert patch(client, location, half, ct_bytes[half:], **{"Upload-Checksum": f"sha1 {right}"}).status_code == 204
+
+  store = get_upload_store()
+  target = store.root.parent / "job_test" / "input.nii.gz"
+  result = store.take(upload_id, "alice", target)
+  assert result.content_hash == hashlib.sha256(ct_bytes).hexdigest()
+  assert result.complete and result.header.shape == (40, 48, 20)
+  assert target.read_bytes() == ct_bytes and result.nii_path.exists()
+  assert client.head(location, headers={**TUS, "X-Client-Id": "alice"}).status_code == 404
+
+
+def test_upload_survives_a_restart(client, ct_bytes):
+  location = create(client, len(ct_bytes))
+  upload_id = location.rsplit("/", 1)[-1]
+  assert patch(client, location, 0, ct_bytes[:5000]).status_code == 204
+  store = get_upload_store()
+  # A new process reads the saved state and resumes from the bytes on disk.
+  reopened = UploadStore(store.root, store.max_bytes, store.ttl_seconds)
+  upload = reopened.get(upload_id, "alice")
+  assert upload.offset == 5000 and upload.metadata == {"filename": "ct.nii.gz"}
+  assert client.delete(location, headers={**TUS, "X-Client-Id": "alice"}).status_code == 204
+  assert not upload.folder.exists()
+
+
+def test_non_ct_upload_is_rejected_and_discarded(client):
+  data = gzip.compress(b"not a nifti file" * 100)
+  location = create(client, len(data))
+  response = patch(client, location, 0, data)
+  assert response.status_code == 400  # "malformed"
+  assert client.head(location, headers={**TUS, "X-Client-Id": "alice"}).status_code == 404
+
+
+def test_create_validates_length(client):
+  assert client.post("/uploads", headers=TUS).status_code == 400
+  too_big = get_upload_store().max_bytes + 1
+  assert client.post("/uploads", headers={**TUS, "Upload-Length": str(too_big)}).status_code == 413
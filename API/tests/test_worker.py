@@ -0,0 +1,85 @@
+import socket
+import threading
+import time
+from pathlib import Path
+
+import pytest
+import uvicorn
+from fastapi import FastAPI
+
+from app import coordinator, worker
+from app.jobs import DONE, Job, JobQueue
+from app.worker import RemoteWorker
+
+TOKEN = "test-worker-token"
+
+
+def free_port() -> int:
+  with socket.socket() as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+
+@pytest.fixture
+def queue(settings, monkeypatch):
+  monkeypatch.setattr(settings, "worker_token", TOKEN)
+  fresh = JobQueue(load_factor=settings.routing_load_factor)
+  monkeypatch.setattr(coordinator, "get_job_queue", lambda: fresh)
+  yield fresh
+  fresh.close()
+
+
+@pytest.fixture
+def coordinator_url(queue):
+  app = FastAPI()
+  app.include_router(coordinator.router)
+  port = free_port()
+  server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+  thread = threading.Thread(target=server.run, daemon=True)
+  thread.start()
+  deadline = time.time() + 10
+  while not server.started:
+    assert time.time() < deadline, "coordinator did not start"
+    time.sleep(0.05)
+  yield f"http://127.0.0.1:{port}"
+  server.should_exit = True
+  thread.join(10)
+
+
+def fake_execute(kind, ct_path, scratch_root, *, case_id, **kwargs):
+  time.sleep(0.1)  # long enough that one worker cannot drain the queue alone
+  result = Path(scratch_root) / f"{case_id}.nii.gz"
+  result.write_bytes(ct_path.read_bytes())
+  return result, {"case_id": case_id}
+
+
+def test_jobs_are_spread_across_remote_workers(queue, coordinator_url, monkeypatch, tmp_path):
+  monkeypatch.setattr(worker, "execute", fake_execute)
+  nodes = [RemoteWorker(coordinator_url, name=f"node{i}", token=TOKEN, poll_seconds=0.5) for i in range(2)]
+  for node in nodes:
+    threading.Thread(target=node.serve_forever, daemon=True).start()
+  deadline = time.time() + 10
+  while len(queue.workers()) < len(nodes):
+    assert time.time() < deadline, "workers did not register"
+    time.sleep(0.05)
+
+  jobs = []
+  for index in range(8):
+    ct = tmp_path / f"case{index}.nii.gz"
+    ct.write_bytes(f"case {index}".encode())
+    job = Job(job_id=f"job{index}", kind="liver", case_id=f"case{index}", input_path=ct,
+              content_hash=f"{index:064x}")
+    jobs.append(queue.submit(job))
+  try:
+    for job in jobs:
+      assert job.wait(20), f"{job.job_id} did not finish"
+  finally:
+    for node in nodes:
+      node.stop()
+
+  assert all(job.status == DONE for job in jobs)
+  # Bounded-load routing gives each node a share, and each job ran where it was routed.
+  ran_on = {job.worker_id for job in jobs}
+  assert ran_on == {node.worker_id for node in nodes}
+  assert all(job.worker_id == job.assigned_to for job in jobs)
+  assert all(job.metadata["case_id"] == job.case_id for job in jobs)